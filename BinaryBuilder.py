@@ -11,7 +11,7 @@ import subprocess
 import sys
 import urllib2
 import logging
-import copy, re
+import copy, re, time, json, shutil, resource
 
 from collections import namedtuple
 from functools import wraps, partial
@@ -44,7 +44,23 @@ def list_recursively(dir):
             matches.append(os.path.join(root, filename))
     return matches
 
+_platform = None
+
 def get_platform(pkg=None):
+    '''The platform we run on. It is worked out on the first call only, as
+       everything from Package.__init__ to the baking of each file asks.'''
+    global _platform
+    if _platform is None:
+        _platform = _probe_platform()
+    if _platform is None:
+        message = 'Cannot match system to known platform'
+        if pkg is None:
+            raise Exception(message)
+        else:
+            raise PackageError(pkg, message)
+    return _platform
+
+def _probe_platform():
     system  = platform.system()
     machine = platform.machine()
     p = namedtuple('Platform', 'os bits osbits system machine prettyos dist_name dist_version')
@@ -66,12 +82,7 @@ def get_platform(pkg=None):
         return p('osx', 64, 'osx64', system, 'x86_64', 'OSX', name, ver)
     elif system == 'Darwin' and machine == 'x86_64':
         return p('osx', 64, 'osx64', system, machine, 'OSX', name, ver)
-    else:
-        message = 'Cannot match system to known platform'
-        if pkg is None:
-            raise Exception(message)
-        else:
-            raise PackageError(pkg, message)
+    return None
 
 def get_prog_version(prog):
     try:
@@ -95,8 +106,25 @@ class HelperError(Exception):
         super(HelperError, self).__init__('Command[%s] %s\nEnv%s' % (tool, message, env))
 
 def hash_file(filename):
+    h = sha1()
     with file(filename, 'rb') as f:
-        return sha1(f.read()).hexdigest()
+        for block in iter(lambda: f.read(1 << 20), ''):
+            h.update(block)
+    return h.hexdigest()
+
+def trim_la_file(filename):
+    '''Empty dependency_libs in a libtool archive, if it is for a shared
+       library. Returns True if the file was changed.'''
+    with file(filename, 'r') as f:
+        text = f.read()
+    if not re.search(r"^library_names='.+'", text, re.M):
+        return False # Static only, the archive really needs its deps
+    new = re.compile(r"^dependency_libs='.*?'", re.M).sub("dependency_libs=''", text)
+    if new == text:
+        return False
+    with file(filename, 'w') as f:
+        f.write(new)
+    return True
 
 def run(*args, **kw):
     '''Try to execute a command line command'''
@@ -180,17 +208,48 @@ def die(*args, **kw):
     error(*args, **kw)
     sys.exit(kw.get('code', -1))
 
+def children_cpu_time():
+    '''CPU seconds used so far by the finished child processes'''
+    r = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return r.ru_utime + r.ru_stime
+
 def stage(f):
     '''Wraps a function to provide some standard output formatting.
-       Only compatible with the Package class!'''
+       Only compatible with the Package class! The wall and CPU time of
+       each stage end up in the package's stage_times.
+
+       In a warm rebuild (see Package.unpack) configure is not run, but
+       the changes it made to self.env last time (ilmbase's AUTOHEADER,
+       protobuf's PATH, ...) are made again, for the stages after it.
+       Anything else a configure override leaves behind for them is not,
+       so such a package must be rebuilt without --fast.'''
     @wraps(f)
     def wrapper(self, *args, **kw):
         stage = f.__name__
         info('========== %s.%s ==========' % (self.pkgname, stage))
+        if stage == 'configure' and getattr(self, 'warm', False):
+            info('Configure inputs are unchanged, keeping the configured tree')
+            for k, v in self.state.get('configure_env', dict()).iteritems():
+                if v is None:
+                    self.env.pop(k, None)
+                else:
+                    self.env[k] = v
+            return None
+        wall, cpu = time.time(), children_cpu_time()
+        env = dict(self.env) if stage == 'configure' else None
         try:
-            return f(self, *args, **kw)
+            ret = f(self, *args, **kw)
+            if stage == 'configure' and getattr(self, 'state', None) is not None:
+                changed = dict((k, v) for k, v in self.env.iteritems() if env.get(k) != v)
+                changed.update((k, None) for k in env if k not in self.env)
+                self.state['configure_env'] = changed
+                self.state['configured'] = True
+                self._save_state()
+            return ret
         except HelperError, e:
             raise PackageError(self, 'Stage[%s] %s' % (stage,e))
+        finally:
+            self.stage_times[stage] = dict(wall = time.time() - wall, cpu = children_cpu_time() - cpu)
     return wrapper
 
 class Environment(dict):
@@ -283,6 +342,20 @@ def get(url, output=None):
             f.write(block) # Write to disk
         info('\nDone')
 
+# Patched files that mean the package has to be configured again
+CONFIGURE_FILES = re.compile(r'^(configure(\.ac|\.in)?|aclocal\.m4|.*\.m4|Makefile\.(am|in)|CMakeLists\.txt|.*\.cmake|meson\.build|.*\.pro)$')
+
+def patched_files(patch):
+    '''The files a patch changes'''
+    ret = set()
+    with open(patch, 'r') as f:
+        for line in f:
+            if line.startswith('+++ ') or line.startswith('--- '):
+                name = line[4:].split('\t')[0].strip()
+                if name != '/dev/null':
+                    ret.add(name)
+    return ret
+
 class Package(object):
     '''Class to represent a single package that needs to be built.
        This class assumes the code for the package is posted online as a compressed file
@@ -291,6 +364,10 @@ class Package(object):
     chksum  = None
     patches = []
     patch_level = None
+    as_needed = False # Link with --as-needed, dropping libraries nothing uses
+    keep_la_deps = False # Keep dependency_libs in the .la files with build.py --trim-la
+    jobs = None # Always build with this -j, whatever build.py learned about the package
+    fast = False # build.py --fast: rebuild in the existing build tree if we can
 
     def __init__(self, env):
         '''Construct with the environment info'''
@@ -304,8 +381,14 @@ class Package(object):
         #info(self.pkgdir)
         self.tarball = None
         self.workdir = None
+        self.stage_times = dict()
         self.env = copy.deepcopy(env) # local copy of the environment, not affecting other packages
         self.arch = get_platform(self)
+        self.warm  = False # Building on in the tree of the last build
+        self.state = None  # What that tree was built from, see unpack()
+
+        if 'FAST' in env and int(env['FAST']) != 0:
+            self.fast = True
 
         self.env['CPPFLAGS'] = self.env.get('CPPFLAGS', '') + ' -I%(NOINSTALL_DIR)s/include -I%(INSTALL_DIR)s/include' % self.env
         self.env['CXXFLAGS'] = self.env.get('CXXFLAGS', '') + ' -I%(NOINSTALL_DIR)s/include -I%(INSTALL_DIR)s/include' % self.env
@@ -316,6 +399,11 @@ class Package(object):
         if P.isdir(self.env['INSTALL_DIR']+'/lib'):
             self.env['LDFLAGS'] = self.env.get('LDFLAGS', '') + ' -L%(INSTALL_DIR)s/lib' % self.env
 
+        # build.py --as-needed can turn it on for packages that don't ask for it
+        as_needed = self.env.get('AS_NEEDED', '').split(',')
+        if self.arch.os == 'linux' and (self.as_needed or self.pkgname in as_needed or 'all' in as_needed):
+            self.env['LDFLAGS'] = '-Wl,--as-needed ' + self.env.get('LDFLAGS', '')
+
         # Remove repeated entries in CPPFLAGS, CXXFLAGS, LDFLAGS
         self.env['CPPFLAGS'] = unique_compiler_flags(self.env['CPPFLAGS'])
         self.env['CXXFLAGS'] = unique_compiler_flags(self.env['CXXFLAGS'])
@@ -364,10 +452,22 @@ class Package(object):
     @stage
     def unpack(self):
         '''After unpack, the source code should be unpacked and should have any
-        necessary patches applied.'''
+        necessary patches applied.
+
+        With --fast, if the last build of the package configured its tree
+        from the same tarball, class definition and flags, that tree is
+        reused: the patches that changed since are reversed and the new
+        ones applied, configure is skipped, and make only rebuilds what
+        the changed files affect. If a changed patch touches the build
+        system, or does not reverse cleanly, the tree is built from
+        scratch.'''
 
         output_dir = P.join(self.env['BUILD_DIR'], self.pkgname)
 
+        if self.fast and self._warm_unpack(output_dir):
+            self._prepend_workdir_flags()
+            return
+
         self.remove_build(output_dir) # Throw out the old content
 
         ext = P.splitext(self.tarball)[-1]
@@ -395,8 +495,11 @@ class Package(object):
 
             self.workdir = self.workdir[0]
 
+        self.state = dict(inputs = self._inputs(), workdir = self.workdir, patches = [], configured = False)
         self._apply_patches()
+        self._prepend_workdir_flags()
 
+    def _prepend_workdir_flags(self):
         # Prepend the work dir to the include/link dirs, to ensure the newest
         # version of any software is used. This is a bugfix.
         self.env['CPPFLAGS'] = '-I' + self.workdir + '/include ' \
@@ -407,6 +510,88 @@ class Package(object):
                                + self.env['CFLAGS']
         self.env['LDFLAGS'] = '-L' + self.workdir + '/lib ' \
                                + self.env['LDFLAGS']
+
+    def _state_dir(self, output_dir=None):
+        if output_dir is None:
+            output_dir = P.join(self.env['BUILD_DIR'], self.pkgname)
+        return P.join(output_dir, '.bb-state')
+
+    def _inputs(self):
+        '''What a configured tree depends on, besides the patches: the
+           tarball, the package class and the classes it derives from
+           (their configure logic and arguments), and the compilers and
+           flags configure wrote into the tree'''
+        h = sha1()
+        for cls in self.__class__.__mro__:
+            if cls is object:
+                continue
+            try:
+                h.update(inspect.getsource(cls))
+            except (IOError, TypeError):
+                h.update(cls.__name__)
+        for k in ('CC', 'CXX', 'F77', 'CFLAGS', 'CXXFLAGS', 'CPPFLAGS', 'LDFLAGS',
+                  'PKG_CONFIG_PATH', 'INSTALL_DIR', 'BB_TOOLCHAIN'):
+            h.update('\0%s=%s' % (k, self.env.get(k, '')))
+        src = self.src if isinstance(self.src, basestring) else ' '.join(self.src or ())
+        return dict(src = src, chksum = str(self.chksum), config = h.hexdigest())
+
+    def _save_state(self):
+        d = self._state_dir()
+        if not P.isdir(d):
+            os.makedirs(d)
+        with file(P.join(d, 'state.json'), 'w') as f:
+            json.dump(self.state, f, indent=1)
+
+    def _warm_unpack(self, output_dir):
+        '''Bring the tree of the last build up to date, if it can be.
+           Returns whether it was.'''
+        try:
+            with file(P.join(self._state_dir(output_dir), 'state.json'), 'r') as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return False
+        if not state.get('configured') or not P.isdir(state['workdir']):
+            return False
+        if state['inputs'] != self._inputs():
+            info('The tarball, configure arguments or flags of %s changed, building from scratch' % self.pkgname)
+            return False
+
+        old = state['patches']
+        new = [(P.basename(p), hash_file(p)) for p in self._patch_files()]
+        same = 0
+        while same < min(len(old), len(new)) and old[same][1] == new[same][1]:
+            same += 1
+        saved = P.join(self._state_dir(output_dir), 'patches')
+        stale = [P.join(saved, entry[2]) for entry in old[same:]]
+        fresh = self._patch_files()[same:]
+        if not all(map(P.isfile, stale)):
+            return False
+        for patch in stale + fresh:
+            touched = [f for f in patched_files(patch) if CONFIGURE_FILES.match(P.basename(f))]
+            if touched:
+                info('%s changes %s, building from scratch' % (P.basename(patch), touched[0]))
+                return False
+
+        self.workdir = state['workdir']
+        self.state = state
+        self.state['patches'] = old[:same]
+        try:
+            for patch in reversed(stale):
+                info('Reversing %s' % P.basename(patch))
+                self._patch(patch, reverse=True)
+                os.remove(patch)
+            for patch in fresh:
+                self._apply_one(patch)
+        except (HelperError, OSError), e:
+            info('Could not update the patches of %s (%s), building from scratch' % (self.pkgname, e))
+            self.workdir = None
+            self.state = None
+            return False
+        self._save_state()
+        self.warm = True
+        info('Rebuilding %s in place, %d patches reversed and %d applied' % (self.pkgname, len(stale), len(fresh)))
+        return True
+
     @stage
     def configure(self, other=(), with_=(), without=(), enable=(), disable=(), configure='./configure'):
         '''After configure, the source code should be ready to build.'''
@@ -461,15 +646,28 @@ class Package(object):
         pkg.unpack()
         pkg.configure()
         pkg.compile()
+        start = time.time() - 1 # Some filesystems keep mtimes in seconds
         pkg.install()
+        if pkg.env.get('TRIM_LA') and not pkg.keep_la_deps:
+            pkg.trim_la(start)
 
-    def _apply_patches(self):
+    @stage
+    def trim_la(self, since):
+        '''Empty dependency_libs in the libtool archives this package
+           installed (the ones changed after since). For a shared library
+           they are redundant: it records its own dependencies, so libtool
+           need not put every transitive library on each later link line.'''
+        for la in glob(P.join(self.env['INSTALL_DIR'], 'lib', '*.la')):
+            if os.lstat(la).st_mtime >= since and trim_la_file(la):
+                info('Trimmed dependency_libs of %s' % P.basename(la))
+
+    def _patch_files(self):
         # self.patches could be:
         #    list of strings, interpreted as a list of patches
         #    a basestring, interpreted as a patch or a dir of patches
         patches = []
         if self.patches is None:
-            return
+            return []
         elif isinstance(self.patches, basestring):
             # Grab all of the patch file paths out of the provided directory
             full = P.join(self.pkgdir, self.patches)
@@ -488,20 +686,42 @@ class Package(object):
         else: # Input is already a list of patch files
             patches = self.patches
 
-        def _apply(patch):
-            '''Helper function to apply a patch with a custom self.patch_level'''
-            if self.patch_level is None:
-                self.helper('patch', '-p1', '-i', patch)
-            else:
-                self.helper('patch', self.patch_level, '-i', patch)
-
         # We have a list of patches now, but we can't trust they're all there
+        ret = []
         for p in patches:
             if p.endswith('~') or p.endswith('#'): # Skip junk file paths
                 continue
             if not P.isfile(p):
                 raise PackageError(self, 'Unknown patch: %s' % p)
-            _apply(p) # The patch file is there, apply it!
+            ret.append(p)
+        return ret
+
+    def _patch(self, patch, reverse=False):
+        '''Apply a patch with a custom self.patch_level'''
+        cmd = ['patch', '-p1' if self.patch_level is None else self.patch_level]
+        if reverse:
+            cmd.append('-R')
+        self.helper(*(cmd + ['-i', patch]))
+
+    def _apply_one(self, patch):
+        '''Apply a patch, keeping a copy to reverse it with in a warm rebuild'''
+        self._patch(patch)
+        if self.state is None:
+            return
+        n = len(self.state['patches'])
+        digest = hash_file(patch)
+        copy_name = '%03d-%s-%s' % (n, digest[:8], P.basename(patch))
+        d = P.join(self._state_dir(), 'patches')
+        if not P.isdir(d):
+            os.makedirs(d)
+        shutil.copyfile(patch, P.join(d, copy_name))
+        self.state['patches'].append((P.basename(patch), digest, copy_name))
+
+    def _apply_patches(self):
+        for p in self._patch_files():
+            self._apply_one(p) # The patch file is there, apply it!
+        if self.state is not None:
+            self._save_state()
 
 
     def helper(self, *args, **kw):
@@ -553,14 +773,10 @@ class GITPackage(Package):
         The goal here is to not re-build a git package if
         we already built it with given commit id.'''
     chksum = None
-    fast = False
     def __init__(self, env):
         super(GITPackage, self).__init__(env)
         self.localcopy = P.join(env['DOWNLOAD_DIR'], 'git', self.pkgname)
 
-        if 'FAST' in env and int(env['FAST']) != 0:
-            self.fast = True
-
         if self.chksum is None:
             # If the user did not specify which commit to fetch,
             # we'll fetch the latest. Store its commit hash.
@@ -674,9 +890,12 @@ class CMakePackage(Package):
     def __init__(self, env):
         super(CMakePackage, self).__init__(env)
 
+    @property
+    def builddir(self):
+        return P.join(self.workdir, 'build')
+
     @stage
     def configure(self, other=(), enable=(), disable=(), with_=(), without=()):
-        self.builddir = P.join(self.workdir, 'build')
 
         def remove_danger(files, dirname, fnames):
             '''Function to find all CMakeLists.txt files in a set of files'''
@@ -2,14 +2,19 @@
 
 import os.path as P
 import logging
-import itertools, shutil, re, errno, sys, os, stat
+import itertools, shutil, re, errno, sys, os, stat, subprocess, tarfile, json, fnmatch
+import urllib2, time, mmap, struct
+from hashlib import sha1, sha256
 from os import makedirs, remove, listdir, chmod, symlink, readlink, link
 from collections import namedtuple
 from BinaryBuilder import get_platform, run, hash_file, binary_builder_prefix,\
      list_recursively
-from tempfile import mkdtemp, NamedTemporaryFile
+from tempfile import mkdtemp
+from StringIO import StringIO
 from glob import glob
 from functools import partial, wraps
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 ''' Code for creating the downloadable binary distribution
 '''
@@ -44,6 +49,85 @@ def strip_flag(flag, key, env):
     return hit, env
 
 
+# Compressors for the dist tarballs. 'programs' are tried in order, so a
+# parallel tool is preferred but its serial cousin still works. Decompression
+# uses the same program, so it is as parallel as the format allows.
+Codec = namedtuple('Codec', 'name ext programs compress decompress level')
+CODECS = dict(
+    pbzip2 = Codec('pbzip2', '.tar.bz2', ['pbzip2', 'bzip2'], ['-c', '-%d'],               ['-d', '-c'],              9),
+    pigz   = Codec('pigz',   '.tar.gz',  ['pigz', 'gzip'],    ['-c', '-n', '-%d'],         ['-d', '-c'],              6),
+    xz     = Codec('xz',     '.tar.xz',  ['xz'],              ['-c', '-T0', '-%d'],        ['-d', '-c', '-T0'],       6),
+    zstd   = Codec('zstd',   '.tar.zst', ['zstd'],            ['-c', '-q', '-T0', '-%d'],  ['-d', '-c', '-q', '-T0'], 12),
+)
+
+def codec_for(filename):
+    '''Find the codec for a tarball from its extension. Returns None
+       for an uncompressed tarball.'''
+    aliases = {'.tbz2': 'pbzip2', '.tbz': 'pbzip2', '.tgz': 'pigz', '.txz': 'xz', '.tzst': 'zstd'}
+    for ext, name in aliases.iteritems():
+        if filename.endswith(ext):
+            return CODECS[name]
+    for codec in CODECS.itervalues():
+        if filename.endswith(codec.ext) or filename.endswith(codec.ext[4:]):
+            return codec
+    if filename.endswith('.tar'):
+        return None
+    raise Exception('Unknown compression for %s' % filename)
+
+def codec_program(codec):
+    '''Return the path of the first available program for this codec'''
+    for prog in codec.programs:
+        path = which(prog)
+        if path is not None:
+            return path
+    raise Exception('Cannot compress with %s, none of %s is in the PATH'
+                    % (codec.name, ', '.join(codec.programs)))
+
+def compress_command(codec, level=None):
+    '''The command line that compresses stdin to stdout'''
+    if level is None: level = codec.level
+    prog = codec_program(codec)
+    flags = [f % level if '%d' in f else f for f in codec.compress]
+    if codec.name == 'zstd' and level > 19:
+        flags.insert(0, '--ultra')
+    if not P.basename(prog).startswith(codec.programs[0]):
+        # The serial fallback tools don't know about threads
+        flags = [f for f in flags if not f.startswith('-T')]
+    return [prog] + flags
+
+def decompress_command(codec):
+    '''The command line that decompresses stdin to stdout'''
+    prog = codec_program(codec)
+    flags = list(codec.decompress)
+    if not P.basename(prog).startswith(codec.programs[0]):
+        flags = [f for f in flags if not f.startswith('-T')]
+    return [prog] + flags
+
+def extract_tarball(tarball, dest, strip_components=1):
+    '''Unpack a (compressed) tarball into dest, piping it through the
+       parallel decompressor matching its extension.'''
+    logger.info('Extracting %s' % tarball)
+    tar = ['tar', 'xf', '-', '-C', dest]
+    if strip_components:
+        tar += ['--strip-components', str(strip_components)]
+    codec = codec_for(tarball)
+    with file(tarball, 'rb') as f:
+        if codec is None:
+            p = subprocess.Popen(tar, stdin=f)
+            if p.wait() != 0:
+                raise Exception('%s: command returned %d' % (tar, p.returncode))
+            return
+        cmd = decompress_command(codec)
+        d = subprocess.Popen(cmd, stdin=f, stdout=subprocess.PIPE)
+        t = subprocess.Popen(tar, stdin=d.stdout)
+        d.stdout.close() # So the decompressor gets SIGPIPE if tar dies
+        t.wait()
+        d.wait()
+    if d.returncode != 0:
+        raise Exception('%s: command returned %d' % (cmd, d.returncode))
+    if t.returncode != 0:
+        raise Exception('%s: command returned %d' % (tar, t.returncode))
+
 def is_binary(filename):
     '''Use the linux "file" tool to deterimen if a given file is a binary file'''
     ret = run('file', filename, output=True)
@@ -59,12 +143,13 @@ def doctest_on(os):
         return inner
     return outer
 
-def default_baker(filename, distdir, searchpath):
-    '''Updates a files rpath to be relative to distdir and strips it of symbols'''
-    if not is_binary(filename):
-        return
+def default_baker(filename, distdir, searchpath, debug_info='full', debug_store=None):
+    '''Updates a files rpath to be relative to distdir and strips it of symbols.
+       DistManager.bake only hands binaries to the baker. debug_info is how
+       the binaries were built and debug_store where their debug info goes,
+       see save_elf_debug.'''
     set_rpath(filename, distdir, searchpath)
-    strip(filename)
+    strip(filename, debug_info, debug_store)
 
 def which(program):
     '''Find if a program is in the PATH'''
@@ -85,16 +170,27 @@ def which(program):
     return None
 
 class DistManager(object):
-    '''Main class for creating a StereoPipeline binary distribution'''
-    def __init__(self, tarname, exec_wrapper_file):
-        self.wrapper_file = exec_wrapper_file
+    '''Main class for creating a StereoPipeline binary distribution.
+
+       Nothing is copied when files are added. Instead a manifest maps each
+       path in the dist to the file that provides its contents. Only the
+       files that bake() rewrites are materialized in the staging dir, the
+       rest is streamed straight from the install dir into the tarball.'''
+    def __init__(self, tarname, exec_wrapper_file, codec='pbzip2', level=None, cache=None, mtime=0):
+        self.wrapper_file = P.abspath(exec_wrapper_file)
         self.tarname = tarname
+        self.codec   = CODECS[codec]
+        self.level   = level
+        self.cache   = cache    # A BakeCache, or None to always bake from scratch
+        self.mtime   = mtime    # The timestamp given to every file in the tarball
         self.tempdir = mkdtemp(prefix='dist')
         self.distdir = Prefix(P.join(self.tempdir, self.tarname))
-        self.distlist  = set()  # List of files to be distributed
+        self.manifest  = dict() # dist path -> file providing its contents
         self.deplist   = dict() # List of file dependencies
         self.parentlib = dict() # library k is used by parentlib[k]
-        
+        self.needed    = dict() # SONAMEs required by each binary in the dist
+        self.libpaths  = dict() # Where the loader found each SONAME
+
         mkdir_f(self.distdir)
 
     def remove_tempdir(self):
@@ -151,10 +247,10 @@ class DistManager(object):
         else:
             self._add_file(inpath, self.distdir.base(relpath))
 
-    def add_directory(self, src, dst=None, hardlink=False):
+    def add_directory(self, src, dst=None):
         ''' Recursively add a directory. Will do it dumbly! No magic here. '''
         if dst is None: dst = self.distdir
-        mergetree(src, dst, partial(self._add_file, hardlink=hardlink, add_deps=False))
+        mergetree(P.abspath(src), dst, partial(self._add_file, add_deps=False))
 
     def remove_deps(self, seq):
         ''' Filter deps out of the deplist '''
@@ -184,72 +280,228 @@ class DistManager(object):
 
     def create_file(self, relpath, mode='w'):
         '''Create a new file in self.distdir and open it'''
-        return file(self.distdir.base(relpath), mode)
+        dst = self.distdir.base(relpath)
+        mkdir_f(P.dirname(dst))
+        self.manifest[dst] = dst
+        return file(dst, mode)
+
+    def materialize(self, dst):
+        '''Give dst a private copy in the staging dir so it can be rewritten
+           without touching the file it was added from.'''
+        src = self.manifest[dst]
+        if src != dst:
+            mkdir_f(P.dirname(dst))
+            copy(src, dst, keep_symlink=False)
+            self.manifest[dst] = dst
+        return dst
 
     def bake(self, searchpath, baker = default_baker):
-        '''Updates the rpath of all files to be relative to distdir and strips it of symbols.
-           Also cleans up some junk in self.distdir and sets file permissions.'''
+        '''Updates the rpath of all binaries to be relative to distdir and strips
+           them of symbols. Only the binaries get materialized in the staging dir.
+           With a cache, binaries baked by an earlier run are reused.'''
         logger.debug('Baking list------------------------------------------')
-        for filename in self.distlist:
+        for filename in sorted(self.manifest):
             logger.debug('  %s' % filename)
-        for filename in self.distlist:
-            baker(filename, self.distdir, searchpath)
-
-        # Delete all hidden files from the self.distdir folder
-        [remove(i) for i in run('find', self.distdir, '-name', '.*', '-print0').split('\0') if len(i) > 0 and i != '.' and i != '..']
-        # Enable read/execute on all files in libexec and bin
-        [chmod(file, 0755) for file in glob(self.distdir.libexec('*')) + glob(self.distdir.bin('*'))]
-
-    def make_tarball(self, include = (), exclude = (), name = None):
-        '''Tar up all the files we have written to self.distdir.
-           exclude takes priority over include '''
-
-        if name is None: name = '%s.tar.bz2' % self.tarname
-        if isinstance(include, basestring):
-            include = [include]
-        if isinstance(exclude, basestring):
-            exclude = [exclude]
-
-        cmd = ['tar', 'cf', name, '--use-compress-prog=pbzip2']
-        cmd += ['-C', P.dirname(self.distdir)]
-        if include:
-            cmd += ['--no-recursion']
-        for i in include:
-            cmd += ['-T', i]
-        for e in exclude:
-            cmd += ['-X', e]
-        cmd.append(self.tarname)
+        for filename in sorted(self.manifest):
+            src = self.manifest[filename]
+            if P.islink(src) or not self._is_binary(src):
+                continue
+            if self.cache is None:
+                baker(self.materialize(filename), self.distdir, searchpath)
+                continue
+            key = self.cache.bake_key(src, P.relpath(filename, self.distdir), searchpath, baker)
+            if self.cache.fetch(key, filename):
+                logger.debug('%8s %s' % ('cached', filename))
+                self.manifest[filename] = filename
+                continue
+            before = set(glob(filename + '.*'))
+            baker(self.materialize(filename), self.distdir, searchpath)
+            self.cache.store(key, filename, sorted(set(glob(filename + '.*')) - before))
+
+        # The baker may leave new files behind (like split debug info)
+        for filename in list_recursively(self.distdir):
+            if filename not in self.manifest:
+                self.manifest[filename] = filename
+
+    def make_tarball(self, include = None, exclude = None, name = None, frame_size = None, first = ()):
+        '''Stream the files in the manifest into a compressed tarball.
+           include and exclude are predicates on the dist path of each
+           file. exclude takes priority over include. Hidden files are
+           never shipped, and everything in bin/ and libexec/ is made
+           executable.
+
+           The tarball only depends on the contents of the files: members
+           are sorted, and their owner, mode and mtime are normalized. A
+           <name>.sha256 manifest of the contents (in sha256sum format) is
+           written next to it, which stays the same even if a different
+           compressor is picked up on another machine.
+
+           The dist paths in first are always included (even if hidden),
+           and come right after the directories, before any other file.
+
+           If frame_size (in bytes) is given the tarball is seekable: it is
+           written as independently compressed frames of about that size,
+           cut at member boundaries, and an index of the members is saved
+           next to it as <name>.index. See SeekableTarball.'''
+
+        if name is None: name = self.tarball_name()
+
+        top = P.dirname(self.distdir)
+        files = list(first)
+        for dst in sorted(self.manifest):
+            if dst in first:
+                continue
+            if P.basename(dst).startswith('.'):
+                continue
+            if include is not None and not include(dst):
+                continue
+            if exclude is not None and exclude(dst):
+                continue
+            files.append(dst)
+
+        dirs = set()
+        for dst in files:
+            d = P.dirname(dst)
+            while d != top and d not in dirs:
+                dirs.add(d)
+                d = P.dirname(d)
 
+        cmd = compress_command(self.codec, self.level)
         logger.info('Creating tarball %s' % name)
-        run(*cmd)
-
-    def find_filter(self, *filter, **kw):
-        '''Call "find" with a filter argument and write results to an opened temporary file'''
-        dir = kw.get('dir', self.tarname)
-        cwd = kw.get('cwd', P.dirname(self.distdir))
-        cmd = ['find', dir] + list(filter)
-        out = run(*cmd, cwd=cwd)
-        files = NamedTemporaryFile()
-        files.write(out)
-        files.flush()
-        return files
-
-    def _add_file(self, src, dst, hardlink=False, keep_symlink=True, add_deps=True):
+        with file(name, 'wb') as out:
+            if frame_size is None:
+                p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=out)
+                sink = p.stdin
+                tar = tarfile.open(fileobj=sink, mode='w|', format=tarfile.GNU_FORMAT)
+            else:
+                sink = FramedWriter(out, cmd, frame_size)
+                tar = tarfile.open(fileobj=sink, mode='w', format=tarfile.GNU_FORMAT)
+            members = dict()
+            digests = dict()
+            try:
+                for d in sorted(dirs):
+                    info = tarfile.TarInfo(P.relpath(d, top))
+                    info.type  = tarfile.DIRTYPE
+                    info.mode  = 0755
+                    info.mtime = self.mtime
+                    tar.addfile(info)
+                for dst in files:
+                    if frame_size is None:
+                        self._add_to_tar(tar, dst, P.relpath(dst, top), digests)
+                        continue
+                    frame, offset = sink.position()
+                    info = self._add_to_tar(tar, dst, P.relpath(dst, top), digests)
+                    members[info.name] = [frame, offset, info.size, info.type, info.linkname]
+                    sink.boundary()
+            finally:
+                tar.close()
+                sink.close()
+            if frame_size is None and p.wait() != 0:
+                raise Exception('%s: command returned %d while writing %s' % (cmd, p.returncode, name))
+
+        if frame_size is not None:
+            needed = dict((P.relpath(k, self.distdir), v) for k, v in self.needed.iteritems())
+            with file(name + '.index', 'w') as f:
+                json.dump(dict(version = 1, codec = self.codec.name, frames = sink.frames,
+                               members = members, needed = needed), f, sort_keys=True)
+
+        with file(name + '.sha256', 'w') as f:
+            for arcname in sorted(digests):
+                f.write('%s  %s\n' % (digests[arcname], arcname))
+
+    def tarball_name(self, suffix=''):
+        '''The file name of a tarball of this dist, with the codec's extension'''
+        return '%s%s%s' % (self.tarname, suffix, self.codec.ext)
+
+    def _add_to_tar(self, tar, dst, arcname, digests):
+        '''Write one manifest entry into an open tarfile, with normalized
+           metadata. The sha256 of regular files goes into digests.'''
+        src  = self.manifest[dst]
+        info = tar.gettarinfo(src, arcname)
+        info.uid   = info.gid   = 0
+        info.uname = info.gname = ''
+        info.mtime = self.mtime
+        if info.issym():
+            info.mode = 0777
+        elif info.mode & 0111 or P.dirname(dst) in (self.distdir.bin(), self.distdir.libexec()):
+            info.mode = 0755
+        else:
+            info.mode = 0644
+        if info.isreg():
+            with file(src, 'rb') as f:
+                f = HashingReader(f)
+                tar.addfile(info, f)
+                digests[arcname] = f.hexdigest()
+        else:
+            if info.islnk():
+                digests[arcname] = digests[info.linkname]
+            tar.addfile(info)
+        return info
+
+    def unused_libs(self):
+        '''Find overlinking: for each binary in the dist, the libraries it
+           needs (NEEDED) that define none of the symbols it uses.'''
+        in_dist = dict((P.basename(dst), src) for dst, src in self.manifest.iteritems())
+        defined = dict()
+        ret = dict()
+        for dst, sonames in sorted(self.needed.iteritems()):
+            wanted = dynamic_symbols(self.manifest[dst])[1]
+            unused = []
+            for soname in sonames:
+                path = in_dist.get(soname, self.libpaths.get(soname))
+                if path is None or not P.exists(path):
+                    continue
+                if path not in defined:
+                    defined[path] = dynamic_symbols(path)[0]
+                if not wanted & defined[path]:
+                    unused.append(soname)
+            if unused:
+                ret[dst] = unused
+        return ret
+
+    def _is_binary(self, filename):
+        if self.cache is None:
+            return is_binary(filename)
+        return self.cache.is_binary(filename)
+
+    def _add_file(self, src, dst, keep_symlink=True, add_deps=True):
         '''Add a file to the list of distribution files'''
+        src = P.abspath(src)
         dst = P.abspath(dst)
 
         assert not P.relpath(dst, self.distdir).startswith('..'), \
                'destination %s must be within distdir[%s]' % (dst, self.distdir)
+        assert not P.isdir(src), 'Source path must not be a dir'
+
+        if keep_symlink and P.islink(src):
+            assert not P.isabs(readlink(src)), 'Cannot copy symlink that points to an absolute path (%s)' % src
+        elif not keep_symlink:
+            src = P.realpath(src)
+
+        if dst in self.manifest:
+            old = self.manifest[dst]
+            if P.islink(old) or P.islink(src):
+                assert P.islink(old) and P.islink(src) and readlink(old) == readlink(src), \
+                       'Refusing to retarget already-exported symlink %s' % dst
+            elif old != src:
+                assert hash_file(old) == hash_file(src), 'Refusing to overwrite already exported dst %s' % dst
+            return
 
-        mkdir_f(P.dirname(dst))
-        copy(src, dst, keep_symlink=keep_symlink, hardlink=hardlink)
-        self.distlist.add(dst)
+        logger.debug('%8s %s -> %s' % ('add', src, dst))
+        self.manifest[dst] = src
 
         #print("dst and deps, ", dst, required_libs(dst))
-        if add_deps and is_binary(dst):
-            req = required_libs(dst)
+        if add_deps and not P.islink(src) and self._is_binary(src):
+            if self.cache is None:
+                req = required_libs(src)
+            else:
+                req = self.cache.required_libs(src)
             self.deplist.update(req)
-            
+            self.needed[dst] = sorted(req.keys())
+            for lib, path in req.iteritems():
+                if path is not None:
+                    self.libpaths.setdefault(lib, path)
+
             # Keep track for later which library needs the current library
             for lib in req.keys():
                 if not lib in self.parentlib.keys():
@@ -257,6 +509,296 @@ class DistManager(object):
                 else:
                     self.parentlib[lib].append(dst)
 
+class HashingReader(object):
+    '''Wraps a file opened for reading, and hashes whatever is read from it'''
+    def __init__(self, f, algorithm=sha256):
+        self.f = f
+        self.h = algorithm()
+
+    def read(self, *args):
+        data = self.f.read(*args)
+        self.h.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.h.hexdigest()
+
+class BakeCache(object):
+    '''A persistent cache for DistManager, so a nightly only re-bakes what
+       changed. Everything is keyed by the sha1 of the source file: whether
+       it is a binary, the libraries it needs, and the baked file (plus any
+       files the baker wrote next to it, like the .debug). The baked output
+       also depends on where it lands in the dist, the rpath search path and
+       the baker. To avoid re-hashing unchanged files, hashes are remembered
+       by path, size and mtime.'''
+    VERSION = 2 # 1 hardlinked entries into the dist, which could edit them
+
+    def __init__(self, root, params=()):
+        self.root   = P.abspath(root)
+        self.params = [str(p) for p in params] # Anything else the bake depends on
+        mkdir_f(self.root)
+        self.hash_file = P.join(self.root, 'hashes.json')
+        self.hashes = dict()
+        try:
+            with file(self.hash_file, 'r') as f:
+                self.hashes = json.load(f)
+        except (IOError, ValueError):
+            pass
+
+    def save(self):
+        '''Write the hash index. Call this once the dist is done.'''
+        tmp = '%s.%d' % (self.hash_file, os.getpid())
+        with file(tmp, 'w') as f:
+            json.dump(self.hashes, f)
+        os.rename(tmp, self.hash_file)
+
+    def digest(self, filename):
+        filename = P.realpath(filename)
+        st = os.stat(filename)
+        old = self.hashes.get(filename)
+        if old is not None and old[0] == st.st_size and old[1] == st.st_mtime:
+            return old[2]
+        digest = hash_file(filename)
+        self.hashes[filename] = [st.st_size, st.st_mtime, digest]
+        return digest
+
+    def _entry(self, kind, key):
+        return P.join(self.root, kind, key[:2], key)
+
+    def _load(self, kind, key):
+        try:
+            with file(self._entry(kind, key), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _save(self, kind, key, value):
+        path = self._entry(kind, key)
+        mkdir_f(P.dirname(path))
+        with file(path, 'w') as f:
+            json.dump(value, f)
+
+    def is_binary(self, filename):
+        key = self.digest(filename)
+        ret = self._load('type', key)
+        if ret is None:
+            ret = is_binary(filename)
+            self._save('type', key, ret)
+        return ret
+
+    def required_libs(self, filename):
+        # The proposed paths come from the loader, so they depend on where
+        # the file sits as well as on what is in it.
+        key = sha1('\0'.join([self.digest(filename), P.dirname(P.realpath(filename)),
+                              os.environ.get('LD_LIBRARY_PATH', '')])).hexdigest()
+        ret = self._load('deps', key)
+        if ret is None:
+            ret = required_libs(filename)
+            self._save('deps', key, ret)
+        return dict((str(k), v and str(v)) for k, v in ret.iteritems())
+
+    def bake_key(self, src, relpath, searchpath, baker):
+        parts = [str(self.VERSION), self.digest(src), relpath, ':'.join(searchpath),
+                 baker.__module__, baker.__name__, get_platform().os] + self.params
+        return sha1('\0'.join(parts)).hexdigest()
+
+    def fetch(self, key, dst):
+        '''Copy a previously baked file (and whatever came with it) to dst.
+           Returns False on a cache miss. The files are copied, or cloned
+           where the filesystem can, not hardlinked: later steps edit the
+           dist in place (rpaths, relocation), which must not reach the
+           cache.'''
+        entry = self._entry('baked', key)
+        meta  = self._load('baked', key + '.json')
+        if meta is None or not P.exists(P.join(entry, 'file')):
+            return False
+        mkdir_f(P.dirname(dst))
+        copy(P.join(entry, 'file'), dst)
+        for suffix in meta['extras']:
+            copy(P.join(entry, 'extra' + suffix), dst + suffix)
+        os.utime(entry, None) # Mark as recently used, for prune()
+        return True
+
+    def store(self, key, dst, extras):
+        '''Save a freshly baked file, and the files the baker created next to it'''
+        entry = self._entry('baked', key)
+        tmp   = '%s.%d' % (entry, os.getpid())
+        shutil.rmtree(tmp, True)
+        mkdir_f(tmp)
+        copy(dst, P.join(tmp, 'file'))
+        suffixes = [e[len(dst):] for e in extras]
+        for suffix in suffixes:
+            copy(dst + suffix, P.join(tmp, 'extra' + suffix))
+        shutil.rmtree(entry, True)
+        os.rename(tmp, entry)
+        self._save('baked', key + '.json', dict(extras = suffixes))
+
+    def prune(self, days):
+        '''Drop baked files that have not been used for this many days'''
+        cutoff = time.time() - days * 24 * 3600
+        for entry in glob(P.join(self.root, 'baked', '*', '*')):
+            if P.isdir(entry) and os.stat(entry).st_mtime < cutoff:
+                logger.debug('Pruning %s' % entry)
+                shutil.rmtree(entry, True)
+                rm_f(entry + '.json')
+        for filename in self.hashes.keys():
+            if not P.exists(filename):
+                del self.hashes[filename]
+
+class FramedWriter(object):
+    '''A write-only file object for tarfile which compresses the stream in
+       independent frames. The caller marks member boundaries, and a frame
+       is only cut at a boundary. Concatenated frames are still a valid
+       compressed stream for all of our codecs, so the output also unpacks
+       with plain tar.'''
+    def __init__(self, out, cmd, frame_size):
+        self.out        = out
+        self.cmd        = cmd
+        self.frame_size = frame_size
+        self.frames     = [] # [compressed offset, compressed length] per frame
+        self.buf        = []
+        self.buflen     = 0
+        self.offset     = 0  # uncompressed bytes written
+
+    def write(self, data):
+        self.buf.append(data)
+        self.buflen += len(data)
+        self.offset += len(data)
+
+    def tell(self):
+        return self.offset
+
+    def position(self):
+        '''The frame the next byte goes into, and its offset in that frame'''
+        return len(self.frames), self.buflen
+
+    def boundary(self):
+        '''A member just ended. Cut a frame if this one is big enough.'''
+        if self.buflen >= self.frame_size:
+            self._cut()
+
+    def close(self):
+        self._cut()
+
+    def _cut(self):
+        if not self.buflen:
+            return
+        p = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        data, _ = p.communicate(''.join(self.buf))
+        if p.returncode != 0:
+            raise Exception('%s: command returned %d' % (self.cmd, p.returncode))
+        self.frames.append([self.out.tell(), len(data)])
+        self.out.write(data)
+        self.buf    = []
+        self.buflen = 0
+
+class SeekableTarball(object):
+    '''Random access to a tarball written by make_tarball with a frame_size.
+       The tarball can be a local path or an http(s) URL; only the frames
+       holding the requested members are read and decompressed.'''
+    def __init__(self, location):
+        self.location = location
+        self.index = json.loads(self._read(location + '.index'))
+        if self.index.get('version') != 1:
+            raise Exception('Unsupported index version in %s.index' % location)
+        self.codec   = CODECS[self.index['codec']]
+        self.members = self.index['members']
+        self.needed  = self.index.get('needed', {})
+
+    def _is_url(self, location):
+        return location.startswith('http://') or location.startswith('https://')
+
+    def _read(self, location, offset=None, length=None):
+        if self._is_url(location):
+            req = urllib2.Request(location)
+            if offset is not None:
+                req.add_header('Range', 'bytes=%d-%d' % (offset, offset + length - 1))
+            resp = urllib2.urlopen(req)
+            data = resp.read()
+            if offset is None:
+                return data
+            if resp.getcode() != 206:
+                # The server ignored the range and sent the whole file
+                data = data[offset:offset + length]
+            if len(data) != length:
+                raise Exception('Asked %s for %d bytes at %d, got %d' % (location, length, offset, len(data)))
+            return data
+        with file(location, 'rb') as f:
+            if offset is None:
+                return f.read()
+            f.seek(offset)
+            return f.read(length)
+
+    def names(self):
+        return sorted(self.members.keys())
+
+    def select(self, patterns, with_deps=False):
+        '''Member names matching any of the glob patterns. Patterns are
+           matched against the full name and the name without its top
+           directory (so "bin/point2dem" works). with_deps adds what is
+           needed to run the selected programs: the libexec binary and
+           scripts behind a bin/ wrapper, the libraries they need (by
+           SONAME, recursively), and the targets of links.'''
+        def rel(name):
+            return name.split('/', 1)[-1]
+        top = dict()
+        for name in self.members:
+            top[rel(name)] = name
+
+        chosen = set()
+        for name in self.members:
+            if any(fnmatch.fnmatch(name, p) or fnmatch.fnmatch(rel(name), p) for p in patterns):
+                chosen.add(name)
+        if not with_deps:
+            return sorted(chosen)
+
+        todo = list(chosen)
+        while todo:
+            name = todo.pop()
+            extra = []
+            r = rel(name)
+            if r.startswith('bin/'):
+                extra += ['libexec/' + r[4:], 'libexec/constants.sh', 'libexec/libexec-funcs.sh']
+            extra += ['lib/' + lib for lib in self.needed.get(r, [])]
+            frame, offset, size, typ, linkname = self.members[name]
+            if linkname:
+                if typ == tarfile.SYMTYPE:
+                    extra.append(P.normpath(P.join(P.dirname(r), linkname)))
+                else:
+                    extra.append(rel(linkname))
+            for e in extra:
+                if e in top and top[e] not in chosen:
+                    chosen.add(top[e])
+                    todo.append(top[e])
+        return sorted(chosen)
+
+    def extract(self, names, dest, strip_components=0):
+        '''Extract the given members into dest, reading each frame only once'''
+        by_frame = dict()
+        for name in names:
+            by_frame.setdefault(self.members[name][0], []).append(name)
+        for frame in sorted(by_frame):
+            offset, length = self.index['frames'][frame]
+            p = subprocess.Popen(decompress_command(self.codec),
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            data, _ = p.communicate(self._read(self.location, offset, length))
+            if p.returncode != 0:
+                raise Exception('Failed to decompress frame %d of %s' % (frame, self.location))
+            frame_file = StringIO(data)
+            for name in sorted(by_frame[frame], key=lambda n: self.members[n][1]):
+                # tarfile starts reading where the file is
+                frame_file.seek(self.members[name][1])
+                tar = tarfile.open(fileobj=frame_file, mode='r:')
+                info = tar.next()
+                parts = info.name.split('/')[strip_components:]
+                if not parts:
+                    continue
+                info.name = '/'.join(parts)
+                if info.islnk():
+                    info.linkname = '/'.join(info.linkname.split('/')[strip_components:])
+                logger.debug('extract %s' % info.name)
+                tar.extract(info, dest)
+
 def copy(src, dst, hardlink=False, keep_symlink=True):
     '''Copy a file to another location with a bunch of link handling'''
     assert not P.isdir(src), 'Source path must not be a dir'
@@ -283,13 +825,33 @@ def copy(src, dst, hardlink=False, keep_symlink=True):
                 if o.errno != errno.EXDEV: # Invalid cross-device link, not an error, fall back to copy
                     raise
 
-        logger.debug('%8s %s -> %s' % ('copy', src, dst))
-        shutil.copy2(src, dst)
+        if reflink(src, dst):
+            logger.debug('%8s %s -> %s' % ('reflink', src, dst))
+        else:
+            logger.debug('%8s %s -> %s' % ('copy', src, dst))
+            shutil.copy2(src, dst)
 
         # Bugfix, make it writeable
         mode = os.stat(dst)[stat.ST_MODE]
         os.chmod(dst, mode | stat.S_IWUSR)
 
+def reflink(src, dst):
+    '''Try to make dst a copy-on-write clone of src. Returns False if the
+       filesystem (or the cp on this system) does not support it.'''
+    def linux():
+        return ['cp', '--reflink=always', '--preserve=mode,timestamps', src, dst]
+    def osx():
+        return ['cp', '-c', '-p', src, dst]
+    try:
+        with open(os.devnull, 'w') as devnull:
+            ret = subprocess.call(locals()[get_platform().os](), stdout=devnull, stderr=devnull)
+    except OSError:
+        return False
+    if ret != 0:
+        rm_f(dst)
+        return False
+    return True
+
 @doctest_on('linux')
 def readelf(filename):
     ''' Run readelf on a file
@@ -310,9 +872,29 @@ def readelf(filename):
         if m:
             if   m.group(1) == 'NEEDED': needed.append(m.group(2))
             elif m.group(1) == 'SONAME': soname = m.group(2)
-            elif m.group(1) == 'RPATH' : rpath  = m.group(2).split(':')
+            elif m.group(1) in ('RPATH', 'RUNPATH'): rpath = m.group(2).split(':')
     return Ret(needed, soname, rpath)
 
+def dynamic_symbols(filename):
+    '''The sets of dynamic symbols a binary defines and uses from other
+       libraries, without symbol versions'''
+    def linux():
+        return ['nm', '-D', filename]
+    def osx():
+        return ['nm', '-g', filename]
+    defined = set()
+    wanted  = set()
+    for line in run(*locals()[get_platform().os]()).split('\n'):
+        tokens = line.split()
+        if len(tokens) < 2:
+            continue
+        kind, name = tokens[-2], tokens[-1].split('@')[0]
+        if kind in ('U', 'w'):
+            wanted.add(name)
+        else:
+            defined.add(name)
+    return defined, wanted
+
 @doctest_on('linux')
 def ldd(filename):
     ''' Run ldd on a file
@@ -465,7 +1047,7 @@ def mergetree(src, dst, copyfunc):
     if errors:
         raise shutil.Error, errors
 
-def strip(filename):
+def strip(filename, debug_info='full', debug_store=None):
     '''Discard all symbols from this object file with OS specific flags'''
     flags = None
 
@@ -474,7 +1056,7 @@ def strip(filename):
         if typ.find('current ar archive') != -1:
             return ['-g']
         elif typ.find('SB executable') != -1 or typ.find('SB shared object') != -1:
-            save_elf_debug(filename)
+            save_elf_debug(filename, debug_info, debug_store)
             return ['--strip-unneeded', '-R', '.comment']
         elif typ.find('SB relocatable') != -1:
             return ['--strip-unneeded']
@@ -488,24 +1070,99 @@ def strip(filename):
     run('strip', *flags)
 
 
-def save_elf_debug(filename):
-    '''Copy the debug information from an ELF file'''
-    debug = '%s.debug' % filename
+def save_elf_debug(filename, debug_info='full', debug_store=None):
+    '''Copy the debug information from an ELF file. debug_info is how it
+       was built (build.py --debug-info): with split, most of the DWARF is
+       in the .dwo files of the build tree and gets packed into a .dwp next
+       to the .debug; with compressed, the .debug keeps its sections zlib
+       compressed.
+
+       With a debug_store directory, the debug info goes there instead, as
+       .build-id/xx/yyyy.debug (the layout gdb and debuginfod look up),
+       always compressed. A build-id already in the store is not written
+       again, so nightlies only add the binaries that changed.'''
+    args = ['--only-keep-debug']
+    bid = None
+    if debug_store is not None:
+        bid = build_id(filename)
+        if bid is None:
+            logger.warning('No build-id in %s, keeping its debug info next to it' % filename)
+    if bid is not None:
+        base = P.join(debug_store, '.build-id', bid[:2], bid[2:])
+        if P.exists(base + '.debug'):
+            logger.debug('%s is already in the debug store' % filename)
+            return
+        mkdir_f(P.dirname(base))
+        # Write under temporary names, so concurrent runs never see half a file
+        debug = '%s.debug.%d' % (base, os.getpid())
+        dwp   = '%s.dwp.%d' % (base, os.getpid())
+        args.append('--compress-debug-sections=zlib')
+    else:
+        debug = '%s.debug' % filename
+        dwp   = '%s.dwp' % filename
+        if debug_info == 'compressed':
+            args.append('--compress-debug-sections=zlib')
     try:
-        run('objcopy', '--only-keep-debug', filename, debug)
-        run('objcopy', '--add-gnu-debuglink=%s' % debug, filename)
+        run('objcopy', *(args + [filename, debug]))
+        if bid is None:
+            run('objcopy', '--add-gnu-debuglink=%s' % debug, filename)
     except Exception:
         logger.warning('Failed to split debug info for %s' % filename)
-        if P.exists(debug):
-            remove(debug)
+        rm_f(debug)
+        return
+    if debug_info == 'split':
+        try:
+            # dwp -e looks for the .dwo files relative to the cwd, not to
+            # the directory each unit was compiled in, so name them all
+            dwos = dwo_files(filename)
+            if dwos:
+                run('dwp', '-o', dwp, *dwos)
+        except Exception:
+            logger.warning('Failed to package the .dwo files of %s' % filename)
+            rm_f(dwp)
+    if bid is not None:
+        if P.exists(dwp):
+            os.rename(dwp, base + '.dwp')
+        os.rename(debug, base + '.debug')
+
+def build_id(filename):
+    '''The GNU build-id of an ELF file, as a hex string, or None'''
+    out = run('readelf', '-n', filename, raise_on_failure = False)
+    if not isinstance(out, basestring):
+        return None
+    m = re.search(r'Build ID:\s*([0-9a-f]+)', out)
+    return m.group(1) if m else None
+
+def dwo_files(filename):
+    '''The .dwo files with the split DWARF of the units in an ELF file'''
+    out = run('readelf', '--debug-dump=info', filename)
+    attr = lambda name, unit: re.search(r'DW_AT_%s\s*:(?:\s*\(.*?\):)?\s*(.+?)\s*$' % name, unit, re.M)
+    ret = []
+    for unit in out.split('Compilation Unit @')[1:]:
+        name = attr('(?:GNU_)?dwo_name', unit)
+        if name is None:
+            continue
+        comp_dir = attr('comp_dir', unit)
+        path = P.join(comp_dir.group(1) if comp_dir else '', name.group(1))
+        if path in ret:
+            continue
+        if not P.exists(path):
+            logger.warning('Missing %s (needed by %s)' % (path, filename))
+            continue
+        ret.append(path)
+    return ret
+
+def origin_rpath(filename, toplevel, searchpath):
+    '''The $ORIGIN-relative ELF rpath set_rpath gives a file'''
+    rel_to_top = P.relpath(toplevel, P.dirname(filename))
+    return [P.join('$ORIGIN', rel_to_top, path) for path in searchpath]
 
 def set_rpath(filename, toplevel, searchpath, relative_name=True):
     '''For each input file, set the rpath to contain all the input
        search paths to be relative to the top level.'''
     assert not any(map(P.isabs, searchpath)), 'set_rpath: searchpaths must be relative to distdir (was given %s)' % (searchpath,)
     def linux():
-        rel_to_top = P.relpath(toplevel, P.dirname(filename))
-        rpath = [P.join('$ORIGIN', rel_to_top, path) for path in searchpath]
+        rpath = origin_rpath(filename, toplevel, searchpath)
         if run('chrpath', '-r', ':'.join(rpath), filename, raise_on_failure = False) is None:
             logger.warn('Failed to set_rpath on %s' % filename)
     def osx():
@@ -584,40 +1241,110 @@ def snap_symlinks(src):
         return [src]
     return [src] + snap_symlinks(P.join(P.dirname(src), readlink(src)))
 
-def fix_install_paths(installdir, arch):
-    ''' After unpacking a set of pre-built binaries, in given directory,
-        fix any paths to point to the current directory. '''
-
-    print('Fixing paths in libtool control files, etc.')
-    control_files = glob(P.join(installdir,'include','*config.h')) + \
-                    glob(P.join(installdir,'lib','*.la'))          + \
-                    glob(P.join(installdir,'lib','*.prl'))         + \
-                    glob(P.join(installdir,'lib','*', '*.pc'))     + \
-                    glob(P.join(installdir,'bin','*'))             + \
-                    glob(P.join(installdir,'mkspecs','*.pri'))     + \
-                    list_recursively(P.join(installdir,'share'))
-
-    for control in control_files:
-
-        # Skip folders and binaries
-        if os.path.isdir(control): continue
-        if is_binary(control): continue
-
-        print('  %s' % P.basename(control))
-
+# The build root of a prebuilt tree, as it appears in its control files
+BB_INSTALL_PATH = re.compile(r'[\/\.]+[\w\/\.\-]*?' + binary_builder_prefix() + r'\w*[\w\/\.]*?/install')
+
+BINARY_MAGIC = ('\x7fELF',                                   # ELF
+                '\xfe\xed\xfa\xce', '\xce\xfa\xed\xfe',      # Mach-O
+                '\xfe\xed\xfa\xcf', '\xcf\xfa\xed\xfe',      # Mach-O 64 bit
+                '\xca\xfe\xba\xbe')                          # Mach-O universal
+
+def has_binary_magic(filename):
+    '''A cheap is_binary: look at the first bytes instead of running "file"'''
+    with file(filename, 'rb') as f:
+        return f.read(4) in BINARY_MAGIC
+
+def file_contains(filename, needle):
+    '''Search a file for a byte string without reading it all into memory'''
+    if P.getsize(filename) == 0:
+        return False
+    with file(filename, 'rb') as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return m.find(needle) != -1
+        finally:
+            m.close()
+
+def relocate_text(data, installdir, prefix=None):
+    '''Point the build root paths in the contents of a control file to
+       installdir. A known old prefix is replaced too, even if it does not
+       look like a build root. Returns the new contents and the number of
+       changes.'''
+    count = 0
+    if prefix is not None and prefix != installdir:
+        count = data.count(prefix)
+        data  = data.replace(prefix, installdir)
+    data, n = BB_INSTALL_PATH.subn(lambda m: installdir, data)
+    return data, count + n
+
+def relocate_control_file(filename, installdir, prefix=None):
+    '''Rewrite one control file in place. Returns the number of changes.'''
+    with file(filename, 'rb') as f:
+        data, count = relocate_text(f.read(), installdir, prefix)
+    if count:
         # ensure we can read and write (some files have odd permissions)
-        st = os.stat(control)
-        os.chmod(control, st.st_mode | stat.S_IREAD | stat.S_IWRITE)
-
-        # replace the temporary install directory with the one we're deploying to. (Modify file in-place)
-        lines = []
-        with open(control,'r') as f:
-            lines = f.readlines()
-        with open(control,'w') as f:
-            for line in lines:
-                line = re.sub('[\/\.]+[\w\/\.\-]*?' + binary_builder_prefix() + '\w*[\w\/\.]*?/install', installdir, line)
-                f.write( line )
+        st = os.stat(filename)
+        os.chmod(filename, st.st_mode | stat.S_IREAD | stat.S_IWRITE)
+        with file(filename, 'wb') as f:
+            f.write(data)
+    return count
+
+def relocate_rpath(filename, installdir, searchpath):
+    '''Point the rpath of one binary into installdir, unless it already
+       does. Returns what was done and the old and new rpath, for the report.'''
+    if get_platform().os == 'linux':
+        old = readelf(filename).rpath
+        new = origin_rpath(filename, installdir, searchpath)
+        if old == new:
+            return 'ok', old, new
+        set_rpath(filename, installdir, searchpath, False)
+        return 'rpath', old, new
+    set_rpath(filename, installdir, searchpath, False)
+    return 'rpath', [], []
+
+# Where a prebuilt tree keeps the text files that mention its build root,
+# and the binaries whose rpath must follow it (relative to the install dir).
+# Everything under share/ counts as a control file too.
+CONTROL_FILES = ['include/*config.h', 'lib/*.la', 'lib/*.prl', 'lib/*/*.pc', 'bin/*', 'mkspecs/*.pri']
+RPATH_SEARCHPATH = ['lib', 'lib/osgPlugins*']
+
+def rpath_files(arch):
+    patterns = ['bin/*']
+    for path in RPATH_SEARCHPATH:
+        patterns.append(path + '/*.so*')
+        if arch.os == 'osx':
+            patterns.append(path + '/*.dylib*')
+    return patterns
+
+def matches_any(relpath, patterns):
+    '''Like glob, but for a path that may not exist yet: * stays within
+       one path component.'''
+    parts = relpath.split('/')
+    for pattern in patterns:
+        pparts = pattern.split('/')
+        if len(pparts) == len(parts) and all(fnmatch.fnmatchcase(a, b) for a, b in zip(parts, pparts)):
+            return True
+    return False
+
+def is_control_file(relpath):
+    return relpath.startswith('share/') or matches_any(relpath, CONTROL_FILES)
+
+def in_parallel(func, items):
+    '''Run func on every item on a thread pool. Returns (item, result,
+       exception) triples, so one failure does not stop the rest.'''
+    def safe(item):
+        try:
+            return item, func(item), None
+        except Exception, e:
+            return item, None, e
+    pool = ThreadPool(cpu_count())
+    try:
+        return pool.map(safe, items)
+    finally:
+        pool.close()
+        pool.join()
 
+def make_blas_la(installdir, arch):
     # Create libblas.la (out of existing libsuperlu.la). We need
     # libblas.la to force blas to show up before superlu when linking
     # on Linux to avoid a bug with corruption when invoking lapack in
@@ -641,39 +1368,509 @@ def fix_install_paths(installdir, arch):
                               + '/lib  -lsuperlu -lm\'', line)
                 f.write( line )
 
-    library_ext = ["so"]
-    if arch.os == 'osx':
-        library_ext.append("dylib")
-
+def add_bin_to_path(installdir):
     # Ensure installdir/bin is in the path, to be able to find chrpath, etc.
     if "PATH" not in os.environ: os.environ["PATH"] = ""
     os.environ["PATH"] = P.join(installdir, 'bin') + \
                          os.pathsep + os.environ["PATH"]
 
-    SEARCHPATH = [P.join(installdir,'lib'),
-                  P.join(installdir,'lib','osgPlugins*')]
+class RelocationReport(object):
+    '''What fix_install_paths or deploy_tarball did to each file'''
+    def __init__(self, installdir):
+        self.installdir = installdir
+        self.entries = []
+        self.changed = dict(text=0, rpath=0)
+
+    def add(self, what, filename, detail=''):
+        if what in self.changed:
+            self.changed[what] += 1
+        self.entries.append('%s\t%s\t%s' % (what, P.relpath(filename, self.installdir), detail))
+
+    def add_rpath(self, filename, ret, err):
+        if err is not None:
+            print('  Failed %s' % P.basename(filename))
+            self.add('failed', filename, err)
+            return
+        what, old, new = ret
+        self.add(what, filename, '%s -> %s' % (':'.join(old), ':'.join(new)))
+
+    def save(self, report=None):
+        if report is None:
+            report = P.join(self.installdir, '.relocation-report.txt')
+        with file(report, 'w') as f:
+            for entry in self.entries:
+                f.write(entry + '\n')
+        print('Relocation report in %s' % report)
+
+PT_LOAD, PT_DYNAMIC = 1, 2
+DT_NULL, DT_STRTAB, DT_RPATH, DT_RUNPATH = 0, 5, 15, 29
+
+def elf_rpath_slot(data):
+    '''Find the RPATH (or RUNPATH) string in the contents of an ELF file
+       (a string or an mmap). Returns its offset and length, or None.'''
+    if data[:4] != '\x7fELF':
+        return None
+    end = '<' if data[5] == '\x01' else '>'
+    if data[4] == '\x02':
+        phoff, = struct.unpack_from(end + 'Q', data, 0x20)
+        phentsize, phnum = struct.unpack_from(end + 'HH', data, 0x36)
+        phdr = lambda at: [struct.unpack_from(end + 'IIQQQQQQ', data, at)[i] for i in (0, 2, 3, 5)]
+        dyn  = end + 'qQ'
+    else:
+        phoff, = struct.unpack_from(end + 'I', data, 0x1c)
+        phentsize, phnum = struct.unpack_from(end + 'HH', data, 0x2a)
+        phdr = lambda at: [struct.unpack_from(end + 'IIIIIIII', data, at)[i] for i in (0, 1, 2, 4)]
+        dyn  = end + 'iI'
+
+    loads = []
+    dynamic = None
+    for i in range(phnum):
+        p_type, p_offset, p_vaddr, p_filesz = phdr(phoff + i * phentsize)
+        if p_type == PT_LOAD:
+            loads.append((p_vaddr, p_offset, p_filesz))
+        elif p_type == PT_DYNAMIC:
+            dynamic = (p_offset, p_filesz)
+    if dynamic is None:
+        return None
+
+    strtab = rpath = None
+    size = struct.calcsize(dyn)
+    for at in range(dynamic[0], dynamic[0] + dynamic[1], size):
+        tag, val = struct.unpack_from(dyn, data, at)
+        if tag == DT_NULL:
+            break
+        if tag == DT_STRTAB:
+            strtab = val
+        elif tag in (DT_RPATH, DT_RUNPATH) and rpath is None:
+            rpath = val
+    if strtab is None or rpath is None:
+        return None
+    for vaddr, offset, filesz in loads:
+        if vaddr <= strtab < vaddr + filesz:
+            start = strtab - vaddr + offset + rpath
+            return start, data.find('\0', start) - start
+    return None
+
+def patch_c_strings(m, offsets, old, new):
+    '''Replace old by new (which is not longer) at each offset of a
+       writable mmap. Each occurrence is in a NUL terminated string: the
+       rest of the string moves up and the end is padded with NULs.
+       Offsets that do not hold old (the file was patched already, under
+       another name) are left alone. Returns where the new strings ended
+       up, and how many offsets were left alone.'''
+    shift = len(old) - len(new)
+    moved = []
+    skipped = 0
+    for off in sorted(offsets, reverse=True):
+        if m[off:off + len(old)] != old:
+            skipped += 1
+            continue
+        end  = m.find('\0', off)
+        if end == -1: end = len(m)
+        text = new + m[off + len(old):end]
+        m[off:end] = text + '\0' * (end - off - len(text))
+        # Occurrences later in the same string have moved up
+        moved = [o - shift if off < o < end else o for o in moved]
+        moved.append(off)
+    return sorted(moved), skipped
+
+class RelocationIndex(object):
+    '''Where the build root (prefix) of a prebuilt tree appears, saved when
+       the tree is packed (make-dist.py --include all) and shipped as the
+       first member of the tarball. Relocating the tree then needs no
+       searching: the control files listed get their paths rewritten, and
+       binaries are patched in place at the recorded offsets. A path in a
+       binary is a NUL terminated string, so a shorter (or equally long)
+       new prefix fits by padding the string with NULs, and the rpath is
+       rewritten in the space the long /aaaa... placeholder reserved.
+
+       files maps each relative path to a dict: 'text' for control files,
+       or the 'offsets' of the prefix and the 'rpath' slot (offset and
+       length) of a binary. A file relocated by an earlier, different
+       prefix keeps it in 'prefix'.'''
+    NAME    = '.relocation-index.json'
+    VERSION = 1
+
+    def __init__(self, prefix, files=None):
+        self.prefix = prefix
+        self.files  = files if files is not None else dict()
+
+    @staticmethod
+    def build(prefix, files, arch):
+        '''Scan files (a dict of relative path -> file) for prefix'''
+        index  = RelocationIndex(prefix)
+        marker = binary_builder_prefix()
+        rpaths = rpath_files(arch)
+        for rel, path in sorted(files.iteritems()):
+            if P.islink(path) or not P.isfile(path) or P.getsize(path) == 0:
+                continue
+            if has_binary_magic(path):
+                with file(path, 'rb') as f:
+                    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    try:
+                        entry = index._scan_binary(m, matches_any(rel, rpaths))
+                    finally:
+                        m.close()
+                if entry:
+                    index.files[rel] = entry
+            elif is_control_file(rel) and (file_contains(path, prefix) or file_contains(path, marker)):
+                index.files[rel] = dict(text = True)
+        return index
+
+    def _scan_binary(self, m, with_rpath):
+        entry = dict()
+        slot  = elf_rpath_slot(m) if with_rpath else None
+        if slot is not None:
+            entry['rpath'] = list(slot)
+        offsets = []
+        off = m.find(self.prefix)
+        while off != -1:
+            # The rpath gets rewritten as a whole
+            if slot is None or not slot[0] <= off < slot[0] + slot[1]:
+                offsets.append(off)
+            off = m.find(self.prefix, off + 1)
+        if offsets:
+            entry['offsets'] = offsets
+        return entry
+
+    @staticmethod
+    def load(f):
+        data = json.load(f)
+        if data.get('version') != RelocationIndex.VERSION:
+            raise Exception('Unknown relocation index version %s' % data.get('version'))
+        return RelocationIndex(str(data['prefix']), dict((str(k), v) for k, v in data['files'].iteritems()))
+
+    def dump(self, f):
+        json.dump(dict(version = self.VERSION, prefix = self.prefix, files = self.files), f, sort_keys=True)
+
+    def relocate_data(self, rel, data, installdir):
+        '''Relocate the contents of a listed control file'''
+        self.files[rel].pop('prefix', None)
+        return relocate_text(data, installdir, self.prefix_of(rel))
+
+    def prefix_of(self, rel):
+        return self.files[rel].get('prefix', self.prefix)
+
+    def patch_binary(self, path, rel, installdir, searchpath):
+        '''Patch a listed binary in place. Returns what was done, as
+           (what, detail) pairs for the report.'''
+        entry = self.files[rel]
+        old   = str(self.prefix_of(rel))
+        done  = []
+        st = os.stat(path)
+        os.chmod(path, st.st_mode | stat.S_IREAD | stat.S_IWRITE)
+        with file(path, 'r+b') as f:
+            m = mmap.mmap(f.fileno(), 0)
+            try:
+                if entry.get('offsets') and old != installdir:
+                    if len(installdir) <= len(old):
+                        entry['offsets'], skipped = patch_c_strings(m, entry['offsets'], old, installdir)
+                        entry.pop('prefix', None)
+                        done.append(('binary', '%d paths' % len(entry['offsets'])))
+                        if skipped:
+                            done.append(('skipped', '%d offsets did not hold %s' % (skipped, old)))
+                    else:
+                        entry['prefix'] = old
+                        done.append(('skipped', '%s is longer than %s' % (installdir, old)))
+                if 'rpath' in entry:
+                    off, length = entry['rpath']
+                    current = m[off:m.find('\0', off)]
+                    new = ':'.join(origin_rpath(path, installdir, searchpath))
+                    if current == new:
+                        done.append(('ok', '%s -> %s' % (current, new)))
+                    elif len(new) <= length:
+                        m[off:off + length] = new + '\0' * (length - len(new))
+                        done.append(('rpath', '%s -> %s' % (current, new)))
+                    else:
+                        done.append(('failed', 'rpath %s does not fit in %d bytes' % (new, length)))
+            finally:
+                m.close()
+        os.chmod(path, st.st_mode)
+        return done
+
+    def merge(self, older):
+        '''Keep the entries of an index for files this one does not list'''
+        for rel, entry in older.files.iteritems():
+            if rel not in self.files:
+                entry = dict(entry)
+                if entry.get('prefix', older.prefix) != self.prefix:
+                    entry['prefix'] = entry.get('prefix', older.prefix)
+                self.files[rel] = entry
+
+    def save(self, installdir, older=None):
+        '''Write the index for the relocated tree in installdir'''
+        self.prefix = installdir
+        if older is not None:
+            self.merge(older)
+        with file(P.join(installdir, self.NAME), 'w') as f:
+            self.dump(f)
+
+def load_relocation_index(installdir):
+    path = P.join(installdir, RelocationIndex.NAME)
+    if not P.exists(path):
+        return None
+    with file(path, 'r') as f:
+        return RelocationIndex.load(f)
+
+def fix_install_paths(installdir, arch, report=None):
+    ''' After unpacking a set of pre-built binaries, in given directory,
+        fix any paths to point to the current directory.
+
+        Only the control files that mention the build root are rewritten,
+        and only the binaries whose rpath is not right yet get chrpath. The
+        work is spread over all cores. Everything done goes in the report,
+        by default <installdir>/.relocation-report.txt.
+
+        A tree that came with a RelocationIndex is patched in place
+        instead, without searching any file. '''
+
+    def unique(files):
+        '''Skip dirs and dangling links, and files seen under another name'''
+        seen = set()
+        ret  = []
+        for f in files:
+            real = P.realpath(f)
+            if real in seen or not P.isfile(real):
+                continue
+            seen.add(real)
+            ret.append(f)
+        return ret
+
+    log = RelocationReport(installdir)
+
+    index = load_relocation_index(installdir)
+    if index is not None:
+        relocate_indexed(installdir, arch, index, log)
+        log.save(report)
+        return
+
+    print('Fixing paths in libtool control files, etc.')
+    control_files = list_recursively(P.join(installdir,'share'))
+    for pattern in CONTROL_FILES:
+        control_files += glob(P.join(installdir, *pattern.split('/')))
+
+    marker = binary_builder_prefix()
+    candidates = []
+    for control in unique(control_files):
+        if file_contains(control, marker) and not has_binary_magic(control):
+            candidates.append(control)
+    for control, count, err in in_parallel(lambda f: relocate_control_file(f, installdir), candidates):
+        if err is not None:
+            print('  Failed %s: %s' % (P.basename(control), err))
+            log.add('failed', control, err)
+        elif count:
+            logger.debug('  %s' % P.basename(control))
+            log.add('text', control, count)
+    print('  Rewrote %d of %d control files' % (log.changed['text'], len(control_files)))
+
+    make_blas_la(installdir, arch)
+    add_bin_to_path(installdir)
 
     print('Fixing RPATHs')
-    for curr_path in SEARCHPATH:
-        for extension in library_ext:
-            for library in glob(P.join(curr_path,'*.'+extension+'*')):
-                if not is_binary(library):
-                    continue
-                print('  %s' % P.basename(library))
-                try:
-                    set_rpath(library, installdir, map(lambda path: P.relpath(path, installdir), SEARCHPATH), False)
-                except:
-                    print('  Failed %s' % P.basename(library))
-
-    print('Fixing Binaries')
-    for binary in glob(P.join(installdir,'bin','*')):
-        if not is_binary(binary):
+    binaries = []
+    for pattern in rpath_files(arch):
+        binaries += glob(P.join(installdir, *pattern.split('/')))
+    binaries = [b for b in unique(binaries) if has_binary_magic(b)]
+
+    for binary, ret, err in in_parallel(lambda f: relocate_rpath(f, installdir, RPATH_SEARCHPATH), binaries):
+        log.add_rpath(binary, ret, err)
+    print('  Updated %d of %d binaries' % (log.changed['rpath'], len(binaries)))
+    log.save(report)
+
+def patch_indexed_binary(index, path, rel, installdir, searchpath):
+    '''Patch a binary of an indexed tree. The index has no rpath slot for
+       Mach-O files, so on OSX they also go through install_name_tool,
+       as in an unindexed tree.'''
+    done = []
+    if rel in index.files:
+        done = index.patch_binary(path, rel, installdir, searchpath)
+    if get_platform().os == 'osx':
+        what, old, new = relocate_rpath(path, installdir, searchpath)
+        done.append((what, '%s -> %s' % (':'.join(old), ':'.join(new))))
+    return done
+
+def relocate_indexed(installdir, arch, index, log):
+    '''fix_install_paths for a tree with a RelocationIndex'''
+    print('Relocating %s to %s using its index' % (index.prefix, installdir))
+    add_bin_to_path(installdir)
+
+    rels = set(index.files)
+    if arch.os == 'osx':
+        for pattern in rpath_files(arch):
+            for path in glob(P.join(installdir, *pattern.split('/'))):
+                if has_binary_magic(path):
+                    rels.add(P.relpath(path, installdir))
+
+    # A file under several names (symlinks, hard links) is patched once,
+    # and its other names get the entry it ends up with
+    aliases = dict()
+    for rel in sorted(rels):
+        path = P.join(installdir, rel)
+        if P.isfile(path):
+            st = os.stat(path)
+            aliases.setdefault((st.st_dev, st.st_ino), []).append(rel)
+
+    def relocate(rel):
+        path = P.join(installdir, rel)
+        entry = index.files.get(rel)
+        if entry is not None and entry.get('text'):
+            count = relocate_control_file(path, installdir, index.prefix_of(rel))
+            entry.pop('prefix', None)
+            return [('text', count)] if count else []
+        return patch_indexed_binary(index, path, rel, installdir, RPATH_SEARCHPATH)
+
+    first = sorted(names[0] for names in aliases.itervalues())
+    for names in aliases.itervalues():
+        for other in names[1:]:
+            if names[0] in index.files:
+                index.files[other] = index.files[names[0]]
+            elif other in index.files:
+                # Only listed under a name we do not patch through
+                index.files[names[0]] = index.files[other]
+    for rel, done, err in in_parallel(relocate, first):
+        path = P.join(installdir, rel)
+        if err is not None:
+            print('  Failed %s: %s' % (rel, err))
+            log.add('failed', path, err)
             continue
-        print('  %s' % P.basename(binary))
+        for what, detail in done:
+            log.add(what, path, detail)
+    print('  Rewrote %d control files and %d rpaths' % (log.changed['text'], log.changed['rpath']))
+
+    make_blas_la(installdir, arch)
+    index.save(installdir)
+
+def deploy_tarball(tarball, installdir, arch, strip_components=1, report=None):
+    '''Unpack a prebuilt tree (like a BaseSystem tarball) into installdir
+       and relocate it on the way: the same result as extract_tarball
+       followed by fix_install_paths, but each byte is only read once.
+
+       The tarball is decompressed in parallel and read as a stream.
+       Control files that mention the build root are rewritten in memory
+       before they are written out, and as soon as a binary is on disk
+       its rpath fix is queued on a thread pool, so it overlaps with the
+       rest of the extraction.
+
+       If the tarball starts with a RelocationIndex, only the files it
+       lists are touched, and binaries are patched in place instead of
+       going through chrpath.'''
+
+    logger.info('Deploying %s' % tarball)
+    log = RelocationReport(installdir)
+    marker = binary_builder_prefix()
+    rpath_patterns = rpath_files(arch)
+    add_bin_to_path(installdir)
+
+    def relpath_of(info):
+        parts = [p for p in info.name.split('/') if p not in ('', '.')][strip_components:]
+        if '..' in parts:
+            raise Exception('Refusing to extract %s outside of %s' % (info.name, installdir))
+        return '/'.join(parts)
+
+    pool = ThreadPool(cpu_count())
+    pending = []
+    index = None
+    older = load_relocation_index(installdir)
+    codec = codec_for(tarball)
+    with file(tarball, 'rb') as f:
+        p = None
+        stream = f
+        if codec is not None:
+            cmd = decompress_command(codec)
+            p = subprocess.Popen(cmd, stdin=f, stdout=subprocess.PIPE)
+            stream = p.stdout
+        tar = tarfile.open(fileobj=stream, mode='r|')
+        try:
+            for info in tar:
+                tar.members = [] # Don't keep every member of a huge tarball around
+                relpath = relpath_of(info)
+                if not relpath:
+                    continue
+                dst = P.join(installdir, relpath)
+                if info.isdir():
+                    mkdir_f(dst)
+                    continue
+                mkdir_f(P.dirname(dst))
+                if P.lexists(dst) and not P.isdir(dst):
+                    remove(dst)
+                if info.issym():
+                    symlink(info.linkname, dst)
+                    continue
+                if info.islnk():
+                    link(P.join(installdir, relpath_of(tarfile.TarInfo(info.linkname))), dst)
+                    continue
+                if not info.isreg():
+                    logger.warn('Skipping special file %s' % info.name)
+                    continue
+
+                src = tar.extractfile(info)
+                if relpath == RelocationIndex.NAME:
+                    index = RelocationIndex.load(src)
+                    continue
+                if index is not None:
+                    entry = index.files.get(relpath)
+                    if entry is not None and entry.get('text'):
+                        data, count = index.relocate_data(relpath, src.read(), installdir)
+                        with file(dst, 'wb') as out:
+                            out.write(data)
+                        if count:
+                            log.add('text', dst, count)
+                    else:
+                        with file(dst, 'wb') as out:
+                            shutil.copyfileobj(src, out, 1 << 20)
+                    os.chmod(dst, info.mode)
+                    os.utime(dst, (info.mtime, info.mtime))
+                    if (entry is not None and not entry.get('text')) or \
+                       (arch.os == 'osx' and matches_any(relpath, rpath_patterns) and has_binary_magic(dst)):
+                        pending.append((dst, pool.apply_async(patch_indexed_binary, (index, dst, relpath, installdir, RPATH_SEARCHPATH))))
+                    continue
+
+                head = src.read(4)
+                binary = head in BINARY_MAGIC
+                if not binary and is_control_file(relpath) and info.size < (64 << 20):
+                    data, count = relocate_text(head + src.read(), installdir)
+                    with file(dst, 'wb') as out:
+                        out.write(data)
+                    if count:
+                        log.add('text', dst, count)
+                else:
+                    with file(dst, 'wb') as out:
+                        out.write(head)
+                        shutil.copyfileobj(src, out, 1 << 20)
+                    if not binary and is_control_file(relpath) and file_contains(dst, marker):
+                        log.add('text', dst, relocate_control_file(dst, installdir))
+                os.chmod(dst, info.mode)
+                os.utime(dst, (info.mtime, info.mtime))
+
+                if binary and matches_any(relpath, rpath_patterns):
+                    pending.append((dst, pool.apply_async(relocate_rpath, (dst, installdir, RPATH_SEARCHPATH))))
+        finally:
+            tar.close()
+            pool.close()
+        if p is not None:
+            stream.close()
+            if p.wait() != 0:
+                raise Exception('%s: command returned %d' % (cmd, p.returncode))
+
+    print('  Rewrote %d control files' % log.changed['text'])
+    pool.join()
+    for dst, result in pending:
         try:
-            set_rpath(binary, installdir, map(lambda path: P.relpath(path, installdir), SEARCHPATH), False)
-        except:
-            print('  Failed %s' % P.basename(binary))
+            ret = result.get()
+        except Exception, e:
+            log.add_rpath(dst, None, e)
+            continue
+        if index is None:
+            log.add_rpath(dst, ret, None)
+        else:
+            for what, detail in ret:
+                log.add(what, dst, detail)
+    print('  Updated %d of %d binaries' % (log.changed['rpath'], len(pending)))
+
+    make_blas_la(installdir, arch)
+    if index is not None:
+        index.save(installdir, older)
+    log.save(report)
 
 
 if __name__ == '__main__':
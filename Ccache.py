@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+import os.path as P
+import logging
+import os, re, json, subprocess, tarfile
+from BinaryDist import codec_for, compress_command, decompress_command, mkdir_f
+
+''' The ccache setup build.py uses.
+
+    One cache directory is shared by all build roots on a machine (and can
+    be seeded from the cache a BaseSystem was built with). Paths under the
+    build root are made relative before hashing. The working directory
+    ends up in the debug info, so it stays in the hash, but build.py maps
+    the build root to . with -fdebug-prefix-map; ccache 3.3 and later hash
+    the mapped directory and leave the map out, so the same package built
+    in two build roots hits the same entries. (Older ones hash the map,
+    and only hit within one build root.) Timestamps the compilers put in
+    the output are not hashed.
+
+    ccache does not cache the .dwo files of -gsplit-dwarf, so build.py
+    does not use it with --debug-info split.
+
+    Hits and misses are taken from ccache's counters before and after each
+    package. In a cache shared with builds running at the same time they
+    count the other builds too.
+'''
+
+global logger
+logger = logging.getLogger()
+
+# Our flags are fixed, so only the usual sources of needless misses
+SLOPPINESS = 'time_macros,include_file_mtime,include_file_ctime,file_macro'
+
+# Files that belong to one cache and must not be copied into another
+LOCAL_FILES = re.compile(r'(^|/)(ccache\.conf|stats|tmp(/.*)?|.*\.lock|.*\.tmp\..*)$')
+
+def ccache_env(cache_dir, build_root):
+    '''The environment the compilers get'''
+    return dict(CCACHE_DIR       = P.abspath(cache_dir),
+                CCACHE_BASEDIR   = P.abspath(build_root),
+                CCACHE_COMPRESS  = '1',
+                CCACHE_SLOPPINESS = SLOPPINESS)
+
+def debug_prefix_map(build_root):
+    '''The flag that keeps the build root out of the debug info, so that
+       objects built in other build roots can be shared'''
+    return '-fdebug-prefix-map=%s=.' % P.abspath(build_root)
+
+def set_max_size(ccache, env, size):
+    '''Cap the cache (size like 20G), ccache evicts old entries past it'''
+    subprocess.check_call([ccache, '-M', size], env=env, stdout=open(os.devnull, 'w'))
+
+def ccache_stats(ccache, env):
+    '''The hit and miss counters of the cache, or None if ccache did not
+       tell us'''
+    def run(flag):
+        p = subprocess.Popen([ccache, flag], env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out = p.communicate()[0]
+        return out if p.returncode == 0 else None
+
+    # ccache 3.7 and later: one "name<TAB>value" per line
+    out = run('--print-stats')
+    if out is not None:
+        counters = dict()
+        for line in out.splitlines():
+            name, _, value = line.partition('\t')
+            if value.strip().isdigit():
+                counters[name] = int(value)
+        return dict(hits   = counters.get('direct_cache_hit', 0) + counters.get('preprocessed_cache_hit', 0),
+                    misses = counters.get('cache_miss', 0))
+    out = run('-s')
+    if out is None:
+        return None
+    count = lambda name: sum(int(n) for n in re.findall(r'^%s\s+(\d+)' % name, out, re.M))
+    return dict(hits   = count(r'cache hit \(direct\)') + count(r'cache hit \(preprocessed\)'),
+                misses = count(r'cache miss'))
+
+class CcacheReport(object):
+    '''Hits and misses per package, for the build report in the build root'''
+    def __init__(self, build_root):
+        self.path  = P.join(build_root, 'ccache-stats.json')
+        self.stats = dict()
+        try:
+            with file(self.path, 'r') as f:
+                self.stats = json.load(f)
+        except (IOError, ValueError):
+            pass
+
+    def record(self, name, before, after):
+        if before is None or after is None:
+            return None
+        delta = dict((k, after[k] - before[k]) for k in ('hits', 'misses'))
+        self.stats[name] = delta
+        tmp = '%s.%d' % (self.path, os.getpid())
+        with file(tmp, 'w') as f:
+            json.dump(self.stats, f, indent=1, sort_keys=True)
+        os.rename(tmp, self.path)
+        return delta
+
+    def summary(self, names):
+        lines = []
+        for name in names:
+            d = self.stats.get(name)
+            if d is None or not d['hits'] + d['misses']:
+                continue
+            lines.append('%-20s %8d hits %8d misses %5.1f%%'
+                         % (name, d['hits'], d['misses'], 100.0 * d['hits'] / (d['hits'] + d['misses'])))
+        return lines
+
+def export_cache(cache_dir, tarball):
+    '''Write the entries of a cache into a tarball, compressed according to
+       its extension, to seed other caches with'''
+    codec = codec_for(tarball)
+    with file(tarball, 'wb') as out:
+        p = None
+        stream = out
+        if codec is not None:
+            p = subprocess.Popen(compress_command(codec), stdin=subprocess.PIPE, stdout=out)
+            stream = p.stdin
+        tar = tarfile.open(fileobj=stream, mode='w|')
+        count = 0
+        for root, dirs, files in os.walk(cache_dir):
+            for name in sorted(files):
+                path = P.join(root, name)
+                rel = P.relpath(path, cache_dir)
+                if LOCAL_FILES.search(rel):
+                    continue
+                tar.add(path, rel)
+                count += 1
+        tar.close()
+        if p is not None:
+            p.stdin.close()
+            if p.wait() != 0:
+                raise Exception('Failed to compress %s' % tarball)
+    logger.info('Exported %d ccache files to %s' % (count, tarball))
+
+def warm_cache(tarball, cache_dir):
+    '''Add the entries of an exported cache that we do not have yet'''
+    mkdir_f(cache_dir)
+    codec = codec_for(tarball)
+    added = 0
+    with file(tarball, 'rb') as f:
+        p = None
+        stream = f
+        if codec is not None:
+            p = subprocess.Popen(decompress_command(codec), stdin=f, stdout=subprocess.PIPE)
+            stream = p.stdout
+        tar = tarfile.open(fileobj=stream, mode='r|')
+        for member in tar:
+            name = P.normpath(member.name)
+            if not member.isfile() or name.startswith('..') or P.isabs(name) or LOCAL_FILES.search(name):
+                continue
+            dst = P.join(cache_dir, name)
+            if P.exists(dst):
+                continue
+            mkdir_f(P.dirname(dst))
+            tmp = '%s.warm.%d' % (dst, os.getpid())
+            with file(tmp, 'wb') as out:
+                src = tar.extractfile(member)
+                for block in iter(lambda: src.read(1 << 20), ''):
+                    out.write(block)
+            os.rename(tmp, dst)
+            added += 1
+        tar.close()
+        if p is not None and p.wait() != 0:
+            raise Exception('Failed to decompress %s' % tarball)
+    logger.info('Added %d files from %s to %s' % (added, tarball, cache_dir))
+    return added
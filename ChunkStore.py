@@ -0,0 +1,452 @@
+#!/usr/bin/env python
+
+import os.path as P
+import logging
+import os, json, zlib, time, fcntl, bisect, struct, subprocess, urllib2
+from contextlib import contextmanager
+from multiprocessing import Pool, cpu_count
+from hashlib import sha1
+from glob import glob
+from BinaryDist import CODECS, codec_for, codec_program, compress_command, decompress_command, mkdir_f, rm_f
+from BinaryBuilder import hash_file
+
+''' A content-defined chunk store for dist tarballs.
+
+    A tarball is published as the list of chunks of its uncompressed tar
+    stream (a manifest) plus the chunks themselves, stored once each under
+    their sha1. Chunk boundaries only depend on nearby content, so two
+    nightlies share nearly all of their chunks, and moving a build between
+    stores (or hosts) only copies the chunks the other side is missing.
+
+    Boundaries are picked per tar member: small members are grouped, and a
+    group ends after a member whose hash has the right low bits. The data
+    of large members is cut with a gear rolling hash. Those cut points are
+    remembered by the member's sha1, so unchanged files are never scanned
+    twice.
+
+    publish, fetch and checkout hold a shared lock on the store, and gc an
+    exclusive one, so gc never deletes the chunks of a dist that is still
+    being published.
+'''
+
+global logger
+logger = logging.getLogger()
+
+BLOCK       = 512
+LARGE       = 1 << 20   # Members at least this big get chunked on their own
+MIN_CHUNK   = 1 << 18
+MAX_CHUNK   = 1 << 22
+MASK        = (1 << 20) - 1 # Average chunk of about 1 MB
+GROUP_MASK  = 3             # End a group of small members after ~1 in 4 members
+PUBLISH_SLACK = 24 * 3600   # How long before its manifest a publish may read the cut cache
+
+def _gear_table():
+    '''256 pseudo-random 32 bit values, fixed forever: changing them changes
+       every chunk boundary.'''
+    table = []
+    for i in range(256):
+        table.append(struct.unpack('>I', sha1('gear%d' % i).digest()[:4])[0])
+    return table
+GEAR = _gear_table()
+
+# The low bits of the hash only depend on the last WINDOW bytes, so the
+# bytes can be hashed in segments, each with the WINDOW - 1 bytes before it
+WINDOW      = 20      # The bits in MASK
+SEGMENT     = 1 << 22
+GEAR_LOW    = [g & MASK for g in GEAR]
+
+def _gear_zeros(args):
+    '''The offsets where the hash of the WINDOW bytes ending there has no
+       bits of MASK set, in a segment that starts at offset start (and
+       has the WINDOW - 1 bytes before it in front)'''
+    segment, start = args
+    gear = GEAR_LOW
+    zeros = []
+    h = 0
+    i = start - WINDOW + 1
+    for c in bytearray(segment):
+        h = ((h << 1) + gear[c]) & MASK
+        if not h and i >= start:
+            zeros.append(i)
+        i += 1
+    return zeros
+
+def gear_cuts(data, pool=None):
+    '''Content-defined cut points in data (offsets where chunks end).
+
+       Hashing is a Python loop over every byte, so with a multiprocessing
+       pool large data is hashed a segment per process. The cuts are the
+       same either way.'''
+    if pool is not None and len(data) >= 2 * SEGMENT:
+        return _parallel_gear_cuts(data, pool)
+    cuts = []
+    n = len(data)
+    start = 0
+    gear = GEAR
+    view = bytearray(data)
+    while n - start > MIN_CHUNK:
+        end = min(start + MAX_CHUNK, n)
+        h = 0
+        cut = end
+        for i in xrange(start + MIN_CHUNK, end):
+            h = ((h << 1) + gear[view[i]]) & 0xffffffff
+            if not h & MASK:
+                cut = i + 1
+                break
+        cuts.append(cut)
+        start = cut
+    if start < n:
+        cuts.append(n)
+    return cuts
+
+def _parallel_gear_cuts(data, pool):
+    n = len(data)
+    zeros = []
+    segments = ((data[s - WINDOW + 1:s + SEGMENT], s) for s in xrange(MIN_CHUNK, n, SEGMENT))
+    for z in pool.imap(_gear_zeros, segments):
+        zeros += z
+    cuts = []
+    start = 0
+    gear = GEAR_LOW
+    view = bytearray(data)
+    while n - start > MIN_CHUNK:
+        end = min(start + MAX_CHUNK, n)
+        first = start + MIN_CHUNK
+        cut = end
+        # The hash starts over at first, so until it has seen WINDOW bytes
+        # it is not the one _gear_zeros computed
+        h = 0
+        for i in xrange(first, min(first + WINDOW - 1, end)):
+            h = ((h << 1) + gear[view[i]]) & MASK
+            if not h:
+                cut = i + 1
+                break
+        else:
+            k = bisect.bisect_left(zeros, first + WINDOW - 1)
+            if k < len(zeros) and zeros[k] < end:
+                cut = zeros[k] + 1
+        cuts.append(cut)
+        start = cut
+    if start < n:
+        cuts.append(n)
+    return cuts
+
+def tar_members(stream):
+    '''Split a tar stream into (header bytes, data bytes) pairs, data padded
+       to the block size. Anything after the last member (the end-of-archive
+       blocks) comes as a final pair with empty data.'''
+    while True:
+        header = stream.read(BLOCK)
+        if not header:
+            return
+        if header == '\0' * BLOCK:
+            yield header + stream.read(), ''
+            return
+        headers = header
+        # GNU long name/link and pax headers carry their payload as data, then the real header follows
+        while header[156] in 'LKx':
+            size = _member_size(header)
+            headers += stream.read(_padded(size))
+            header = stream.read(BLOCK)
+            headers += header
+        size = 0
+        if header[156] not in '12345':
+            size = _member_size(header)
+        yield headers, stream.read(_padded(size))
+
+def _padded(size):
+    return (size + BLOCK - 1) // BLOCK * BLOCK
+
+def _member_size(header):
+    field = header[124:136]
+    if ord(field[0]) & 0x80: # GNU base-256 encoding
+        size = 0
+        for c in field[1:]:
+            size = (size << 8) + ord(c)
+        return size
+    field = field.strip('\0 ')
+    return int(field, 8) if field else 0
+
+class ChunkStore(object):
+    '''A directory of chunks and manifests. The same layout can be served
+       over http (or mirrored with rsync) and used as a source for fetch().'''
+    def __init__(self, root):
+        self.root = P.abspath(root)
+        mkdir_f(P.join(self.root, 'chunks'))
+        mkdir_f(P.join(self.root, 'manifests'))
+        mkdir_f(P.join(self.root, 'cuts'))
+
+    def chunk_path(self, digest):
+        return P.join(self.root, 'chunks', digest[:2], digest)
+
+    def manifest_path(self, name):
+        return P.join(self.root, 'manifests', name + '.json')
+
+    def has(self, digest):
+        return P.exists(self.chunk_path(digest))
+
+    @contextmanager
+    def lock(self, exclusive=False):
+        with file(P.join(self.root, 'lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def put_raw(self, digest, compressed, data=None):
+        path = self.chunk_path(digest)
+        if P.exists(path):
+            return
+        if compressed is None:
+            compressed = zlib.compress(data, 6)
+        mkdir_f(P.dirname(path))
+        tmp = '%s.%d' % (path, os.getpid())
+        with file(tmp, 'wb') as f:
+            f.write(compressed)
+        os.rename(tmp, path)
+
+    def get(self, digest):
+        with file(self.chunk_path(digest), 'rb') as f:
+            return zlib.decompress(f.read())
+
+    def names(self):
+        return sorted(P.basename(m)[:-5] for m in glob(P.join(self.root, 'manifests', '*.json')))
+
+    def manifest(self, name):
+        with file(self.manifest_path(name), 'r') as f:
+            return json.load(f)
+
+    def _cuts(self, data, pool=None):
+        '''gear_cuts, remembered by the sha1 of the data. The file's mtime
+           is when a publish last used it, for gc.'''
+        digest = sha1(data).hexdigest()
+        path = P.join(self.root, 'cuts', digest[:2], digest)
+        try:
+            with file(path, 'r') as f:
+                cuts = json.load(f)
+            os.utime(path, None)
+            return cuts
+        except (IOError, OSError, ValueError):
+            pass
+        cuts = gear_cuts(data, pool)
+        mkdir_f(P.dirname(path))
+        with file(path, 'w') as f:
+            json.dump(cuts, f)
+        return cuts
+
+    def publish(self, tarball, name=None, level=None):
+        '''Chunk a (compressed) tarball into the store and write its
+           manifest. level is the compression level the tarball was made
+           with, if not the codec's default; the manifest records it, and
+           the compressor found here, for checkout.'''
+        pool = Pool(cpu_count()) if cpu_count() > 1 else None
+        try:
+            with self.lock():
+                return self._publish(tarball, name, level, pool)
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    def _publish(self, tarball, name, level, pool):
+        if name is None:
+            name = P.basename(tarball)
+        codec = codec_for(tarball)
+        chunks = []
+        whole = sha1()
+        new = [0, 0] # chunks, bytes that were not in the store yet
+
+        def emit(data):
+            whole.update(data)
+            digest = sha1(data).hexdigest()
+            if not self.has(digest):
+                self.put_raw(digest, None, data)
+                new[0] += 1
+                new[1] += len(data)
+            chunks.append([digest, len(data)])
+
+        with file(tarball, 'rb') as f:
+            p = None
+            stream = f
+            if codec is not None:
+                p = subprocess.Popen(decompress_command(codec), stdin=f, stdout=subprocess.PIPE)
+                stream = p.stdout
+            group = []
+            group_len = 0
+            for headers, data in tar_members(stream):
+                if len(data) >= LARGE:
+                    group.append(headers)
+                    emit(''.join(group))
+                    group, group_len = [], 0
+                    start = 0
+                    for cut in self._cuts(data, pool):
+                        emit(data[start:cut])
+                        start = cut
+                    continue
+                group.append(headers)
+                group.append(data)
+                group_len += len(headers) + len(data)
+                # Not the whole header, the mtime in it changes every night
+                key = int(sha1(headers[:100] + data).hexdigest()[:8], 16)
+                if group_len >= MAX_CHUNK or (group_len >= MIN_CHUNK and not key & GROUP_MASK):
+                    emit(''.join(group))
+                    group, group_len = [], 0
+            if group:
+                emit(''.join(group))
+            if p is not None and p.wait() != 0:
+                raise Exception('Failed to decompress %s' % tarball)
+
+        manifest = dict(version = 1, name = name, created = time.time(),
+                        codec = codec.name if codec is not None else None,
+                        size = sum(c[1] for c in chunks), sha1 = whole.hexdigest(),
+                        chunks = chunks, tarball_sha1 = hash_file(tarball))
+        if codec is not None:
+            manifest['level']   = level if level is not None else codec.level
+            manifest['program'] = P.basename(codec_program(codec))
+        tmp = self.manifest_path(name) + '.%d' % os.getpid()
+        with file(tmp, 'w') as f:
+            json.dump(manifest, f)
+        os.rename(tmp, self.manifest_path(name))
+        logger.info('Published %s: %d chunks, %d new (%.1f of %.1f MB)'
+                    % (name, len(chunks), new[0], new[1] / 1e6, manifest['size'] / 1e6))
+        return manifest
+
+    def fetch(self, source, name):
+        '''Copy the manifest for name, and whichever of its chunks we are
+           missing, from another store (a path or an http URL). Each chunk
+           is checked against its digest before it goes in the store.'''
+        src = RemoteStore(source)
+        manifest = json.loads(src.read('manifests/%s.json' % name))
+        count, size = 0, 0
+        with self.lock():
+            for digest, length in manifest['chunks']:
+                if self.has(digest):
+                    continue
+                compressed = src.read('chunks/%s/%s' % (digest[:2], digest))
+                if not self._intact(digest, length, compressed):
+                    raise Exception('Chunk %s of %s in %s is corrupt' % (digest, name, source))
+                self.put_raw(digest, compressed)
+                count += 1
+                size  += length
+            tmp = self.manifest_path(name) + '.%d' % os.getpid()
+            with file(tmp, 'w') as f:
+                json.dump(manifest, f)
+            os.rename(tmp, self.manifest_path(name))
+        logger.info('Fetched %s: %d of %d chunks (%.1f of %.1f MB)'
+                    % (name, count, len(manifest['chunks']), size / 1e6, manifest['size'] / 1e6))
+        return manifest
+
+    def _intact(self, digest, length, compressed):
+        try:
+            data = zlib.decompress(compressed)
+        except zlib.error:
+            return False
+        return len(data) == length and sha1(data).hexdigest() == digest
+
+    def verify(self, name):
+        '''The chunks of name that are missing or do not match their digest'''
+        bad = []
+        with self.lock():
+            for digest, length in self.manifest(name)['chunks']:
+                try:
+                    with file(self.chunk_path(digest), 'rb') as f:
+                        compressed = f.read()
+                except IOError:
+                    compressed = ''
+                if not self._intact(digest, length, compressed):
+                    bad.append(digest)
+        return bad
+
+    def write_tar(self, name, out):
+        '''Reassemble the uncompressed tar stream of name into an open file'''
+        manifest = self.manifest(name)
+        whole = sha1()
+        for digest, length in manifest['chunks']:
+            data = self.get(digest)
+            whole.update(data)
+            out.write(data)
+        if whole.hexdigest() != manifest['sha1']:
+            raise Exception('Reassembled %s does not match its manifest' % name)
+
+    def checkout(self, name, tarball=None, directory=None, strip_components=0):
+        '''Rebuild the tarball (compressed like the original) and/or unpack it'''
+        with self.lock():
+            self._checkout(name, tarball, directory, strip_components)
+
+    def _checkout(self, name, tarball, directory, strip_components):
+        manifest = self.manifest(name)
+        if tarball is not None:
+            codec = manifest['codec']
+            with file(tarball, 'wb') as out:
+                if codec is None:
+                    self.write_tar(name, out)
+                else:
+                    codec = CODECS[codec]
+                    cmd = compress_command(codec, manifest.get('level'))
+                    p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=out)
+                    self.write_tar(name, p.stdin)
+                    p.stdin.close()
+                    if p.wait() != 0:
+                        raise Exception('%s: command returned %d' % (cmd, p.returncode))
+            if manifest.get('tarball_sha1') not in (None, hash_file(tarball)):
+                # The tar stream is checked, only the compression differs
+                logger.warn('%s has the same contents as the tarball that was published, but not the same bytes: '
+                            'that was not made by %s at level %s' % (tarball, P.basename(cmd[0]), manifest.get('level')))
+        if directory is not None:
+            mkdir_f(directory)
+            cmd = ['tar', 'xf', '-', '-C', directory]
+            if strip_components:
+                cmd += ['--strip-components', str(strip_components)]
+            p = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+            self.write_tar(name, p.stdin)
+            p.stdin.close()
+            if p.wait() != 0:
+                raise Exception('%s: command returned %d' % (cmd, p.returncode))
+
+    def gc(self, keep, prefix=''):
+        '''Keep the newest 'keep' manifests whose name starts with prefix,
+           drop the older ones, then delete chunks nothing refers to.'''
+        with self.lock(exclusive=True):
+            self._gc(keep, prefix)
+
+    def _gc(self, keep, prefix):
+        manifests = [(self.manifest(n)['created'], n) for n in self.names() if n.startswith(prefix)]
+        for created, name in sorted(manifests)[:max(len(manifests) - keep, 0)]:
+            logger.info('Removing manifest %s' % name)
+            rm_f(self.manifest_path(name))
+
+        live = set()
+        for name in self.names():
+            live.update(c[0] for c in self.manifest(name)['chunks'])
+        freed = 0
+        for path in glob(P.join(self.root, 'chunks', '*', '*')):
+            if P.basename(path) not in live:
+                freed += P.getsize(path)
+                os.remove(path)
+        logger.info('Freed %.1f MB of unreferenced chunks' % (freed / 1e6))
+
+        # Keep the cut points any remaining dist was published with, so an
+        # unchanged library is not scanned again. A publish uses them
+        # before it writes its manifest, and can take a while.
+        created = [self.manifest(name)['created'] for name in self.names()]
+        cutoff = min(created) - PUBLISH_SLACK if created else time.time()
+        dropped = 0
+        for path in glob(P.join(self.root, 'cuts', '*', '*')):
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    os.remove(path)
+                    dropped += 1
+            except OSError:
+                pass
+        logger.info('Dropped %d unused cut point lists' % dropped)
+
+class RemoteStore(object):
+    '''Read-only access to the files of a store at a path or http URL'''
+    def __init__(self, location):
+        self.location = location.rstrip('/')
+
+    def read(self, relpath):
+        if self.location.startswith('http://') or self.location.startswith('https://'):
+            return urllib2.urlopen('%s/%s' % (self.location, relpath)).read()
+        with file(P.join(self.location, relpath), 'rb') as f:
+            return f.read()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+import os.path as P
+import os, re, time, zlib, errno, socket, hashlib, tempfile, subprocess
+
+''' A cache of object files that build machines share.
+
+    build.py --objcache <where> has compiler-wrapper.py look each compile
+    up here before running it, and store what it compiled. <where> is a
+    directory (on NFS, say), the URL of objcache-server.py, or "local" for
+    a directory in the build root, to try it out on one machine.
+
+    The key is the hash of the compiler fingerprint (misc/toolchain.json),
+    the compiler, its flags and the preprocessed source. The preprocessed
+    source has the paths of the headers, and with -g the directory the
+    compile runs in, so machines only share objects built at the same
+    paths, as the auto_build hosts are. The dependency file of -MD is
+    written when preprocessing, hit or miss. Compiler warnings are not
+    stored, so a hit prints none.
+
+    This runs for every compile, so it is kept to the standard library.
+'''
+
+# Flags whose compiles have outputs (or inputs) the key does not cover
+UNCACHEABLE = re.compile(r'^(-save-temps.*|-gsplit-dwarf|-fprofile-.*|-fauto-profile.*|-ftest-coverage|'
+                         r'--coverage|-fdump-.*|-M|-MM|-E|-S|-|@.*)$')
+
+# Dependency file flags, and whether they take an argument
+DEP_FLAGS = {'-MD': False, '-MMD': False, '-MP': False, '-MF': True, '-MT': True, '-MQ': True}
+
+KEY = re.compile(r'^[0-9a-f]{64}$')
+
+def cacheable(args, mode, sources, output):
+    '''Whether a compiler command line makes one object from one source,
+       and nothing else'''
+    if mode != 'compile' or len(sources) != 1 or output is None:
+        return False
+    return not any(UNCACHEABLE.match(a) for a in args)
+
+def _preprocess_args(args, output, pre):
+    '''The compiler arguments that preprocess the source of a compile into
+       pre, writing the dependency file the compile would have'''
+    ret = []
+    i = 0
+    while i < len(args):
+        a = args[i]
+        if a == '-o':
+            i += 1
+        elif a.startswith('-o') or a == '-c':
+            pass
+        else:
+            ret.append(a)
+        i += 1
+    if '-MD' in args or '-MMD' in args:
+        # With -c these default to the output's name, with -E they would not
+        if '-MF' not in args:
+            ret += ['-MF', P.splitext(output)[0] + '.d']
+        if '-MT' not in args and '-MQ' not in args:
+            ret += ['-MT', output]
+    return ret + ['-E', '-o', pre]
+
+def _key_args(args, sources):
+    '''The arguments that make a difference to the object'''
+    ret = []
+    i = 0
+    while i < len(args):
+        a = args[i]
+        if a == '-o' or DEP_FLAGS.get(a):
+            i += 1
+        elif not (a.startswith('-o') or a in DEP_FLAGS or a in sources):
+            ret.append(a)
+        i += 1
+    return ret
+
+def object_key(compiler, name, args, sources, fingerprint, output):
+    '''Preprocess a compile and return its key, or None if the
+       preprocessor failed (the compile will say why). compiler is the
+       command that runs the compiler, name the compiler it stands for.'''
+    fd, pre = tempfile.mkstemp(suffix='.i', prefix='objcache-')
+    os.close(fd)
+    try:
+        with open(os.devnull, 'w') as null:
+            if subprocess.call(compiler + _preprocess_args(args, output, pre), stderr=null) != 0:
+                return None
+        h = hashlib.sha256()
+        h.update('objcache 1\0%s\0' % fingerprint)
+        h.update('\0'.join([name] + _key_args(args, sources)))
+        h.update('\0')
+        with open(pre, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), ''):
+                h.update(block)
+        return h.hexdigest()
+    finally:
+        try:
+            os.remove(pre)
+        except OSError, e:
+            # A failed preprocessor removes its output
+            if e.errno != errno.ENOENT:
+                raise
+
+def _umask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+def write_atomic(path, data):
+    d = P.dirname(path) or '.'
+    fd, tmp = tempfile.mkstemp(dir=d, prefix='.%s.' % P.basename(path))
+    try:
+        # mkstemp makes the file 0600; give it the mode open() would
+        os.fchmod(fd, 0666 & ~_umask())
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+
+class DirCache(object):
+    '''Objects in <dir>/xx/<key>, zlib compressed'''
+    def __init__(self, path):
+        self.path = path
+
+    def _file(self, key):
+        return P.join(self.path, key[:2], key)
+
+    def get(self, key):
+        data = self.get_raw(key)
+        try:
+            return None if data is None else zlib.decompress(data)
+        except zlib.error:
+            return None
+
+    def get_raw(self, key):
+        path = self._file(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+        try:
+            # So that trim() keeps what is used
+            os.utime(path, None)
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data):
+        self.put_raw(key, zlib.compress(data, 6))
+
+    def put_raw(self, key, data):
+        path = self._file(key)
+        if P.exists(path):
+            return
+        try:
+            os.makedirs(P.dirname(path))
+        except OSError:
+            pass
+        write_atomic(path, data)
+
+    def trim(self, max_bytes):
+        '''Remove the least recently used objects until the cache fits
+           in max_bytes. Returns how many were removed.'''
+        files = []
+        total = 0
+        for root, dirs, names in os.walk(self.path):
+            for name in names:
+                if not KEY.match(name):
+                    continue
+                path = P.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        files.sort()
+        removed = 0
+        for mtime, size, path in files:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+class HttpCache(object):
+    '''Objects behind objcache-server.py: GET and PUT <url>/<key>.
+
+       Once the server cannot be reached, the cache is off for the rest
+       of the process. Every compile is a process of its own, so the
+       failure is also noted in down_file, if given, and the compiles
+       that start in the next retry seconds do not try the server.'''
+    def __init__(self, url, timeout=5, down_file=None, retry=60):
+        self.url = str(url).rstrip('/')
+        self.timeout = timeout
+        self.down_file = down_file
+        self.down = False
+        if down_file is not None:
+            try:
+                self.down = time.time() - os.path.getmtime(down_file) < retry
+            except OSError:
+                pass
+
+    def _request(self, req):
+        import urllib2
+        if self.down:
+            return None
+        try:
+            return urllib2.urlopen(req, timeout=self.timeout).read()
+        except urllib2.HTTPError:
+            # The server answered: a miss, or a store it refused
+            return None
+        except (urllib2.URLError, IOError, socket.error):
+            self.down = True
+            if self.down_file is not None:
+                try:
+                    write_atomic(self.down_file, '')
+                except (IOError, OSError):
+                    pass
+            return None
+
+    def get(self, key):
+        data = self._request('%s/%s' % (self.url, key))
+        try:
+            return None if data is None else zlib.decompress(data)
+        except zlib.error:
+            return None
+
+    def put(self, key, data):
+        import urllib2
+        req = urllib2.Request('%s/%s' % (self.url, key), data=zlib.compress(data, 6))
+        req.get_method = lambda: 'PUT'
+        req.add_header('Content-Type', 'application/octet-stream')
+        self._request(req)
+
+def open_cache(where, down_file=None):
+    if re.match(r'^https?://', where):
+        return HttpCache(where, down_file=down_file)
+    return DirCache(where)
+
+def parse_size(text):
+    '''Bytes in a size like 20G'''
+    m = re.match(r'^(\d+(?:\.\d+)?)([KMGT]?)B?$', text.strip().upper())
+    if m is None:
+        raise ValueError('Bad size: %s' % text)
+    return int(float(m.group(1)) * 1024 ** ' KMGT'.index(m.group(2) or ' '))
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+
+import os.path as P
+import logging
+import os, re, json, time, shutil, errno, stat
+from hashlib import sha1
+from BinaryBuilder import get_platform
+from BinaryDist import copy, mkdir_f, rm_f, relocate_text, is_control_file, has_binary_magic, \
+     RelocationIndex, patch_indexed_binary, RPATH_SEARCHPATH
+
+''' An immutable store of installed packages, shared by all build roots.
+
+    After build.py installs a package, the files the install added or
+    changed in INSTALL_DIR are copied into a store entry, keyed by the
+    package, its chksum, the build flags and the keys of the packages
+    built before it. A build root that needs the same package again gets
+    it composed into its INSTALL_DIR as hard links (or symlinks) to the
+    entry instead of building it. Control files (.la, .pc, scripts, ...)
+    mention the install dir, so they are copied and relocated instead.
+    So are binaries, but the relocated copy is kept in the store too, and
+    the next composition into the same install dir links to it. Most
+    libraries only have an $ORIGIN rpath to set, which comes out the
+    same for every install dir, so all build roots share one copy of
+    those. A build root never loads libraries from another one, and
+    patching its binaries never changes the store entry.
+
+    Each build root remembers its compositions, so the tree can be rolled
+    back to the packages it had before the last build.
+'''
+
+global logger
+logger = logging.getLogger()
+
+# The parts of the build environment that change what a package installs.
+# Paths into the build root are left out, or nothing could be shared.
+FINGERPRINT_VARS = ('CC', 'CXX', 'F77', 'CFLAGS', 'CPPFLAGS', 'CXXFLAGS', 'LDFLAGS', 'AS_NEEDED', 'TRIM_LA')
+
+def env_fingerprint(env):
+    arch = get_platform()
+    parts = [arch.os, arch.machine, arch.dist_name, arch.dist_version]
+    for var in FINGERPRINT_VARS:
+        value = env.get(var, '')
+        if var in ('CC', 'CXX', 'F77'):
+            value = P.basename(value) # The ccache links live in the build root
+        else:
+            # Maps the build root out of the debug info (see Ccache.py)
+            value = re.sub(r'(^|\s)-fdebug-prefix-map=\S*', '', value).strip()
+        parts.append('%s=%s' % (var, value))
+    return '\n'.join(parts)
+
+def snapshot(directory):
+    '''What is in a directory: relative path -> (size, mtime, inode)'''
+    ret = dict()
+    for root, dirs, files in os.walk(directory):
+        for name in files + [d for d in dirs if P.islink(P.join(root, d))]:
+            path = P.join(root, name)
+            st = os.lstat(path)
+            ret[P.relpath(path, directory)] = (st.st_size, st.st_mtime, st.st_ino)
+    return ret
+
+class PackageStore(object):
+    '''A directory of package entries. An entry is the files one package
+       installed (under files/), described by entry.json.'''
+    def __init__(self, root):
+        self.root = P.abspath(root)
+        mkdir_f(P.join(self.root, 'entries'))
+
+    def key(self, name, chksum, env, previous='', toolchain=''):
+        '''The cache key of a package. previous is the key of the package
+           built before it, so a changed dependency changes the key of
+           everything built after it. toolchain is the fingerprint of the
+           compilers (see Toolchain).'''
+        h = sha1()
+        for part in (name, str(chksum), env_fingerprint(env), previous, toolchain):
+            h.update(part)
+            h.update('\0')
+        return h.hexdigest()
+
+    def entry_dir(self, name, key):
+        return P.join(self.root, 'entries', '%s-%s' % (name, key))
+
+    def has(self, name, key):
+        return P.exists(P.join(self.entry_dir(name, key), 'entry.json'))
+
+    def entry(self, name, key):
+        with file(P.join(self.entry_dir(name, key), 'entry.json'), 'r') as f:
+            return json.load(f)
+
+    def ingest(self, name, key, chksum, installdir, before):
+        '''Copy what a package install added to installdir (compared to the
+           snapshot before) into a new entry'''
+        after = snapshot(installdir)
+        changed = sorted(rel for rel, st in after.iteritems() if before.get(rel) != st)
+
+        entry = self.entry_dir(name, key)
+        tmp = '%s.%d' % (entry, os.getpid())
+        shutil.rmtree(tmp, True)
+        files    = []
+        control  = []
+        symlinks = dict()
+        for rel in changed:
+            src = P.join(installdir, rel)
+            if P.islink(src):
+                symlinks[rel] = os.readlink(src)
+                continue
+            dst = P.join(tmp, 'files', rel)
+            mkdir_f(P.dirname(dst))
+            copy(src, dst, keep_symlink=False)
+            # Nothing may change a file other build roots link to
+            os.chmod(dst, os.stat(dst).st_mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+            files.append(rel)
+            if is_control_file(rel) and not has_binary_magic(src):
+                control.append(rel)
+        with file(P.join(tmp, 'entry.json'), 'w') as f:
+            json.dump(dict(name = name, key = key, chksum = str(chksum), prefix = installdir, created = time.time(),
+                           files = files, control = control, symlinks = symlinks), f, sort_keys=True)
+        if P.exists(entry):
+            shutil.rmtree(tmp, True) # Another build root stored it first
+        else:
+            os.rename(tmp, entry)
+        logger.info('Stored %s: %d files, %d symlinks' % (name, len(files), len(symlinks)))
+
+    def compose(self, installdir, entries, symlinks=False):
+        '''Make the packages of entries (in order, later ones win) appear in
+           installdir. Files are hard links to the store unless symlinks is
+           set, or the store is on another filesystem. Control files are
+           copies, relocated to installdir, and binaries are links to
+           copies relocated for installdir (see _relocated).'''
+        arch = get_platform()
+        for e in entries:
+            top = P.join(self.entry_dir(e['name'], e['key']), 'files')
+            control = set(e['control'])
+            for rel in e['files']:
+                src = P.join(top, rel)
+                dst = P.join(installdir, rel)
+                mkdir_f(P.dirname(dst))
+                rm_f(dst)
+                if rel in control:
+                    with file(src, 'rb') as f:
+                        data, count = relocate_text(f.read(), installdir, str(e['prefix']))
+                    with file(dst, 'wb') as f:
+                        f.write(data)
+                    os.chmod(dst, os.stat(src).st_mode | stat.S_IWUSR)
+                elif has_binary_magic(src):
+                    self._relocated(e, src, dst, rel, installdir, arch, symlinks)
+                else:
+                    self._link(src, dst, symlinks)
+            for rel, target in e['symlinks'].iteritems():
+                dst = P.join(installdir, rel)
+                mkdir_f(P.dirname(dst))
+                rm_f(dst)
+                os.symlink(target, dst)
+
+    def _link(self, src, dst, symlinks):
+        if symlinks:
+            os.symlink(src, dst)
+            return
+        try:
+            os.link(src, dst)
+        except OSError, o:
+            if o.errno != errno.EXDEV:
+                raise
+            os.symlink(src, dst)
+
+    def _relocated(self, e, src, dst, rel, installdir, arch, symlinks):
+        '''Put a binary of entry e in installdir, with the paths into the
+           build root that stored it (and its rpath) pointing into
+           installdir. The relocated copy is kept under relocated/ in the
+           store, by install dir, or under relocated/any when only its
+           $ORIGIN rpath changes. A binary with nothing to change is
+           linked to the entry itself.'''
+        index = RelocationIndex.build(str(e['prefix']), {rel: src}, arch)
+        entry = index.files.get(rel)
+        if arch.os == 'osx':
+            where = sha1(installdir).hexdigest() # install_name_tool sets absolute paths
+        elif not entry:
+            self._link(src, dst, symlinks)
+            return
+        elif entry.get('offsets'):
+            where = sha1(installdir).hexdigest()
+        else:
+            where = 'any'
+        shared = P.join(self.root, 'relocated', where, '%s-%s' % (e['name'], e['key']), rel)
+        if P.exists(shared):
+            self._link(shared, dst, symlinks)
+            return
+
+        # Relocate it in place, where the rpath is relative to, then keep it
+        shutil.copy2(src, dst)
+        os.chmod(dst, os.stat(src).st_mode | stat.S_IWUSR)
+        for what, detail in patch_indexed_binary(index, dst, rel, installdir, RPATH_SEARCHPATH):
+            if what in ('skipped', 'failed'):
+                logger.warn('%s: %s' % (rel, detail))
+        os.chmod(dst, os.stat(dst).st_mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+        mkdir_f(P.dirname(shared))
+        tmp = '%s.%d' % (shared, os.getpid())
+        try:
+            os.link(dst, tmp)
+            os.rename(tmp, shared)
+        except OSError:
+            rm_f(tmp) # On another filesystem, this build root keeps its own copy
+
+    def decompose(self, installdir, entries):
+        '''Remove the files of entries from installdir'''
+        for e in entries:
+            for rel in e['files'] + e['symlinks'].keys():
+                rm_f(P.join(installdir, rel))
+
+class Compositions(object):
+    '''The history of which store entries a build root's INSTALL_DIR was
+       composed from, oldest first. The last one is the current one, and
+       is updated as each package gets built or linked.'''
+    def __init__(self, build_root):
+        self.path = P.join(build_root, 'compositions.json')
+        self.history = []
+        self.started = False
+        if P.exists(self.path):
+            with file(self.path, 'r') as f:
+                self.history = json.load(f)
+
+    def save(self):
+        tmp = '%s.%d' % (self.path, os.getpid())
+        with file(tmp, 'w') as f:
+            json.dump(self.history, f, indent=1)
+        os.rename(tmp, self.path)
+
+    def start(self):
+        '''Begin a new composition, with the packages of the current one.
+           It is only recorded once a package in it changes, so a build
+           that changes nothing leaves nothing to roll back.'''
+        self.started = True
+
+    def set(self, name, key):
+        current = self.history[-1]['packages'] if self.history else []
+        if [name, key] in current:
+            return
+        if self.started or not self.history:
+            self.history.append(dict(created = time.time(), packages = list(current)))
+            self.started = False
+        packages = [p for p in self.history[-1]['packages'] if p[0] != name]
+        packages.append([name, key])
+        self.history[-1]['packages'] = packages
+        self.save()
+
+    def rollback(self, store, installdir, symlinks=False):
+        '''Replace the current composition by the one before it. Returns
+           the store entries now in installdir.'''
+        if len(self.history) < 2:
+            raise Exception('No earlier composition to roll back to in %s' % self.path)
+        current, previous = self.history[-1], self.history[-2]
+        entries = lambda c: [store.entry(name, key) for name, key in c['packages'] if store.has(name, key)]
+        store.decompose(installdir, entries(current))
+        store.compose(installdir, entries(previous), symlinks)
+        self.history.pop()
+        self.save()
+        return entries(previous)
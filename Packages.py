@@ -579,6 +579,7 @@ class geos(Package):
 class superlu(Package):
     src    = ['http://sources.gentoo.org/cgi-bin/viewvc.cgi/gentoo-x86/sci-libs/superlu/files/superlu-4.3-autotools.patch','http://crd-legacy.lbl.gov/~xiaoye/SuperLU/superlu_4.3.tar.gz']
     chksum = ['c9cc1c9a7aceef81530c73eab7f599d652c1fddd','d2863610d8c545d250ffd020b8e74dc667d7cbdd']
+    keep_la_deps = True # libblas.la is made from it, see fix_install_paths
 
     def __init__(self,env):
         super(superlu,self).__init__(env)
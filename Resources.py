@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+
+import os.path as P
+import logging
+import os, re, json, math, time, shutil, threading, subprocess
+from BinaryBuilder import get_platform
+
+''' How much of the machine build.py may use, and how much each package
+    needs.
+
+    The CPUs are the online ones, less whatever the affinity mask and the
+    cgroup CPU quota (v1 or v2) take away; the memory is what the kernel
+    says is available, capped by the cgroup memory limit. While a package
+    builds, the memory of every process under build.py is sampled, and the
+    peak per make job is kept in resources.json in the build root. The next
+    build of the package gets a -j that fits in the memory available then.
+
+    The wall and CPU time of each stage are kept too. A package whose
+    compile stage kept only a few of its jobs busy (configure-bound, or a
+    serial Makefile) is given about as many as it used next time. If it
+    keeps those busy, it gets half as many again the time after, and so
+    on, rather than all of them at once, which would leave it alternating
+    between too many jobs and too few.
+
+    So is the size of each package's build tree once it is installed,
+    which decides whether build.py --tmpfs builds it in memory or on disk
+    (see BuildSpace).
+'''
+
+global logger
+logger = logging.getLogger()
+
+def _read(path):
+    try:
+        with file(path, 'r') as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+def _cgroup_files(name, v1_controller):
+    '''Where a cgroup control file of this process may be, for cgroup v2
+       and v1 (the path from /proc/self/cgroup, or the root of the cgroup
+       filesystem in a container that only sees its own cgroup)'''
+    ret = []
+    for line in (_read('/proc/self/cgroup') or '').splitlines():
+        parts = line.split(':', 2)
+        if len(parts) != 3:
+            continue
+        if parts[1] == '':
+            ret.append(P.join('/sys/fs/cgroup', parts[2].lstrip('/'), name))
+        elif v1_controller in parts[1].split(','):
+            ret.append(P.join('/sys/fs/cgroup', parts[1], parts[2].lstrip('/'), name))
+    ret += [P.join('/sys/fs/cgroup', name), P.join('/sys/fs/cgroup', v1_controller, name)]
+    return ret
+
+def _cpu_list_len(text):
+    '''Count the CPUs in a list like 0-3,8,10-11'''
+    n = 0
+    for part in text.split(','):
+        lo, _, hi = part.partition('-')
+        n += int(hi) - int(lo) + 1 if hi else 1
+    return n
+
+def effective_cpus():
+    '''The CPUs we may use: online, in our affinity mask and within our
+       cgroup CPU quota'''
+    try:
+        n = os.sysconf('SC_NPROCESSORS_ONLN') or 2
+    except (ValueError, OSError):
+        n = 2
+    if get_platform().os != 'linux':
+        return n
+
+    m = re.search(r'^Cpus_allowed_list:\s*(\S+)', _read('/proc/self/status') or '', re.M)
+    if m:
+        n = min(n, _cpu_list_len(m.group(1)))
+
+    quota = None
+    for path in _cgroup_files('cpu.max', 'cpu'):
+        text = _read(path)
+        if text is not None:
+            q, _, period = text.partition(' ')
+            if q != 'max':
+                quota = float(q) / float(period)
+            break
+    else:
+        for path in _cgroup_files('cpu.cfs_quota_us', 'cpu'):
+            q = _read(path)
+            period = _read(P.join(P.dirname(path), 'cpu.cfs_period_us'))
+            if q is not None and period is not None:
+                if int(q) > 0:
+                    quota = float(q) / float(period)
+                break
+    if quota is not None:
+        n = min(n, max(1, int(quota + 0.5)))
+    return n
+
+def available_memory():
+    '''Bytes of memory we can use now, or None if we can not tell'''
+    def linux():
+        m = re.search(r'^MemAvailable:\s*(\d+) kB', _read('/proc/meminfo') or '', re.M)
+        avail = int(m.group(1)) * 1024 if m else None
+        # A cgroup limit is the limit, whatever the host has free
+        for limit_name, usage_name in (('memory.max', 'memory.current'), ('memory.limit_in_bytes', 'memory.usage_in_bytes')):
+            for path in _cgroup_files(limit_name, 'memory'):
+                limit = _read(path)
+                if limit is None:
+                    continue
+                usage = _read(P.join(P.dirname(path), usage_name))
+                if limit != 'max' and usage is not None and int(limit) < (1 << 60):
+                    left = max(int(limit) - int(usage), 0)
+                    avail = left if avail is None else min(avail, left)
+                return avail
+        return avail
+    def osx():
+        try:
+            total = int(subprocess.Popen(['sysctl', '-n', 'hw.memsize'], stdout=subprocess.PIPE).communicate()[0])
+        except (OSError, ValueError):
+            return None
+        return total // 2 # No cheap equivalent of MemAvailable, assume half is free
+
+    return locals()[get_platform().os]()
+
+def oom_kills():
+    '''How many processes the kernel OOM killer has killed so far in our
+       cgroup (cgroup v2 memory.events, or v1 memory.oom_control), or in
+       the whole system if the kernel does not count them per cgroup. None
+       if we cannot tell.'''
+    for path in _cgroup_files('memory.events', 'memory') + _cgroup_files('memory.oom_control', 'memory'):
+        m = re.search(r'^oom_kill (\d+)', _read(path) or '', re.M)
+        if m:
+            return int(m.group(1))
+    m = re.search(r'^oom_kill (\d+)', _read('/proc/vmstat') or '', re.M)
+    return int(m.group(1)) if m else None
+
+def process_tree_rss(root):
+    '''Resident memory (bytes) of each process under root (not root itself)'''
+    def linux():
+        page = os.sysconf('SC_PAGE_SIZE')
+        children = dict()
+        rss = dict()
+        for name in os.listdir('/proc'):
+            if not name.isdigit():
+                continue
+            stat = _read('/proc/%s/stat' % name)
+            if stat is None:
+                continue
+            # The command name may have spaces, the fields after it do not
+            fields = stat[stat.rfind(')') + 2:].split()
+            pid = int(name)
+            children.setdefault(int(fields[1]), []).append(pid)
+            rss[pid] = int(fields[21]) * page
+        return children, rss
+    def osx():
+        out = subprocess.Popen(['ps', '-A', '-o', 'pid=,ppid=,rss='], stdout=subprocess.PIPE).communicate()[0]
+        children = dict()
+        rss = dict()
+        for line in out.splitlines():
+            pid, ppid, kb = map(int, line.split())
+            children.setdefault(ppid, []).append(pid)
+            rss[pid] = kb * 1024
+        return children, rss
+
+    children, rss = locals()[get_platform().os]()
+    ret = []
+    todo = list(children.get(root, []))
+    while todo:
+        pid = todo.pop()
+        ret.append(rss.get(pid, 0))
+        todo.extend(children.get(pid, []))
+    return ret
+
+def tree_size(path):
+    '''Bytes a directory tree takes on its filesystem'''
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                total += os.lstat(P.join(root, name)).st_blocks * 512
+            except OSError:
+                pass
+    return total
+
+class MemorySampler(threading.Thread):
+    '''Samples the memory of everything below this process until stopped.
+       peak is the most the whole tree used at once, largest the most any
+       single process used.'''
+    def __init__(self, interval=0.5):
+        super(MemorySampler, self).__init__()
+        self.daemon   = True
+        self.interval = interval
+        self.peak     = 0
+        self.largest  = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        pid = os.getpid()
+        while not self._stop_event.is_set():
+            try:
+                sizes = process_tree_rss(pid)
+            except (OSError, ValueError, IndexError):
+                sizes = []
+            if sizes:
+                self.peak    = max(self.peak, sum(sizes))
+                self.largest = max(self.largest, max(sizes))
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+class ResourceStats(object):
+    '''What each package needed the last time it was built'''
+    def __init__(self, build_root):
+        self.path  = P.join(build_root, 'resources.json')
+        self.stats = dict()
+        try:
+            with file(self.path, 'r') as f:
+                self.stats = json.load(f)
+        except (IOError, ValueError):
+            pass
+
+    def save(self):
+        tmp = '%s.%d' % (self.path, os.getpid())
+        with file(tmp, 'w') as f:
+            json.dump(self.stats, f, indent=1, sort_keys=True)
+        os.rename(tmp, self.path)
+
+    def record(self, name, jobs, sampler, oom=False, stages=None):
+        '''Remember a build of a package: the make jobs it had, the memory
+           sampled while it ran and, if it finished, the times of its
+           stages (see Package.stage_times)'''
+        per_job = max(sampler.largest, sampler.peak // max(jobs, 1))
+        old = self.stats.get(name, dict())
+        if oom:
+            # We never saw the peak, the build died on the way to it
+            per_job = max(per_job, old.get('per_job', 0))
+        if stages is None:
+            stages = old.get('stages', dict())
+        else:
+            stages = dict((k, dict(v, jobs = jobs)) for k, v in stages.iteritems())
+        self.stats[name] = dict(jobs = jobs, peak = sampler.peak, largest = sampler.largest,
+                                per_job = per_job, oom = oom, when = time.time(), stages = stages,
+                                footprint = old.get('footprint'))
+        self.save()
+
+    def record_footprint(self, name, size, complete=True):
+        '''Remember the size of a package's build tree. If the build did not
+           complete (it ran out of space) the tree needs more than size.'''
+        self.stats.setdefault(name, dict())['footprint'] = dict(size = size, complete = complete)
+        self.save()
+
+    def footprint(self, name):
+        '''The size of the build tree of a package last time, and whether
+           that was all of it, or None'''
+        f = self.stats.get(name, dict()).get('footprint')
+        return None if f is None else (f['size'], f['complete'])
+
+    def parallelism(self, name, stage='compile'):
+        '''How many jobs a stage kept busy on average last time, and the
+           -j it had, or None if it was too short to tell'''
+        t = self.stats.get(name, dict()).get('stages', dict()).get(stage)
+        if t is None or t['wall'] < 30:
+            return None
+        return t['cpu'] / t['wall'], t['jobs']
+
+    def jobs(self, name, threads, memory=None):
+        '''How many make jobs to give a package, at most threads, and why
+           it gets fewer (None if it does not)'''
+        old = self.stats.get(name)
+        if old is None:
+            return threads, None
+        jobs, why = threads, None
+        used = self.parallelism(name)
+        if used is not None:
+            busy, had = used
+            if busy < 0.7 * had:
+                # More jobs than this would sit idle
+                limit = max(2, int(math.ceil(busy * 1.5)))
+            else:
+                # It kept them busy, try a few more
+                limit = max(had + 1, int(math.ceil(had * 1.5)))
+            if limit < jobs:
+                jobs, why = limit, 'last time it kept %.1f of %d jobs busy' % used
+        if memory is None:
+            memory = available_memory()
+        if old.get('per_job') and memory is not None:
+            limit = int(memory * 0.9 // old['per_job'])
+            if limit < jobs:
+                jobs, why = limit, ('last time it needed %.1f GB per job, %.1f GB is available'
+                                    % (old['per_job'] / 1e9, memory / 1e9))
+            if old.get('oom') and old['jobs'] // 2 < jobs:
+                jobs, why = old['jobs'] // 2, 'it ran out of memory with -j%d last time' % old['jobs']
+        return max(1, jobs), why
+
+class BuildSpace(object):
+    '''Puts the build trees of the packages that fit on a memory-backed
+       filesystem, the others in the build directory on disk. At most
+       budget bytes of the tmpfs are used, counting the trees kept there
+       from earlier builds. A package is put there if the size of its tree
+       is not known yet, so that it can be measured. A package that runs
+       out of space there is built on disk from then on.'''
+    def __init__(self, disk_dir, tmpfs_dir, budget, stats):
+        self.disk_dir  = disk_dir
+        self.tmpfs_dir = tmpfs_dir
+        self.budget    = budget
+        self.stats     = stats
+        if not P.isdir(tmpfs_dir):
+            os.makedirs(tmpfs_dir)
+
+    def _trees(self):
+        return [P.join(self.tmpfs_dir, name) for name in os.listdir(self.tmpfs_dir)
+                if P.isdir(P.join(self.tmpfs_dir, name)) and not P.islink(P.join(self.tmpfs_dir, name))]
+
+    def available(self, name=None):
+        '''Bytes of the tmpfs a build of name could use, counting its own
+           tree from last time, which it replaces'''
+        used = 0
+        own = 0
+        for tree in self._trees():
+            size = tree_size(tree)
+            used += size
+            if name is not None and P.basename(tree) == name:
+                own = size
+        st = os.statvfs(self.tmpfs_dir)
+        return min(self.budget - used, st.f_bavail * st.f_frsize) + own
+
+    def place(self, name):
+        '''The BUILD_DIR to build a package in'''
+        footprint = self.stats.footprint(name)
+        avail = self.available(name)
+        fits = avail > 0
+        if footprint is not None:
+            size, complete = footprint
+            fits = size < avail if complete else False
+        if fits:
+            return self.tmpfs_dir
+        self.evict(name)
+        if footprint is not None:
+            print('The build tree of %s needs %s%.1f GB, %.1f GB of the tmpfs is available. Building on disk.'
+                  % (name, '' if footprint[1] else 'more than ', footprint[0] / 1e9, max(avail, 0) / 1e9))
+        return self.disk_dir
+
+    def full(self):
+        '''Whether the tmpfs, or our budget, is (almost) used up'''
+        return self.available() < 0.02 * self.budget
+
+    def evict(self, name):
+        '''Remove the tree of a package from the tmpfs'''
+        tree = P.join(self.tmpfs_dir, name)
+        if P.isdir(tree) and not P.islink(tree):
+            shutil.rmtree(tree, True)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+import os.path as P
+import logging
+import os, re, json, subprocess
+from hashlib import sha1
+from BinaryBuilder import get_platform
+from BinaryDist import in_parallel
+
+''' What build.py needs to know about the compilers and tools it runs.
+
+    Each program is looked up in the PATH and run with --version once. The
+    answer is kept in a json file (misc/toolchain.json in the build root)
+    with the path, mtime and size of the binary it came from, and reused by
+    later runs until the binary changes or another one comes first in the
+    PATH. The fingerprint of the toolchain goes into the package store keys,
+    so upgrading a compiler rebuilds everything it built.
+
+    Where the programs are in the PATH is remembered too, keyed by the PATH
+    and the mtimes of its directories, which change whenever a program is
+    added to or removed from one of them. preflight() checks everything
+    build.py needs at once: one scan of the PATH, and the --version probes
+    run in parallel.
+'''
+
+global logger
+logger = logging.getLogger()
+
+def _is_exe(path):
+    return P.isfile(path) and os.access(path, os.X_OK)
+
+class Toolchain(object):
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path     = path
+        self.tools    = dict()
+        self.resolved = dict(PATH = None, stamps = [], found = dict())
+        self.dirty    = False
+        try:
+            with file(self.path, 'r') as f:
+                saved = json.load(f)
+            if saved.get('version') == self.VERSION:
+                self.tools    = saved['tools']
+                self.resolved = saved['resolved']
+        except (IOError, ValueError, KeyError):
+            pass
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp = '%s.%d' % (self.path, os.getpid())
+        with file(tmp, 'w') as f:
+            json.dump(dict(version = self.VERSION, tools = self.tools, resolved = self.resolved), f, indent=1, sort_keys=True)
+        os.rename(tmp, self.path)
+        self.dirty = False
+
+    def resolve(self, programs):
+        '''Find programs in the PATH with a single scan of it. Returns a dict
+           of program -> path, or None for the ones that are missing.'''
+        PATH = os.environ['PATH']
+        dirs = [d.strip('"') for d in PATH.split(os.pathsep) if d]
+        stamps = []
+        for d in dirs:
+            try:
+                stamps.append(os.stat(d).st_mtime)
+            except OSError:
+                stamps.append(None)
+        if self.resolved['PATH'] != PATH or self.resolved['stamps'] != stamps:
+            self.resolved = dict(PATH = PATH, stamps = stamps, found = dict())
+            self.dirty = True
+        found = self.resolved['found']
+
+        ret = dict()
+        wanted = set()
+        for program in programs:
+            if os.sep in program:
+                ret[program] = program if _is_exe(program) else None
+            elif program in found:
+                ret[program] = found[program]
+            else:
+                wanted.add(program)
+        if wanted:
+            for program in wanted:
+                found[program] = None
+            for d in dirs:
+                try:
+                    names = set(os.listdir(d))
+                except OSError:
+                    continue
+                for program in wanted & names:
+                    if found[program] is None and _is_exe(P.join(d, program)):
+                        found[program] = P.join(d, program)
+            for program in wanted:
+                ret[program] = found[program]
+            self.dirty = True
+        return ret
+
+    def preflight(self, programs, probe=()):
+        '''Check that all of programs are in the PATH, and that the ones in
+           probe also run (their --version probes run in parallel). Returns
+           every program that is missing or does not run.'''
+        found = self.resolve(list(programs) + list(probe))
+        missing = [p for p in programs if found[p] is None]
+        for program, result, exc in in_parallel(self.tool, list(probe)):
+            if exc is not None:
+                logger.debug('%s: %s' % (program, exc))
+                missing.append(program)
+        return missing
+
+    def tool(self, program):
+        '''What we know about a program: its path, the binary it resolves to,
+           and what it says to --version. Raises if it is missing or does
+           not run.'''
+        path = self.resolve([program])[program]
+        if path is None:
+            raise Exception('Could not find: ' + program)
+        real = P.realpath(path)
+        st = os.stat(real)
+        old = self.tools.get(program)
+        if old is not None and old['path'] == path and old['real'] == real \
+                and old['mtime'] == st.st_mtime and old['size'] == st.st_size:
+            return old
+
+        logger.debug('Probing %s' % path)
+        try:
+            p = subprocess.Popen([path, '--version'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = p.communicate()
+        except OSError:
+            raise Exception('Could not run: ' + program)
+        if p.returncode != 0:
+            raise Exception('Checking ' + program + ' version caused errors')
+        out = out.decode('utf-8', 'replace')
+        m = re.match(r'^.*?(\d+\.\d+)', out)
+        self.tools[program] = dict(path = path, real = real, mtime = st.st_mtime, size = st.st_size,
+                                   output = out, version = float(m.group(1)) if m else None)
+        self.dirty = True
+        return self.tools[program]
+
+    def version(self, program):
+        '''The version of a program as a float, like get_prog_version'''
+        ret = self.tool(program)['version']
+        if ret is None:
+            raise Exception('Could not find ' + program + ' version')
+        return ret
+
+    def version_output(self, program):
+        return self.tool(program)['output']
+
+    def fingerprint(self, programs):
+        '''A hash of the platform and of these programs (paths and versions)'''
+        h = sha1()
+        h.update('\0'.join(map(str, get_platform())))
+        for program in programs:
+            t = self.tool(program)
+            for part in (program, t['real'], t['output']):
+                h.update('\0')
+                h.update(part.encode('utf-8'))
+        return h.hexdigest()
@@ -31,9 +31,8 @@ fi
 tarBallDir=$(dirname $HOME/$buildDir/$tarBall)
 cd $tarBallDir
 echo "Unpacking $HOME/$buildDir/$tarBall"
-tar xjfv $HOME/$buildDir/$tarBall
-binDir=$HOME/$buildDir/$tarBall
-binDir=${binDir/.tar.bz2/}
+unpack_tarball $HOME/$buildDir/$tarBall
+binDir=$(tarball_base $HOME/$buildDir/$tarBall)
 if [ ! -e "$binDir" ]; then
     echo "Error: Directory: $binDir does not exist"
     echo "$tarBall test_done $status" > $HOME/$buildDir/$statusFile
@@ -114,8 +113,23 @@ echo "###### Contents of the report file ######"
 cat $reportFile
 echo "###### End of the report file ######"
 
+# How long the shipped programs take to start, compared with the last
+# good build tested on this machine. For information only, it never
+# changes the status. The results go in the report, below the tests.
+startupBaseline=$HOME/$buildDir/startup_"$machine".json
+startupLog=startup.txt
+baselineOpt=""
+if [ -f "$startupBaseline" ]; then baselineOpt="--baseline $startupBaseline"; fi
+rm -f startup.json
+echo "###### Program startup times ######"
+$HOME/$buildDir/bench-startup.py $binDir --repeat 3 --save startup.json $baselineOpt > $startupLog 2>&1
+startupStatus="$?"
+cat $startupLog
+echo "###### End of program startup times ######"
+
 if [ $test_status -ne 0 ]; then
     echo "py.test command failed, sending status and early quit."
+    cat $startupLog >> $reportFile
     echo "$tarBall test_done $status" > $HOME/$buildDir/$statusFile
     exit 1
 fi
@@ -137,5 +151,16 @@ failures=$(grep -i fail $reportFile)
 if [ "$failures" = "" ]; then
     status="Success"
 fi
+
+# The baseline only moves to a build that passed and did not regress
+if [ -f startup.json ]; then
+    if [ ! -f "$startupBaseline" ] || \
+       ( [ "$status" = "Success" ] && [ "$startupStatus" -eq 0 ] ); then
+        cp -f startup.json $startupBaseline
+    fi
+fi
+echo "" >> $reportFile
+echo "###### Program startup times (not part of the status) ######" >> $reportFile
+cat $startupLog >> $reportFile
 echo "$tarBall test_done $status" > $HOME/$buildDir/$statusFile
 echo "Finished running tests locally!"
@@ -58,6 +58,23 @@ function ncpus(){
     echo $ncpu
 }
 
+# Strip the compression extension from a dist tarball name
+function tarball_base (){
+    echo $1 | perl -pe "s#\.tar\.(bz2|gz|xz|zst)\$##g"
+}
+
+# Unpack a dist tarball in the current directory, using the parallel
+# decompressor which matches its extension (see CODECS in BinaryDist.py)
+function unpack_tarball (){
+    case "$1" in
+        *.tar.zst) zstd -d -c -q -T0 "$1" | tar xv ;;
+        *.tar.xz)  xz -d -c -T0 "$1"      | tar xv ;;
+        *.tar.gz)  if [ -n "$(which pigz 2>/dev/null)" ]; then pigz -d -c "$1" | tar xv; else tar xzvf "$1"; fi ;;
+        *.tar.bz2) if [ -n "$(which pbzip2 2>/dev/null)" ]; then pbzip2 -d -c "$1" | tar xv; else tar xjvf "$1"; fi ;;
+        *)         tar xvf "$1" ;;
+    esac
+}
+
 # To do: Make this consistent with the above, so
 # remove the buildDir from here
 function output_file () {
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import sys
+code = -1
+# Must have this check before importing other BB modules
+if sys.version_info < (2, 6, 1):
+    print('\nERROR: Must use Python 2.6.1 or greater.')
+    sys.exit(code)
+
+import os, time, logging, subprocess, shutil
+import os.path as P
+from optparse import OptionParser
+from tempfile import mkdtemp
+from BinaryBuilder import die
+from BinaryDist import CODECS, codec_for, compress_command, decompress_command
+
+''' Compare the tarball compressors make-dist.py can use on a real dist.
+    For each codec report the compressed size and the compression and
+    decompression throughput (in MB/s of uncompressed tar).
+'''
+
+def timed(cmd, infile, outfile):
+    '''Run cmd with the given stdin/stdout paths, return the wall time'''
+    with file(infile, 'rb') as i:
+        with file(outfile, 'wb') as o:
+            start = time.time()
+            p = subprocess.Popen(cmd, stdin=i, stdout=o)
+            if p.wait() != 0:
+                raise Exception('%s: command returned %d' % (cmd, p.returncode))
+            return time.time() - start
+
+def make_plain_tar(src, tar):
+    '''Write an uncompressed tar of a dist dir or of a compressed dist tarball'''
+    if P.isdir(src):
+        src = P.realpath(src)
+        with file(tar, 'wb') as o:
+            subprocess.check_call(['tar', 'cf', '-', '-C', P.dirname(src), P.basename(src)], stdout=o)
+        return
+    codec = codec_for(src)
+    if codec is None:
+        shutil.copy(src, tar)
+    else:
+        timed(decompress_command(codec), src, tar)
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%s [options] <dist dir or tarball>' % sys.argv[0])
+    parser.add_option('--codec', dest='codecs', default=[], action='append',
+                      help='A codec to try, as name or name:level. Can be repeated. (default: all of %s)' % ', '.join(sorted(CODECS.keys())))
+    parser.add_option('--tmpdir', dest='tmpdir', default=None, help='Where to write the temporary archives')
+    parser.add_option('--debug',  dest='loglevel', default=logging.INFO, action='store_const', const=logging.DEBUG, help='Turn on debug messages')
+
+    (opt, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        die('\nMissing required argument: dist dir or tarball')
+    logging.basicConfig(level=opt.loglevel)
+
+    runs = []
+    for spec in opt.codecs or sorted(CODECS.keys()):
+        name, _, level = spec.partition(':')
+        if name not in CODECS:
+            die('Unknown codec %s' % name)
+        runs.append((CODECS[name], int(level) if level else CODECS[name].level))
+
+    tmpdir = mkdtemp(prefix='bench-compression', dir=opt.tmpdir)
+    try:
+        tar = P.join(tmpdir, 'dist.tar')
+        print('Writing uncompressed tar of %s' % args[0])
+        make_plain_tar(args[0], tar)
+        mb = P.getsize(tar) / 1e6
+
+        print('\n%-12s %12s %8s %14s %14s' % ('codec', 'size (MB)', 'ratio', 'comp (MB/s)', 'decomp (MB/s)'))
+        print('%-12s %12.1f %8.3f %14s %14s' % ('tar', mb, 1.0, '-', '-'))
+        for codec, level in runs:
+            label = '%s:%d' % (codec.name, level)
+            try:
+                out = P.join(tmpdir, 'dist' + codec.ext)
+                ctime = timed(compress_command(codec, level), tar, out)
+                dtime = timed(decompress_command(codec), out, os.devnull)
+            except Exception, e:
+                print('%-12s skipped: %s' % (label, e))
+                continue
+            size = P.getsize(out) / 1e6
+            print('%-12s %12.1f %8.3f %14.1f %14.1f' % (label, size, size / mb, mb / ctime, mb / dtime))
+            sys.stdout.flush()
+            os.remove(out)
+    finally:
+        shutil.rmtree(tmpdir, True)
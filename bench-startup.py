@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import sys
+code = -1
+# Must have this check before importing other BB modules
+if sys.version_info < (2, 6, 1):
+    print('\nERROR: Must use Python 2.6.1 or greater.')
+    sys.exit(code)
+
+import os, re, time, json, logging, shutil, subprocess, threading, fnmatch
+import os.path as P
+from optparse import OptionParser
+from tempfile import mkdtemp
+from glob import glob
+from BinaryBuilder import die, get_platform
+from BinaryDist import extract_tarball, has_binary_magic
+
+''' Measure how long the shipped programs take to start. Each program in
+    bin/ of a dist (made by make-dist.py) is run with --help through its
+    libexec wrapper, under the dynamic loader's statistics, and we record
+    how many libraries it loaded, how many relocations the loader did,
+    the time spent in the loader and the wall time of the whole run.
+
+    Compare against the results of an earlier dist to catch startup
+    regressions:
+      ./bench-startup.py StereoPipeline-X.tar.bz2 --save new.json --baseline old.json
+'''
+
+global logger
+logger = logging.getLogger()
+
+def run_timed(cmd, env, timeout):
+    '''Run cmd with no input, return its pid, stderr and wall time'''
+    with open(os.devnull, 'r+') as devnull:
+        start = time.time()
+        p = subprocess.Popen(cmd, env=env, stdin=devnull, stdout=devnull, stderr=subprocess.PIPE)
+        timer = threading.Timer(timeout, p.kill)
+        timer.start()
+        try:
+            err = p.communicate()[1]
+        finally:
+            timer.cancel()
+        return p.pid, err, time.time() - start
+
+def measure(wrapper, program, timeout):
+    '''Startup statistics of one program. The loader output for the
+       wrapper's shell and for the program end up in the same file (the
+       wrapper execs the program), so only the part about the program
+       counts.'''
+    def linux():
+        tmp = mkdtemp(prefix='bench-startup')
+        try:
+            env = dict(os.environ, LD_DEBUG='statistics,libs', LD_DEBUG_OUTPUT=P.join(tmp, 'ld'))
+            pid, err, wall = run_timed([wrapper, '--help'], env, timeout)
+            path = P.join(tmp, 'ld.%d' % pid)
+            if not P.exists(path):
+                return None
+            with file(path, 'r') as f:
+                text = f.read()
+        finally:
+            shutil.rmtree(tmp, True)
+        # Everything the loader did before handing control to the program
+        for m in re.finditer(r'transferring control: (\S+)', text):
+            if P.basename(m.group(1)) == P.basename(program):
+                break
+        else:
+            # Not the program's loader (it did not run, or is static)
+            return None
+        text = text[:m.start()]
+        text = text[text.rfind('transferring control:') + 1:] # Drop the wrapper's part
+        stat = lambda name: sum(int(x) for x in re.findall(name + r': (\d+)', text))
+        return dict(libs        = len(re.findall(r'calling init: ', text)),
+                    relocations = stat('number of relocations') + stat('number of relative relocations'),
+                    loader      = stat('total startup time in dynamic loader'), # cycles
+                    wall        = wall)
+    def osx():
+        env = dict(os.environ, DYLD_PRINT_STATISTICS_DETAILS='1', DYLD_PRINT_LIBRARIES='1')
+        pid, err, wall = run_timed([wrapper, '--help'], env, timeout)
+        # Keep what dyld said about the program, not about the wrapper's shell
+        start = err.rfind('dyld: loaded: %s' % program)
+        if start == -1:
+            start = err.rfind(P.basename(program))
+        text = err[max(start, 0):]
+        stat = lambda name: sum(int(x) for x in re.findall(name + r':\s+(\d+)', text))
+        m = re.search(r'total time: ([\d.]+) milliseconds', text)
+        return dict(libs        = len(re.findall(r'dyld: loaded: ', text)),
+                    relocations = stat('total rebase fixups') + stat('total binding fixups'),
+                    loader      = int(float(m.group(1)) * 1e6) if m else 0, # ns
+                    wall        = wall)
+
+    return locals()[get_platform().os]()
+
+def programs(distdir, patterns):
+    '''The bin/ wrappers that exec a binary from libexec/'''
+    ret = []
+    for wrapper in sorted(glob(P.join(distdir, 'bin', '*'))):
+        name = P.basename(wrapper)
+        program = P.join(distdir, 'libexec', name)
+        if not P.isfile(program) or not has_binary_magic(program):
+            continue
+        if patterns and not any(fnmatch.fnmatch(name, p) for p in patterns):
+            continue
+        ret.append((name, wrapper, program))
+    return ret
+
+def regressions(results, baseline, tolerance):
+    '''Compare with a baseline, returns a list of messages'''
+    ret = []
+    for name in sorted(results):
+        new, old = results[name], baseline.get(name)
+        if old is None:
+            continue
+        if new['libs'] > old['libs']:
+            ret.append('%s loads %d libraries, was %d' % (name, new['libs'], old['libs']))
+        for key in ('relocations', 'wall'):
+            if old[key] and new[key] > old[key] * (1 + tolerance):
+                ret.append('%s %s went from %s to %s (+%.0f%%)'
+                           % (name, key, old[key], new[key], 100.0 * (new[key] / float(old[key]) - 1)))
+    return ret
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%s [options] <dist dir or tarball> [program pattern ...]' % sys.argv[0])
+    parser.add_option('--repeat',    dest='repeat',    default=5, type='int', help='Runs per program, the fastest one counts (default: %default)')
+    parser.add_option('--timeout',   dest='timeout',   default=60, type='int', help='Kill a program after this many seconds (default: %default)')
+    parser.add_option('--save',      dest='save',      default=None, help='Write the results to this json file')
+    parser.add_option('--baseline',  dest='baseline',  default=None, help='Compare against the results saved from an earlier dist')
+    parser.add_option('--tolerance', dest='tolerance', default=0.2, type='float', help='Allowed growth of relocations and wall time over the baseline (default: %default)')
+    parser.add_option('--tmpdir',    dest='tmpdir',    default=None, help='Where to unpack a tarball')
+    parser.add_option('--debug',     dest='loglevel',  default=logging.INFO, action='store_const', const=logging.DEBUG, help='Turn on debug messages')
+
+    (opt, args) = parser.parse_args()
+    if not args:
+        parser.print_help()
+        die('\nMissing required argument: dist dir or tarball')
+    logging.basicConfig(level=opt.loglevel)
+
+    tmpdir = None
+    distdir = args[0]
+    if not P.isdir(distdir):
+        tmpdir = mkdtemp(prefix='bench-startup', dir=opt.tmpdir)
+        extract_tarball(distdir, tmpdir)
+        distdir = tmpdir
+
+    try:
+        found = programs(distdir, args[1:])
+        if not found:
+            die('No programs found in %s' % P.join(distdir, 'bin'))
+
+        results = dict()
+        print('%-32s %6s %12s %14s %10s' % ('program', 'libs', 'relocations', 'loader (M)', 'wall (ms)'))
+        for name, wrapper, program in found:
+            runs = []
+            for i in range(opt.repeat):
+                r = measure(wrapper, program, opt.timeout)
+                if r is not None:
+                    runs.append(r)
+            if not runs:
+                print('%-32s no loader statistics' % name)
+                continue
+            best = min(runs, key=lambda r: r['wall'])
+            best['loader'] = min(r['loader'] for r in runs)
+            results[name] = best
+            print('%-32s %6d %12d %14.1f %10.1f' % (name, best['libs'], best['relocations'], best['loader'] / 1e6, best['wall'] * 1e3))
+            sys.stdout.flush()
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, True)
+
+    if opt.save is not None:
+        with file(opt.save, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if opt.baseline is not None:
+        with file(opt.baseline, 'r') as f:
+            baseline = json.load(f)
+        found = regressions(results, baseline, opt.tolerance)
+        if found:
+            print('\nStartup regressions against %s:' % opt.baseline)
+            for msg in found:
+                print('  %s' % msg)
+            sys.exit(1)
+        print('\nNo startup regressions against %s' % opt.baseline)
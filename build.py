@@ -9,12 +9,15 @@ if sys.version_info < (2, 6, 1):
     sys.exit(code)
 
 import os
+import re
 import os.path as P
 import subprocess
 import errno
+import shutil
 import string
 import types
 import time
+import json
 from optparse import OptionParser
 from tempfile import mkdtemp
 from distutils import version
@@ -22,9 +25,14 @@ from glob import glob
 from Packages import *
 
 from BinaryBuilder import Package, Environment, PackageError, die, info,\
-     get_platform, findfile, run, get_prog_version, logger, warn, \
-     binary_builder_prefix, program_exists
-from BinaryDist import fix_install_paths, which
+     get_platform, findfile, run, logger, warn, \
+     binary_builder_prefix
+from BinaryDist import which, deploy_tarball
+from PackageStore import PackageStore, Compositions, snapshot
+from Toolchain import Toolchain
+from ObjCache import DirCache, parse_size
+from Ccache import ccache_env, debug_prefix_map, set_max_size, ccache_stats, CcacheReport, warm_cache
+from Resources import ResourceStats, MemorySampler, BuildSpace, effective_cpus, available_memory, oom_kills, tree_size
 
 CC_FLAGS = ('CFLAGS', 'CXXFLAGS')
 LD_FLAGS = ('LDFLAGS')
@@ -38,13 +46,60 @@ BUILD_GOAL_VW_DEV  = 3 # Build a VW development environment
 
 def get_cores():
     try:
-        n = os.sysconf('SC_NPROCESSORS_ONLN')
-        if n:
-            return n
-        return 2
+        return effective_cpus()
     except:
         return 2
 
+# Compile and link flags for each --debug-info mode. split leaves the DWARF
+# in .dwo files next to the objects, so the linker never sees it (DWARF 4,
+# the dwp from binutils can not pack newer split units); compressed keeps it
+# in the binaries but zlib compressed.
+DEBUG_INFO_FLAGS = dict(
+    full       = ('-g', ''),
+    split      = ('-g -gdwarf-4 -gsplit-dwarf', ''),
+    compressed = ('-g -gz', '-Wl,--compress-debug-sections=zlib'),
+    )
+
+def compiler_accepts(cc, cflags, ldflags):
+    '''Whether cc can build and link a trivial program with these flags'''
+    tmp = mkdtemp(prefix='compiler_accepts')
+    try:
+        src = P.join(tmp, 'test.c')
+        with file(src, 'w') as f:
+            f.write('int main(void) { return 0; }\n')
+        cmd = [cc] + cflags.split() + ldflags.split() + [src, '-o', P.join(tmp, 'test')]
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.call(cmd, cwd=tmp, stdout=devnull, stderr=devnull) == 0
+    except OSError:
+        return False
+    finally:
+        shutil.rmtree(tmp, True)
+
+def write_compiler_wrappers(env, wrapper_dir, db=None, time_report=False, objcache=None):
+    '''Put compiler-wrapper.py in front of CC and CXX, to profile into db
+       and/or to use the object cache. Returns the new values for them.'''
+    if not P.exists(wrapper_dir):
+        os.makedirs(wrapper_dir)
+    config = P.join(wrapper_dir, 'wrapper.json')
+    wrapper = P.join(P.abspath(P.dirname(__file__)), 'compiler-wrapper.py')
+    compilers = dict()
+    new = dict()
+    for var in ('CC', 'CXX'):
+        name = P.basename(env[var])
+        compilers[name] = [env[var]]
+        shim = P.join(wrapper_dir, name)
+        with file(shim, 'w') as f:
+            f.write('#!/bin/sh\nexec "%s" "%s" "%s" "%s" "$@"\n' % (sys.executable, wrapper, config, name))
+        os.chmod(shim, 0755)
+        new[var] = shim
+    if P.exists(config + '.objcache-down'):
+        # Give a server that was down last time another try
+        os.remove(config + '.objcache-down')
+    with file(config, 'w') as f:
+        json.dump(dict(compilers = compilers, db = db and P.abspath(db), time_report = time_report,
+                       objcache = objcache, build = time.strftime('%Y-%m-%d %H:%M:%S')), f, indent=1)
+    return new
+
 def makelink(src, dst):
     try:
         os.remove(dst)
@@ -127,13 +182,32 @@ if __name__ == '__main__':
     parser.add_option('--fetch',      action='store_const', dest='mode',         const='fetch',           help='Fetch sources only, don\'t build')
     parser.add_option('--libtoolize',                       dest='libtoolize',   default=None,            help='Value to set LIBTOOLIZE, use to override if system\'s default is bad.')
     parser.add_option('--no-ccache',  action='store_false', dest='ccache',       default=True,            help='Disable ccache')
+    parser.add_option('--ccache-dir',                       dest='ccache_dir',   default=os.environ.get('CCACHE_DIR', P.expanduser('~/.cache/BinaryBuilder/ccache')),
+                      help='The ccache directory, shared by all build roots (default: %default)')
+    parser.add_option('--ccache-size',                      dest='ccache_size',  default='20G',           help='Cap the ccache directory at this size (default: %default)')
+    parser.add_option('--ccache-warm', action='append',     dest='ccache_warm',  default=[],              help='Seed the ccache directory from a cache exported with a BaseSystem (make-dist.py --export-ccache). Can be repeated.')
+    parser.add_option('--profile-compiles', action='store_true', dest='profile_compiles', default=False,  help='Record the time and memory of every compiler run in <build root>/compiles.sqlite (see compile-report.py)')
+    parser.add_option('--objcache',                         dest='objcache',     default=None,            help='Share compiled objects with other machines through this directory, or objcache-server.py URL. "local" for a cache in the build root.')
+    parser.add_option('--objcache-size',                    dest='objcache_size', default=None,           help='Trim a directory --objcache to this size (like 50G) before building')
+    parser.add_option('--time-report', action='store_true', dest='time_report',  default=False,           help='With --profile-compiles, also keep a -ftime-report summary of each compile')
     parser.add_option('--no-fetch',   action='store_const', dest='mode',         const='nofetch',         help='Build, but do not fetch (will fail if sources are missing)')
     parser.add_option('--osx-sdk-version',                  dest='osx_sdk',      default='10.6',          help='SDK version to use. Make sure you have the SDK version before requesting it.')
     parser.add_option('--pretend',    action='store_true',  dest='pretend',      default=False,           help='Show the list of packages without actually doing anything')
     parser.add_option('--resume',     action='store_true',  dest='resume',       default=False,           help='Reuse in-progress build/install dirs')
     parser.add_option('--save-temps', action='store_true',  dest='save_temps',   default=False,           help='Save build files to check include paths')
     parser.add_option('--threads',    type='int',           dest='threads',      default=get_cores(),     help='Build threads to use')
-    parser.add_option('--fast',                             action='store_true', dest='fast',      default=False,           help='For any git package, update and build in existing directory rather than stating from scratch (may fail)')
+    parser.add_option('--jobs',       action='append',      dest='jobs',         default=[],              help='Build a package with this -j, as package=N. Can be repeated.')
+    parser.add_option('--tmpfs',                            dest='tmpfs',        default=None,            help='Build the packages that fit in this directory on a memory-backed filesystem, the rest on disk')
+    parser.add_option('--tmpfs-budget',                     dest='tmpfs_budget', default=None,            help='Use at most this much of --tmpfs, like 16G (default: all of it)')
+    parser.add_option('--retain-build', action='append',    dest='retain',       default=[],              help='Keep the build tree of this package on the tmpfs after it is installed ("all" for every package, the default with --debug-info split). Can be repeated.')
+    parser.add_option('--fast',                             action='store_true', dest='fast',      default=False,           help='Rebuild in the existing build tree: update git packages, and only reapply the changed patches of others, without configuring again if nothing configure depends on changed')
+    parser.add_option('--store',                            dest='store',        default=None,            help='Keep installed packages in this shared store, and link them in instead of rebuilding when nothing changed')
+    parser.add_option('--store-symlinks', action='store_true', dest='store_symlinks', default=False,      help='Compose the install dir from --store with symlinks instead of hard links')
+    parser.add_option('--rollback',   action='store_true',  dest='rollback',     default=False,           help='With --store, put back the packages the install dir had before the last build, and exit')
+    parser.add_option('--as-needed',                        dest='as_needed',    default=None,            help='Comma-separated packages to link with -Wl,--as-needed (or "all"), on top of the ones that ask for it')
+    parser.add_option('--trim-la',    action='store_true',  dest='trim_la',      default=False,           help='Empty dependency_libs in the installed libtool .la files of shared libraries, except for packages that need them')
+    parser.add_option('--debug-info', type='choice',        dest='debug_info',   default='full', choices=sorted(DEBUG_INFO_FLAGS.keys()),
+                      help='How to build debug info: full, split (-gsplit-dwarf, .dwo files) or compressed (-gz). make-dist.py --debug-info should match. [%default]')
     parser.add_option('--add-ld-library-path',              dest='ld_library_path', default=None,          help='This is a hack for the supercomputer that uses libstdc++ in a non-standard location. Please don\'t use this option unless you truly needed. This has the ability to corrupt our builds if you put /usr/lib or /lib as an argument.')
 
     global opt
@@ -144,6 +218,16 @@ if __name__ == '__main__':
     if opt.ccache and opt.save_temps:
         die('--save-temps was specified. Disable ccache with --no-ccache.')
 
+    if opt.rollback and opt.store is None:
+        die('--rollback needs --store')
+
+    fixed_jobs = dict()
+    for spec in opt.jobs:
+        name, _, n = spec.partition('=')
+        if not n.isdigit() or int(n) < 1:
+            die('--jobs expects package=N, got %s' % spec)
+        fixed_jobs[name] = int(n)
+
     if opt.build_root is not None and not P.exists(opt.build_root):
         os.makedirs(opt.build_root)
 
@@ -181,8 +265,8 @@ if __name__ == '__main__':
         CC       = opt.cc,
         CXX      = opt.cxx,
         F77      = opt.f77,
-        CFLAGS   = '-O3 -g',
-        CXXFLAGS = '-O3 -g',
+        CFLAGS   = '-O3',
+        CXXFLAGS = '-O3',
         LDFLAGS  = r'-Wl,-rpath,/%s' % ('a'*100),
         MAKEOPTS = '-j%s' % opt.threads,
         DOWNLOAD_DIR = opt.download_dir,
@@ -197,6 +281,46 @@ if __name__ == '__main__':
     if opt.ld_library_path is not None:
         build_env['LD_LIBRARY_PATH'] = opt.ld_library_path
 
+    if opt.as_needed is not None:
+        build_env['AS_NEEDED'] = opt.as_needed
+
+    if opt.trim_la:
+        build_env['TRIM_LA'] = '1'
+
+    arch = get_platform()
+
+    if not P.exists(build_env['MISC_DIR']):
+        os.makedirs(build_env['MISC_DIR'])
+    toolchain = Toolchain(P.join(build_env['MISC_DIR'], 'toolchain.json'))
+
+    # Verify we have the executables we need, all in one scan of the PATH
+    common_exec = ["make", "tar", "ln", "autoreconf", "cp", "sed", "bzip2", "unzip", "patch", "csh", "git", "svn", "wget", "curl"]
+    if arch.os == 'linux':
+        common_exec.extend( ["libtool"] )
+    else:
+        common_exec.extend( ["glibtool", "install_name_tool"] )
+    acceptable_fortran_compilers = [build_env['F77'],'g77']
+    for i in range(0,10):
+        acceptable_fortran_compilers.append("gfortran-mp-4.%s" % i)
+    found = toolchain.resolve(common_exec + [build_env['CC'], build_env['CXX']] + acceptable_fortran_compilers)
+
+    # Deal with the Fortran compiler
+    if found[build_env['F77']] is None:
+        for compiler in acceptable_fortran_compilers:
+            if found[compiler] is not None:
+                print("Found fortran at: %s" % found[compiler])
+                build_env['F77'] = compiler
+                break
+
+    compiler_exec = [ build_env['CC'],build_env['CXX'],build_env['F77'] ]
+    missing_exec = toolchain.preflight(common_exec, compiler_exec)
+    if missing_exec:
+        die('Missing required executables for building. You need to install %s.' % missing_exec)
+
+    toolchain_id = toolchain.fingerprint(compiler_exec)
+    build_env['BB_TOOLCHAIN'] = toolchain_id
+    toolchain.save()
+
     # Bugfix, add compiler's libraries to LD_LIBRARY_PATH.
     comp_path = which(build_env['CC'])
     libdir1 = P.join(P.dirname(P.dirname(comp_path)), "lib")
@@ -205,23 +329,21 @@ if __name__ == '__main__':
         build_env['LD_LIBRARY_PATH'] = ""
     build_env['LD_LIBRARY_PATH'] += ":" + libdir1 + ":" + libdir2
 
-    arch = get_platform()
-
     # Check compiler version for compilers we hate
-    output = run(build_env['CC'],'--version')
+    output = toolchain.version_output(build_env['CC'])
     if 'gcc' in build_env['CC']:
         output = output.lower()
         if "llvm" in output or "clang" in output:
             die('Your compiler is an LLVM-GCC hybrid. It is our experience that these tools can not compile Vision Workbench and Stereo Pipeline correctly. Please change your compiler choice.')
 
     #if arch.os == 'linux':
-    ver1 = get_prog_version(build_env['CC'])
-    ver2 = get_prog_version(build_env['CXX'])
+    ver1 = toolchain.version(build_env['CC'])
+    ver2 = toolchain.version(build_env['CXX'])
     if ver1 < MIN_CC_VERSION or ver2 < MIN_CC_VERSION:
         die('Expecting gcc and g++ version >= ' + str(MIN_CC_VERSION))
         
     if arch.os == 'linux':
-        build_env.append('LDFLAGS', '-Wl,-O1 -Wl,--enable-new-dtags -Wl,--hash-style=both')
+        build_env.append('LDFLAGS', '-Wl,-O1 -Wl,--enable-new-dtags -Wl,--hash-style=both -Wl,--build-id')
         build_env.append_many(ALL_FLAGS, '-m%i' % arch.bits)
 
     elif arch.os == 'osx':
@@ -257,6 +379,16 @@ if __name__ == '__main__':
         if ver >= '10.6' and opt.osx_sdk == '10.5':
             build_env.append('LDFLAGS', '-Wl,-no_compact_linkedit')
 
+    debug_cflags, debug_ldflags = DEBUG_INFO_FLAGS[opt.debug_info]
+    if opt.debug_info != 'full' and not compiler_accepts(build_env['CC'], debug_cflags, debug_ldflags):
+        warn('%s does not support --debug-info=%s, using full debug info' % (build_env['CC'], opt.debug_info))
+        opt.debug_info = 'full'
+        debug_cflags, debug_ldflags = DEBUG_INFO_FLAGS[opt.debug_info]
+    build_env.append_many(CC_FLAGS, debug_cflags)
+    if debug_ldflags:
+        build_env.append('LDFLAGS', debug_ldflags)
+    build_env['DEBUG_INFO'] = opt.debug_info
+
     # if arch.osbits == 'linux32':
     #     limit_symbols = P.join(P.abspath(P.dirname(__file__)), 'glibc24.h')
     #     build_env.append('CPPFLAGS', '-include %s' % limit_symbols)
@@ -265,22 +397,7 @@ if __name__ == '__main__':
     if not P.exists(compiler_dir):
         os.makedirs(compiler_dir)
 
-    # Deal with the Fortran compiler
-    try:
-        findfile(build_env['F77'], build_env['PATH'])
-    except Exception:
-        acceptable_fortran_compilers = [build_env['F77'],'g77']
-        for i in range(0,10):
-            acceptable_fortran_compilers.append("gfortran-mp-4.%s" % i)
-        for compiler in acceptable_fortran_compilers:
-            try:
-                gfortran_path = findfile(compiler, build_env['PATH'])
-                print("Found fortran at: %s" % gfortran_path)
-                build_env['F77'] = compiler
-                break
-            except Exception:
-                pass
-    ver = get_prog_version(build_env['F77'])
+    ver = toolchain.version(build_env['F77'])
     if ver < MIN_CC_VERSION:
         die('Expecting ' + build_env['F77'] + ' version >= ' + str(MIN_CC_VERSION))
 
@@ -294,24 +411,6 @@ if __name__ == '__main__':
     if opt.libtoolize is not None:
         build_env['LIBTOOLIZE'] = opt.libtoolize
 
-    # Verify we have the executables we need
-    common_exec = ["make", "tar", "ln", "autoreconf", "cp", "sed", "bzip2", "unzip", "patch", "csh", "git", "svn", "wget", "curl"]
-    compiler_exec = [ build_env['CC'],build_env['CXX'],build_env['F77'] ]
-    if arch.os == 'linux':
-        common_exec.extend( ["libtool"] )
-    else:
-        common_exec.extend( ["glibtool", "install_name_tool"] )
-
-    missing_exec = []
-    for program in common_exec:
-        if not program_exists(program):
-            missing_exec.append(program)
-    for program in compiler_exec:
-        check_help = True
-        if not program_exists(program, check_help):
-            missing_exec.append(program)
-    if missing_exec:
-        die('Missing required executables for building. You need to install %s.' % missing_exec)
 
     build = []
     
@@ -365,8 +464,11 @@ if __name__ == '__main__':
     if opt.base and not opt.resume:
         print('Untarring base system')
         for base in opt.base:
-            run('tar', 'xf', base, '-C', build_env['INSTALL_DIR'], '--strip-components', '1')
-        fix_install_paths(build_env['INSTALL_DIR'], arch)
+            deploy_tarball(base, build_env['INSTALL_DIR'], arch)
+
+    if opt.ccache and opt.debug_info == 'split':
+        warn('ccache does not cache the .dwo files of --debug-info split, building without it')
+        opt.ccache = False
 
     # This must happen after untarring the base system,
     # as perhaps cache will be found there.
@@ -388,6 +490,32 @@ if __name__ == '__main__':
         subprocess.check_call(['ln', '-sf', ccache_path, new['CC']])
         subprocess.check_call(['ln', '-sf', ccache_path, new['CXX']])
         build_env.update(new)
+        build_env.update(ccache_env(opt.ccache_dir, opt.build_root))
+        if '-g' in debug_cflags.split():
+            build_env.append_many(CC_FLAGS, debug_prefix_map(opt.build_root))
+        for tarball in opt.ccache_warm:
+            print('Seeding %s from %s' % (opt.ccache_dir, tarball))
+            warm_cache(tarball, opt.ccache_dir)
+        set_max_size(ccache_path, build_env, opt.ccache_size)
+
+    objcache = None
+    if opt.objcache is not None and opt.mode != 'fetch':
+        where = opt.objcache
+        if where == 'local':
+            where = P.join(opt.build_root, 'objcache')
+        elif not re.match(r'^https?://', where):
+            where = P.abspath(where)
+        if opt.objcache_size is not None and not re.match(r'^https?://', where):
+            print('Trimmed %d objects from %s' % (DirCache(where).trim(parse_size(opt.objcache_size)), where))
+        objcache = dict(where = where, fingerprint = toolchain_id)
+
+    # Goes in front of ccache, so cache hits get recorded as such
+    if opt.profile_compiles or objcache is not None:
+        db = None
+        if opt.profile_compiles:
+            db = P.join(opt.build_root, 'compiles.sqlite')
+        build_env.update(write_compiler_wrappers(build_env, P.join(build_env['MISC_DIR'], 'compiler-wrappers'),
+                                                 db, opt.time_report, objcache))
 
     modes = dict(
         all     = lambda pkg : Package.build(pkg, skip_fetch=False),
@@ -396,24 +524,109 @@ if __name__ == '__main__':
 
     # Build the packages, skipping the ones already done
     done_file = opt.build_root + "/done.txt"
+
+    store = None
+    if opt.store is not None and opt.mode != 'fetch':
+        store = PackageStore(opt.store)
+        compositions = Compositions(opt.build_root)
+        if opt.rollback:
+            print('Rolling back %s' % build_env['INSTALL_DIR'])
+            entries = compositions.rollback(store, build_env['INSTALL_DIR'], opt.store_symlinks)
+            write_done(dict((e['name'], e['chksum']) for e in entries), done_file)
+            sys.exit(0)
+        compositions.start()
+
     done = read_done(done_file)
+    resources = ResourceStats(opt.build_root)
+    space = None
+    if opt.tmpfs is not None and opt.mode != 'fetch':
+        tmpfs = P.abspath(opt.tmpfs)
+        if not P.isdir(tmpfs):
+            os.makedirs(tmpfs)
+        if opt.tmpfs_budget is not None:
+            budget = parse_size(opt.tmpfs_budget)
+        else:
+            st = os.statvfs(tmpfs)
+            budget = st.f_blocks * st.f_frsize
+        space = BuildSpace(build_env['BUILD_DIR'], tmpfs, budget, resources)
+    ccache_report = CcacheReport(opt.build_root)
+    built = []
+    key = ''
     try:
         for pkg in build:
             name = pkg.__name__
+            if store is not None:
+                key = store.key(name, get_chksum(name), build_env, key, toolchain_id)
             if name in done:
                 print("Package %s was already built, skipping" % name)
                 continue
+            if store is not None:
+                if store.has(name, key):
+                    print("Package %s is in the store, linking it" % name)
+                    store.compose(build_env['INSTALL_DIR'], [store.entry(name, key)], opt.store_symlinks)
+                    compositions.set(name, key)
+                    done[name] = get_chksum(name)
+                    write_done(done, done_file)
+                    continue
+                before = snapshot(build_env['INSTALL_DIR'])
             print("\n========== Building: %s ==========" % name)
+            jobs = opt.threads
+            memory = available_memory()
+            if name in fixed_jobs:
+                jobs = fixed_jobs[name]
+            elif pkg.jobs is not None:
+                jobs = pkg.jobs
+            elif opt.mode != 'fetch':
+                jobs, why = resources.jobs(name, opt.threads, memory)
+                if why is not None:
+                    print('Building %s with -j%d: %s' % (name, jobs, why))
+            build_dir = build_env['BUILD_DIR']
+            if space is not None:
+                build_dir = space.place(name)
             # Make several attempts, perhaps the servers are down.
             num=10
             for i in range(0,num):
+                sampler = MemorySampler()
+                ooms = oom_kills()
+                cached = ccache_stats(ccache_path, build_env) if opt.ccache and opt.mode != 'fetch' else None
                 try:
                     # Build
-                    modes[opt.mode](pkg(build_env.copy_set_default()))
+                    env = build_env.copy_set_default()
+                    env['MAKEOPTS'] = '-j%d' % jobs
+                    env['BB_PACKAGE'] = name
+                    env['BUILD_DIR'] = build_dir
+                    if opt.mode != 'fetch':
+                        sampler.start()
+                    instance = pkg(env)
+                    modes[opt.mode](instance)
+                    if sampler.is_alive():
+                        sampler.stop()
+                        resources.record(name, jobs, sampler, stages=instance.stage_times)
+                        tree = P.join(build_dir, name)
+                        if P.isdir(tree):
+                            resources.record_footprint(name, tree_size(tree))
+                        # Split debug info stays in the .dwo files of the build
+                        # tree, where make-dist.py packs it from
+                        if build_dir != build_env['BUILD_DIR'] and opt.debug_info != 'split' and \
+                           not (opt.fast or name in opt.retain or 'all' in opt.retain):
+                            space.evict(name)
+                        for stage in ('configure', 'compile', 'install'):
+                            t = instance.stage_times.get(stage)
+                            if t is not None and t['wall'] > 0:
+                                print('%10s: %7.1fs wall, %7.1fs CPU, %.1f of -j%d busy'
+                                      % (stage, t['wall'], t['cpu'], t['cpu'] / t['wall'], jobs))
+                    if cached is not None:
+                        delta = ccache_report.record(name, cached, ccache_stats(ccache_path, build_env))
+                        if delta is not None:
+                            print('    ccache: %(hits)d hits, %(misses)d misses' % delta)
+                    built.append(name)
                     # Mark as done
                     name = pkg.__name__
                     chksum = get_chksum(name)
                     done[name] = chksum
+                    if store is not None:
+                        store.ingest(name, key, chksum, build_env['INSTALL_DIR'], before)
+                        compositions.set(name, key)
                     # Save the status after each package was built,
                     # in case the process gets interrupted.
                     write_done(done, done_file)
@@ -421,6 +634,25 @@ if __name__ == '__main__':
                 except Exception, e:
                     print("Failed to build %s in attempt %d %s" %
                           (name, i, str(e)))
+                    if sampler.is_alive():
+                        sampler.stop()
+                    if build_dir != build_env['BUILD_DIR'] and space.full():
+                        resources.record_footprint(name, tree_size(P.join(build_dir, name)), complete=False)
+                        space.evict(name)
+                        build_dir = build_env['BUILD_DIR']
+                        print("%s ran out of space on the tmpfs, trying again on disk" % name)
+                        continue
+                    # Out of memory if the kernel killed something, or if
+                    # we can not tell and the build got close to the limit
+                    now = oom_kills()
+                    oom = (now > ooms) if now is not None and ooms is not None \
+                          else (memory is not None and sampler.peak > 0.9 * memory)
+                    if oom and opt.mode != 'fetch':
+                        resources.record(name, jobs, sampler, oom=True)
+                        if jobs > 1:
+                            jobs = max(1, jobs // 2)
+                            print("%s ran out of memory, trying again with -j%d" % (name, jobs))
+                            continue
                     raise
                     #if i < num-1:
                     #    print("Sleep for 60 seconds and try again")
@@ -434,4 +666,9 @@ if __name__ == '__main__':
     makelink(opt.build_root, 'last-completed-run')
 
     info('\n\nAll done!')
+    if built and opt.ccache:
+        lines = ccache_report.summary(built)
+        if lines:
+            print('\n===== ccache =====')
+            print('\n'.join(lines))
     summary(build_env)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import sys
+code = -1
+# Must have this check before importing other BB modules
+if sys.version_info < (2, 6, 1):
+    print('\nERROR: Must use Python 2.6.1 or greater.')
+    sys.exit(code)
+
+import logging
+import os.path as P
+from optparse import OptionParser
+from BinaryBuilder import die
+from ChunkStore import ChunkStore
+
+usage = '''%prog [options] <store> <command> [args]
+
+Commands:
+  publish <tarball> [name]     Add a dist tarball to the store
+  fetch <source store> <name>  Copy a dist, and only the chunks we lack, from
+                               another store (a directory or an http URL)
+  checkout <name>              Rebuild the tarball (--tarball) or unpack it (-C)
+  list                         List the dists in the store
+  verify <name>                Check that the chunks of a dist are all there
+                               and match their digests
+  gc                           Keep the newest --keep dists, delete unused chunks'''
+
+if __name__ == '__main__':
+    parser = OptionParser(usage=usage)
+    parser.add_option('--tarball', dest='tarball', default=None, help='checkout: write the tarball here')
+    parser.add_option('-C', '--directory', dest='directory', default=None, help='checkout: unpack into this directory')
+    parser.add_option('--strip-components', dest='strip', default=0, type='int', help='checkout: strip leading path components when unpacking')
+    parser.add_option('--compress-level', dest='level', default=None, type='int', help='publish: the compression level the tarball was made with, if not the default')
+    parser.add_option('--keep',    dest='keep',   default=8, type='int', help='gc: how many dists to keep (default: %default)')
+    parser.add_option('--prefix',  dest='prefix', default='', help='gc: only consider dists whose name starts with this')
+    parser.add_option('--debug',   dest='loglevel', default=logging.INFO, action='store_const', const=logging.DEBUG, help='Turn on debug messages')
+
+    (opt, args) = parser.parse_args()
+    logging.basicConfig(level=opt.loglevel, format='%(message)s')
+
+    if len(args) < 2:
+        parser.print_help()
+        die('\nMissing required arguments: store and command')
+
+    store = ChunkStore(args[0])
+    command, args = args[1], args[2:]
+    if command == 'publish' and len(args) in (1, 2):
+        store.publish(P.realpath(args[0]), args[1] if len(args) > 1 else None, opt.level)
+    elif command == 'fetch' and len(args) == 2:
+        store.fetch(args[0], args[1])
+    elif command == 'checkout' and len(args) == 1:
+        if opt.tarball is None and opt.directory is None:
+            die('checkout needs --tarball and/or --directory')
+        store.checkout(args[0], opt.tarball, opt.directory, opt.strip)
+    elif command == 'list' and not args:
+        for name in store.names():
+            m = store.manifest(name)
+            print('%-70s %8.1f MB %6d chunks' % (name, m['size'] / 1e6, len(m['chunks'])))
+    elif command == 'verify' and len(args) == 1:
+        bad = store.verify(args[0])
+        if bad:
+            die('%s: %d chunks missing or corrupt:\n%s' % (args[0], len(bad), '\n'.join(bad)))
+        print('%s: all chunks intact' % args[0])
+    elif command == 'gc' and not args:
+        store.gc(opt.keep, opt.prefix)
+    else:
+        parser.print_help()
+        die('\nUnknown command or wrong number of arguments: %s' % ' '.join([command] + args))
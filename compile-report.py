@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import sys
+code = -1
+# Must have this check before importing other BB modules
+if sys.version_info < (2, 6, 1):
+    print('\nERROR: Must use Python 2.6.1 or greater.')
+    sys.exit(code)
+
+import sqlite3
+import os.path as P
+from optparse import OptionParser
+from BinaryBuilder import die
+
+''' Summarize the compiles recorded by build.py --profile-compiles: per
+    package, the time spent compiling and linking, and the translation
+    units that took longest and needed the most memory. Compiles taken
+    from the object cache (build.py --objcache) are counted as cached.
+
+      ./compile-report.py build_asp/compiles.sqlite --package visionworkbench
+'''
+
+def short(path, width=70):
+    if path is None:
+        return '-'
+    return path if len(path) <= width else '...' + path[-(width - 3):]
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%s [options] <compiles.sqlite>' % sys.argv[0])
+    parser.add_option('--top',     dest='top',     default=10, type='int', help='Translation units to list per package (default: %default)')
+    parser.add_option('--package', dest='packages', default=[], action='append', help='Only report on this package. Can be repeated.')
+    parser.add_option('--build',   dest='build',   default=None, help='Which build to report on, by its start time (default: the last one)')
+    parser.add_option('--all-builds', dest='all_builds', default=False, action='store_true', help='Report on every build in the database')
+    parser.add_option('--time-report', dest='time_report', default=False, action='store_true', help='Show the -ftime-report summary of the slowest units')
+
+    (opt, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        die('\nMissing required argument: database')
+    if not P.exists(args[0]):
+        die('No such database: %s' % args[0])
+
+    db = sqlite3.connect(args[0])
+    where, params = ['1'], []
+    if not opt.all_builds:
+        build = opt.build
+        if build is None:
+            build = db.execute('SELECT MAX(build) FROM compiles').fetchone()[0]
+        where.append('build = ?')
+        params.append(build)
+        print('Build of %s' % build)
+    if opt.packages:
+        where.append('package IN (%s)' % ','.join('?' * len(opt.packages)))
+        params += opt.packages
+    # Configure tests are not what we want to speed up
+    where.append("(source IS NULL OR source NOT LIKE '%/conftest.%')")
+    where = ' AND '.join(where)
+
+    totals = db.execute('''SELECT package, mode, COUNT(*), SUM(wall), SUM(cpu), MAX(maxrss)
+                           FROM compiles WHERE %s GROUP BY package, mode''' % where, params).fetchall()
+    packages = dict()
+    for package, mode, count, wall, cpu, maxrss in totals:
+        packages.setdefault(package, dict())[mode] = (count, wall, cpu, maxrss)
+    if not packages:
+        die('Nothing recorded for that selection')
+
+    order = sorted(packages, key=lambda p: -sum(v[2] for v in packages[p].values()))
+    print('\n%-20s %8s %8s %12s %8s %12s %10s' % ('package', 'compiles', 'cached', 'compile CPU', 'links', 'link wall', 'max MB'))
+    for package in order:
+        c = packages[package].get('compile', (0, 0, 0, 0))
+        l = packages[package].get('link', (0, 0, 0, 0))
+        cached = packages[package].get('cached', (0,))[0]
+        print('%-20s %8d %8d %11.0fs %8d %11.0fs %10.0f'
+              % (package, c[0], cached, c[2] or 0, l[0], l[1] or 0, max(c[3], l[3]) / 1e6))
+
+    for package in order:
+        print('\n===== %s =====' % package)
+        for title, column in (('Slowest', 'wall'), ('Most memory', 'maxrss')):
+            rows = db.execute('''SELECT source, output, mode, wall, cpu, maxrss, time_report FROM compiles
+                                 WHERE %s AND package IS ? AND mode IN ('compile', 'link')
+                                 ORDER BY %s DESC LIMIT ?''' % (where, column), params + [package, opt.top]).fetchall()
+            print('%s:' % title)
+            for source, output, mode, wall, cpu, maxrss, report in rows:
+                what = source if mode == 'compile' else '(link) %s' % output
+                print('  %7.1fs %7.1fs CPU %7.0f MB  %s' % (wall, cpu, maxrss / 1e6, short(what)))
+                if opt.time_report and report and column == 'wall':
+                    for line in report.splitlines():
+                        print('            %s' % line)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+''' Runs a compiler and records what it cost. build.py --profile-compiles
+    puts a small shell script in front of CC and CXX that execs this with
+    the path of its config and the compiler it stands for:
+
+      compiler-wrapper.py <config.json> <name> <compiler args...>
+
+    The config (written by build.py) holds the command that really runs
+    the compiler (the ccache link, or the compiler itself), the sqlite
+    database to record into, whether to add -ftime-report, and the shared
+    object cache to look compiles up in (see ObjCache.py).
+
+    For each invocation the database gets the package (BB_PACKAGE, set by
+    build.py), the source file, the output and its size, the wall and CPU
+    time and the peak memory of the compiler and everything it ran. See
+    compile-report.py. Compiles found in the object cache are recorded
+    with mode "cached".
+
+    This runs for every compile, so it only imports what it needs, and it
+    never fails a build because of the profiling or the cache.
+'''
+
+import sys, os, re, time, json, sqlite3
+
+SOURCE_EXTS = ('.c', '.cc', '.cp', '.cpp', '.cxx', '.c++', '.C', '.m', '.mm',
+               '.f', '.for', '.f77', '.f90', '.F', '.F90')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS compiles (
+    build       TEXT,
+    package     TEXT,
+    compiler    TEXT,
+    mode        TEXT,
+    source      TEXT,
+    output      TEXT,
+    cwd         TEXT,
+    started     REAL,
+    wall        REAL,
+    cpu         REAL,
+    maxrss      INTEGER,
+    output_size INTEGER,
+    status      INTEGER,
+    time_report TEXT
+)'''
+
+def describe(args):
+    '''The mode (compile, preprocess, link), sources and output of a
+       compiler command line'''
+    mode = 'link'
+    sources = []
+    output = None
+    i = 0
+    while i < len(args):
+        a = args[i]
+        if a == '-o' and i + 1 < len(args):
+            output = args[i + 1]
+            i += 1
+        elif a.startswith('-o') and len(a) > 2:
+            output = a[2:]
+        elif a in ('-c', '-S'):
+            mode = 'compile'
+        elif a == '-E':
+            mode = 'preprocess'
+        elif not a.startswith('-') and a.endswith(SOURCE_EXTS):
+            sources.append(a)
+        i += 1
+    if mode == 'compile' and output is None and len(sources) == 1:
+        output = os.path.splitext(os.path.basename(sources[0]))[0] + '.o'
+    return mode, sources, output
+
+# The report starts with one of these, GCC 9 and later with the first
+REPORT_HEADERS = ('Time variable', 'Execution times (seconds)')
+
+# Before GCC 9 each time has its label after it ("0.75 (38%) wall"), later
+# ones have usr, sys and wall columns with no labels
+LABELLED_WALL = re.compile(r'([\d.]+)\s*\(\s*\d+\s*%\)\s*wall')
+
+def time_report_summary(err):
+    '''The TOTAL line and the five slowest phases of -ftime-report'''
+    phases = []
+    total = None
+    for line in err.splitlines():
+        line = line.strip()
+        if line.startswith('TOTAL'):
+            total = line
+        elif ':' in line and '(' in line and 'wall' not in line.split(':', 1)[0]:
+            name, _, rest = line.partition(':')
+            m = LABELLED_WALL.search(rest)
+            try:
+                if m:
+                    wall = float(m.group(1))
+                else:
+                    # usr, sys and wall are each "seconds ( percent)"
+                    numbers = rest.replace('(', ' ').replace(')', ' ').replace('%', ' ').split()
+                    wall = float(numbers[4])
+            except (IndexError, ValueError):
+                continue
+            phases.append((wall, name.strip()))
+    if total is None:
+        return None
+    phases.sort(reverse=True)
+    return '\n'.join([total] + ['%s: %.2fs' % (name, wall) for wall, name in phases[:5]])
+
+def record(config, row):
+    if not config.get('db'):
+        return
+    try:
+        db = sqlite3.connect(config['db'], timeout=60)
+        try:
+            db.execute(SCHEMA)
+            db.execute('INSERT INTO compiles VALUES (%s)' % ','.join('?' * len(row)), row)
+            db.commit()
+        finally:
+            db.close()
+    except Exception, e:
+        sys.stderr.write('compiler-wrapper: could not record to %s: %s\n' % (config['db'], e))
+
+def main():
+    with open(sys.argv[1], 'r') as f:
+        config = json.load(f)
+    name = sys.argv[2]
+    args = sys.argv[3:]
+    compiler = list(config['compilers'][name])
+    cmd  = compiler + args
+
+    mode, sources, output = describe(args)
+    source = sources[-1] if sources else None
+    report = config.get('time_report') and mode == 'compile'
+
+    started = time.time()
+    cache, key = None, None
+    objcache = config.get('objcache')
+    if objcache:
+        try:
+            import ObjCache
+            if ObjCache.cacheable(args, mode, sources, output):
+                cache = ObjCache.open_cache(objcache['where'], sys.argv[1] + '.objcache-down')
+                key = ObjCache.object_key(compiler, name, args, sources, objcache['fingerprint'], output)
+                data = cache.get(key) if key is not None else None
+                if data is not None:
+                    ObjCache.write_atomic(output, data)
+                    times = os.times()
+                    record(config, (config.get('build'), os.environ.get('BB_PACKAGE'), name, 'cached',
+                                    os.path.abspath(source), os.path.abspath(output), os.getcwd(),
+                                    started, time.time() - started, times[2] + times[3], None, len(data), 0, None))
+                    return 0
+        except Exception, e:
+            sys.stderr.write('compiler-wrapper: object cache: %s\n' % e)
+            cache, key = None, None
+
+    if report:
+        cmd.append('-ftime-report')
+    r_fd, w_fd = None, None
+    if report:
+        r_fd, w_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        if w_fd is not None:
+            os.close(r_fd)
+            os.dup2(w_fd, 2)
+            os.close(w_fd)
+        try:
+            os.execvp(cmd[0], cmd)
+        finally:
+            os._exit(127)
+    err = ''
+    if r_fd is not None:
+        os.close(w_fd)
+        with os.fdopen(r_fd, 'r') as f:
+            err = f.read()
+    pid, status, usage = os.wait4(pid, 0)
+    wall = time.time() - started
+    if os.WIFEXITED(status):
+        code = os.WEXITSTATUS(status)
+    else:
+        code = 128 + os.WTERMSIG(status)
+
+    summary = None
+    if report:
+        summary = time_report_summary(err)
+        # Pass on the diagnostics, but not the report itself
+        cuts = [0 if err.startswith(h) else err.find('\n' + h) for h in REPORT_HEADERS]
+        cuts = [c for c in cuts if c != -1]
+        sys.stderr.write(err[:min(cuts)] if cuts else err)
+
+    maxrss = usage.ru_maxrss
+    if sys.platform != 'darwin':
+        maxrss *= 1024 # kB on Linux, bytes on OS X
+    size = None
+    if code == 0 and output is not None and os.path.isfile(output):
+        size = os.path.getsize(output)
+    if key is not None and code == 0 and os.path.isfile(output):
+        try:
+            with open(output, 'rb') as f:
+                cache.put(key, f.read())
+        except Exception, e:
+            sys.stderr.write('compiler-wrapper: object cache: %s\n' % e)
+    record(config, (config.get('build'), os.environ.get('BB_PACKAGE'), name, mode,
+                    source and os.path.abspath(source), output and os.path.abspath(output), os.getcwd(),
+                    started, wall, usage.ru_utime + usage.ru_stime, maxrss, size, code, summary))
+    return code
+
+if __name__ == '__main__':
+    sys.exit(main())
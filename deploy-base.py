@@ -18,7 +18,7 @@ import string
 from optparse import OptionParser
 from BinaryBuilder import get_platform, die, run, Apps, \
      write_vw_config, write_asp_config
-from BinaryDist import fix_install_paths
+from BinaryDist import fix_install_paths, deploy_tarball
 from Packages import geoid
 from glob import glob
 
@@ -36,7 +36,7 @@ if __name__ == '__main__':
     parser.add_option('--debug',       dest='loglevel',  default=logging.INFO, action='store_const', const=logging.DEBUG, help='Turn on debug messages')
     parser.add_option("--skip-extracting-tarball",
                       action="store_true", dest="skip_extraction", default=False,
-                      help="Skip the time-consuming tarball extraction (for debugging purposes)")
+                      help="Only relocate an already extracted tarball (for debugging purposes)")
 
     global opt
     (opt, args) = parser.parse_args()
@@ -53,12 +53,12 @@ if __name__ == '__main__':
         usage('Invalid installdir %s (not a directory)' % installdir, code)
     logging.basicConfig(level=opt.loglevel)
 
-    if not opt.skip_extraction:
-        print('Extracting tarball')
-        run('tar', 'xf', tarball, '-C', installdir, '--strip-components', '1')
-
     arch = get_platform()
-    fix_install_paths(installdir, arch)
+    if opt.skip_extraction:
+        fix_install_paths(installdir, arch)
+    else:
+        print('Extracting and relocating tarball')
+        deploy_tarball(tarball, installdir, arch)
 
     # Replace /home/user with $HOME, looks nicer in the output
     vardir = installdir
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import sys
+code = -1
+# Must have this check before importing other BB modules
+if sys.version_info < (2, 6, 1):
+    print('\nERROR: Must use Python 2.6.1 or greater.')
+    sys.exit(code)
+
+import os, logging
+import os.path as P
+from optparse import OptionParser
+from BinaryBuilder import die
+from BinaryDist import SeekableTarball, mkdir_f
+
+''' Pull individual files out of a seekable dist tarball (see make-dist.py
+    --seekable) without decompressing the rest of it. The tarball may be a
+    local file or an http(s) URL on the artifact server.
+
+    Examples:
+      ./extract-dist.py StereoPipeline-X.tar.bz2 --deps bin/point2dem
+      ./extract-dist.py http://host/StereoPipeline-X.tar.bz2 'lib/libvw*'
+'''
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%s [options] tarball [pattern ...]' % sys.argv[0])
+    parser.add_option('-C', '--directory', dest='dest', default='.', help='Extract into this directory')
+    parser.add_option('--deps',    dest='deps',    default=False, action='store_true',
+                      help='Also extract the libraries and helper scripts the selected programs need')
+    parser.add_option('--list',    dest='list',    default=False, action='store_true', help='List the matching members instead of extracting them')
+    parser.add_option('--strip-components', dest='strip', default=0, type='int', help='Strip this many leading path components')
+    parser.add_option('--debug',   dest='loglevel', default=logging.INFO, action='store_const', const=logging.DEBUG, help='Turn on debug messages')
+
+    (opt, args) = parser.parse_args()
+    if not args:
+        parser.print_help()
+        die('\nMissing required argument: tarball')
+    logging.basicConfig(level=opt.loglevel)
+
+    location = args[0]
+    if not (location.startswith('http://') or location.startswith('https://')):
+        location = P.realpath(location)
+        if not P.exists(location + '.index'):
+            die('Missing %s.index. Was the tarball made with make-dist.py --seekable?' % location)
+
+    archive = SeekableTarball(location)
+    patterns = args[1:] or ['*']
+    names = archive.select(patterns, with_deps=opt.deps)
+    if not names:
+        die('Nothing in %s matches %s' % (location, ' '.join(patterns)))
+
+    if opt.list:
+        for name in names:
+            print(name)
+        sys.exit(0)
+
+    mkdir_f(opt.dest)
+    archive.extract(names, opt.dest, opt.strip)
+    print('Extracted %d files into %s' % (len(names), P.realpath(opt.dest)))
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import sys
+code = -1
+# Must have this check before importing other BB modules
+if sys.version_info < (2, 6, 1):
+    print('\nERROR: Must use Python 2.6.1 or greater.')
+    sys.exit(code)
+
+import os, re
+import os.path as P
+from optparse import OptionParser
+from BinaryBuilder import die
+
+''' Find the headers that cost the most to compile, across package builds.
+
+    Reads, from each build directory given:
+      *.ii, *.i   preprocessed output (build.py --save-temps), which gives
+                  the exact bytes each header adds to every unit
+      *.d, *.Po   dependency files (-MD, or automake's .deps), only which
+                  headers each unit uses. A unit that also has
+                  preprocessed output (same source) is only counted once.
+      --trace F   the stderr of a build with -H, the include tree of each
+                  unit
+    For the last two the size of a header on disk stands in for what it
+    adds to the preprocessed output.
+
+    The report has, for each header, how many units include it, how often
+    it is included, and the bytes it and everything it includes add up to
+    over all units. Headers are also totalled by the include directory
+    they were found in and by library, with the most expensive boost, eigen
+    and qt headers listed on their own. That is where a precompiled header
+    or an include cleanup pays off.
+
+      ./build.py --save-temps visionworkbench stereopipeline
+      ./include-graph.py build_asp/build/visionworkbench build_asp/build/stereopipeline
+'''
+
+LINEMARKER = re.compile(r'^# (\d+) "(.*)"((?: \d)*)\s*$')
+LIBRARIES  = ('boost', 'eigen', 'qt')
+
+class Include(object):
+    '''One inclusion of a header in a unit'''
+    __slots__ = ('depth', 'path', 'size')
+    def __init__(self, depth, path, size=0):
+        self.depth = depth
+        self.path  = path
+        self.size  = size
+
+def include_dir(path):
+    '''The directory of the header search path a header was found in'''
+    i = path.rfind('/include/')
+    if i != -1:
+        return path[:i + len('/include')]
+    return P.dirname(path)
+
+def library(path):
+    '''Which library a header belongs to, going by where it is installed'''
+    rest = path[len(include_dir(path)) + 1:]
+    if '/' not in rest:
+        return '(top level)'
+    top = rest.split('/')[0]
+    if top.startswith('boost'):
+        return 'boost'
+    if top in ('eigen3', 'Eigen', 'unsupported'):
+        return 'eigen'
+    if top.startswith('Qt') or top in ('qt4', 'qt5'):
+        return 'qt'
+    return top
+
+def parse_preprocessed(filename):
+    '''The source of a unit and its includes, from the linemarkers of its
+       preprocessed output, with the bytes each one added itself. The
+       source is None for a file with no linemarkers, which is not
+       preprocessed output (a SWIG interface, say).'''
+    source = None
+    includes = []
+    stack = []
+    with open(filename, 'r') as f:
+        for line in f:
+            if line.startswith('# '):
+                m = LINEMARKER.match(line)
+                if m:
+                    if source is None:
+                        source = P.normpath(m.group(2))
+                    flags = m.group(3).split()
+                    if '1' in flags:
+                        inc = Include(len(stack) + 1, P.normpath(m.group(2)))
+                        includes.append(inc)
+                        stack.append(inc)
+                    elif '2' in flags and stack:
+                        stack.pop()
+                    continue
+            if stack:
+                stack[-1].size += len(line)
+    return source, includes
+
+def parse_depfile(filename):
+    '''The headers of each unit in a make dependency file. They are all
+       taken as included by the unit itself.'''
+    with open(filename, 'r') as f:
+        text = f.read().replace('\\\n', ' ')
+    units = []
+    for rule in text.splitlines():
+        target, sep, deps = rule.partition(': ')
+        deps = deps.split()
+        if not sep or not deps or target.endswith(':'):
+            continue
+        # The first prerequisite is the source, the rest are headers. A
+        # rule with no recipe of its own (from -MP) has no source.
+        if not re.search(r'\.(c|cc|cp|cpp|cxx|c\+\+|C|m|mm)$', deps[0]):
+            continue
+        units.append((P.normpath(deps[0]), [Include(1, P.normpath(d)) for d in deps[1:]]))
+    return units
+
+def parse_trace(filename):
+    '''The include trees printed by -H, one unit after another'''
+    units = []
+    current = None
+    with open(filename, 'r') as f:
+        for line in f:
+            m = re.match(r'^(\.+) (\S.*)$', line.rstrip('\n'))
+            if m is None:
+                if current:
+                    units.append(current)
+                current = None
+                continue
+            if current is None:
+                current = []
+            current.append(Include(len(m.group(1)), P.normpath(m.group(2))))
+    if current:
+        units.append(current)
+    return units
+
+def sizes_from_disk(includes):
+    for inc in includes:
+        try:
+            inc.size = P.getsize(inc.path)
+        except OSError:
+            pass
+
+class IncludeGraph(object):
+    def __init__(self):
+        self.units   = 0
+        self.bytes   = 0
+        self.headers = dict() # path -> [units, includes, own bytes, inclusive bytes]
+        self.edges   = dict() # (includer, header) -> count
+
+    def add_unit(self, unit, includes):
+        '''Add a unit and the headers it included, in the order they were
+           included (depth 1 being the ones the unit includes itself)'''
+        self.units += 1
+        seen = set()
+        stack = [] # [include, bytes of its subtree]
+        def close(entry):
+            stats = self.headers[entry[0].path]
+            stats[3] += entry[1]
+            if stack:
+                stack[-1][1] += entry[1]
+        for inc in includes:
+            while len(stack) >= inc.depth:
+                close(stack.pop())
+            parent = stack[-1][0].path if stack else unit
+            stats = self.headers.setdefault(inc.path, [0, 0, 0, 0])
+            if inc.path not in seen:
+                seen.add(inc.path)
+                stats[0] += 1
+            stats[1] += 1
+            stats[2] += inc.size
+            self.bytes += inc.size
+            self.edges[(parent, inc.path)] = self.edges.get((parent, inc.path), 0) + 1
+            stack.append([inc, inc.size])
+        while stack:
+            close(stack.pop())
+
+    def top(self, n, predicate=lambda path: True):
+        ranked = sorted((s[3], path) for path, s in self.headers.iteritems() if predicate(path))
+        return [path for size, path in reversed(ranked[-n:])] if n else []
+
+    def totals(self, key):
+        '''Units, includes and own bytes of the headers, summed by key(path)'''
+        ret = dict()
+        for path, s in self.headers.iteritems():
+            t = ret.setdefault(key(path), [0, 0, 0])
+            t[0] += 1
+            t[1] += s[1]
+            t[2] += s[2]
+        return ret
+
+    def write_dot(self, filename, n):
+        keep = set(self.top(n))
+        with open(filename, 'w') as f:
+            f.write('digraph includes {\n  rankdir=LR;\n  node [shape=box];\n')
+            for path in keep:
+                f.write('  "%s" [label="%s\\n%.1f MB"];\n' % (path, P.basename(path), self.headers[path][3] / 1e6))
+            for (parent, child), count in sorted(self.edges.iteritems()):
+                if parent in keep and child in keep:
+                    f.write('  "%s" -> "%s" [label="%d"];\n' % (parent, child, count))
+            f.write('}\n')
+
+def mb(n):
+    return '%.1f' % (n / 1e6)
+
+def print_headers(graph, paths, width=70):
+    print('%10s %10s %7s %9s  %s' % ('total MB', 'own MB', 'units', 'includes', 'header'))
+    for path in paths:
+        units, includes, own, total = graph.headers[path]
+        name = path if len(path) <= width else '...' + path[-(width - 3):]
+        print('%10s %10s %7d %9d  %s' % (mb(total), mb(own), units, includes, name))
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%s [options] <build dir> ...' % sys.argv[0])
+    parser.add_option('--trace', dest='traces', default=[], action='append', help='The stderr of a build with -H. Can be repeated.')
+    parser.add_option('--top',   dest='top',    default=25, type='int', help='Headers to list in each table (default: %default)')
+    parser.add_option('--dot',   dest='dot',    default=None, help='Write the include graph of the most expensive headers in graphviz format')
+
+    (opt, args) = parser.parse_args()
+    if not args and not opt.traces:
+        parser.print_help()
+        die('\nMissing required argument: build dir')
+
+    graph = IncludeGraph()
+    for directory in args:
+        found = [0, 0]
+        depfiles = []
+        # The sources as the compiles named them, which is how both the
+        # linemarkers and the dependency files give them
+        preprocessed = set()
+        for root, dirs, files in os.walk(directory):
+            for name in files:
+                path = P.join(root, name)
+                if name.endswith('.ii') or name.endswith('.i'):
+                    source, includes = parse_preprocessed(path)
+                    if source is None:
+                        continue
+                    graph.add_unit(path, includes)
+                    preprocessed.add(source)
+                    found[0] += 1
+                elif name.endswith(('.d', '.Po', '.Plo')):
+                    depfiles.append(path)
+        for path in depfiles:
+            for unit, includes in parse_depfile(path):
+                if unit in preprocessed:
+                    continue
+                sizes_from_disk(includes)
+                graph.add_unit(unit, includes)
+                found[1] += 1
+        print('%s: %d preprocessed units, %d from dependency files' % (directory, found[0], found[1]))
+    for trace in opt.traces:
+        units = parse_trace(trace)
+        for i, includes in enumerate(units):
+            sizes_from_disk(includes)
+            graph.add_unit('%s#%d' % (trace, i), includes)
+        print('%s: %d units' % (trace, len(units)))
+
+    if not graph.units:
+        die('Found nothing to analyze. Build with --save-temps, -MD or -H first.')
+
+    print('\n%d units, %d headers, %s MB of preprocessed headers'
+          % (graph.units, len(graph.headers), mb(graph.bytes)))
+
+    print('\n===== Most expensive headers, with everything they include =====')
+    print_headers(graph, graph.top(opt.top))
+
+    print('\n===== By library =====')
+    print('%10s %8s %9s  %s' % ('own MB', 'headers', 'includes', 'library'))
+    for name, t in sorted(graph.totals(library).iteritems(), key=lambda x: -x[1][2])[:opt.top]:
+        print('%10s %8d %9d  %s' % (mb(t[2]), t[0], t[1], name))
+
+    for name in LIBRARIES:
+        paths = graph.top(opt.top, lambda path: library(path) == name)
+        if paths:
+            print('\n===== Most expensive %s headers =====' % name)
+            print_headers(graph, paths)
+
+    print('\n===== Header search path =====')
+    print('%10s %8s %9s  %s' % ('own MB', 'headers', 'includes', 'directory'))
+    for name, t in sorted(graph.totals(include_dir).iteritems(), key=lambda x: -x[1][2]):
+        print('%10s %8d %9d  %s' % (mb(t[2]), t[0], t[1], name))
+
+    if opt.dot is not None:
+        graph.write_dot(opt.dot, opt.top)
+        print('\nWrote %s' % opt.dot)
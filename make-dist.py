@@ -9,7 +9,9 @@ if sys.version_info < (2, 6, 1):
     print('\nERROR: Must use Python 2.6.1 or greater.')
     sys.exit(code)
 
-from BinaryDist import grep, DistManager, Prefix, run
+from BinaryDist import grep, DistManager, Prefix, run, CODECS, BakeCache, RelocationIndex, default_baker
+from ChunkStore import ChunkStore
+from Ccache import export_cache
 
 import time, logging, copy, re, os
 import os.path as P
@@ -81,7 +83,7 @@ LIB_SYSTEM_LIST = '''
 # prefixes of libs that we always ship
 LIB_SHIP_PREFIX = '''libstdc++. libgfortran. libquadmath. libgcc_s. libgomp. libgobject-2.0. libgthread-2.0. libgmodule-2.0. libglib-2.0. libicui18n. libicuuc. libicudata. libdc1394. libxcb-xlib. libxcb. '''.split() # libssl. libcrypto.  libk5crypto. libcom_err. libkrb5support. libkeyutils. libresolv.
 
-def tarball_name():
+def tarball_name(mtime):
     arch = get_platform()
     if opt.version is not None:
         return '%s-%s-%s-%s%s' % (opt.name, opt.version, arch.machine, arch.dist_name, arch.dist_version)
@@ -89,7 +91,27 @@ def tarball_name():
         git = run('git', 'describe', '--always', '--dirty', output=False, raise_on_failure=False)
         if git is None: git = ''
         if len(git): git = '%s' % git.strip()
-        return '%s-%s-%s%s-%s%s' % (opt.name, arch.machine, arch.dist_name, arch.dist_version, time.strftime('%Y-%m-%d_%H-%M-%S', time.localtime()), git)
+        # The name is part of every path in the tarball, so it must not
+        # depend on when make-dist.py runs either
+        stamp = time.gmtime(mtime)
+        return '%s-%s-%s%s-%s%s' % (opt.name, arch.machine, arch.dist_name, arch.dist_version, time.strftime('%Y-%m-%d_%H-%M-%S', stamp), git)
+
+def files_mtime(installdir):
+    '''The timestamp for the files in the tarball, and in its name: the
+       newest mtime in the install dir. It stays the same for two runs on
+       the same install dir, and moves on with every build that changes
+       something in it. (The cwd is BinaryBuilder, its git log says
+       nothing about what is being packaged.)'''
+    if opt.timestamp is not None:
+        return opt.timestamp
+    newest = 0
+    for root, dirs, files in os.walk(installdir):
+        for name in files + dirs:
+            try:
+                newest = max(newest, os.lstat(P.join(root, name)).st_mtime)
+            except OSError:
+                pass
+    return int(newest)
 
 def sibling_to(dir, name):
     ''' get a pathname for a directory 'name' which is a sibling of directory 'dir' '''
@@ -124,10 +146,32 @@ if __name__ == '__main__':
     parser.add_option('--include',     dest='include',     default='./whitelist', help='A file that lists the binaries for the dist')
     parser.add_option('--debug-build', dest='debug_build', default=False, action='store_true', help='Create a build having debug symbols')
     parser.add_option('--vw-build',    dest='vw_build',    default=False, action='store_true', help='Set to true when packaging a non-ASP build')
+    parser.add_option('--debug-info',  dest='debug_info',  default='full', type='choice', choices=['full', 'split', 'compressed'],
+                      help='How the install dir was built (build.py --debug-info). split packs the .dwo files into .dwp files, compressed keeps the .debug files compressed. [%default]')
+    parser.add_option('--debug-store', dest='debug_store', default=None,
+                      help='Put the debug info of the binaries in this directory, keyed by build-id (.build-id/xx/yyyy.debug), instead of next to them')
+    parser.add_option('--export-ccache', dest='export_ccache', default=None,
+                      help='Also write the entries of this ccache directory to <tarball>-ccache, for build.py --ccache-warm')
     parser.add_option('--keep-temp',   dest='keeptemp',    default=False, action='store_true', help='Keep tmp distdir around for debugging')
     parser.add_option('--set-version', dest='version',     default=None, help='Set the version number to use for the generated tarball')
     parser.add_option('--set-name',    dest='name',        default='StereoPipeline', help='Tarball name for this dist')
     parser.add_option('--isisroot',    dest='isisroot',    default=None, help='Use a locally-installed isis at this root')
+    parser.add_option('--compress',    dest='codec',       default='pbzip2', type='choice', choices=sorted(CODECS.keys()),
+                      help='Compressor for the tarball [%s] (default: pbzip2)' % ', '.join(sorted(CODECS.keys())))
+    parser.add_option('--compress-level', dest='level',    default=None, type='int', help='Compression level (default depends on --compress)')
+    parser.add_option('--seekable',    dest='seekable',    default=False, action='store_true',
+                      help='Write the tarball as independently compressed frames plus an index, for use with extract-dist.py')
+    parser.add_option('--frame-size',  dest='frame_size',  default=4, type='int', help='Uncompressed size of a --seekable frame, in MB (default: 4)')
+    parser.add_option('--bake-cache',  dest='bake_cache',  default=P.expanduser('~/.cache/BinaryBuilder/bake'),
+                      help='Keep baked binaries here and reuse them when the source did not change (default: %default)')
+    parser.add_option('--no-bake-cache', dest='bake_cache', action='store_const', const=None, help='Bake every binary from scratch')
+    parser.add_option('--bake-cache-days', dest='bake_cache_days', default=14, type='int', help='Drop cache entries unused for this many days (default: %default)')
+    parser.add_option('--publish-chunks', dest='chunk_store', default=None,
+                      help='Also add the tarball to this chunk store (see chunk-store.py)')
+    parser.add_option('--timestamp',   dest='timestamp',   default=os.environ.get('SOURCE_DATE_EPOCH', None), type='int',
+                      help='Seconds since the epoch to use in the tarball name and for its files, for reproducible tarballs (default: $SOURCE_DATE_EPOCH)')
+    parser.add_option('--overlink-report', dest='overlink_report', default=None,
+                      help='Write the libraries each binary links but takes no symbols from to this file')
     parser.add_option('--force-continue', dest='force_continue', default=False, action='store_true', help='Continue despite errors. Not recommended.')
 
     global opt
@@ -160,11 +204,19 @@ if __name__ == '__main__':
     os.environ["PATH"] = P.join(installdir, 'bin') + os.pathsep + os.environ["PATH"]
 
     logging.basicConfig(level=opt.loglevel)
+    if opt.debug_store is not None:
+        opt.debug_store = P.realpath(opt.debug_store)
 
     wrapper_file = 'libexec-helper.sh'
     if (opt.vw_build):
         wrapper_file = 'libexec-helper_vw.sh'
-    mgr = DistManager(tarball_name(), wrapper_file)
+    cache = None
+    if opt.bake_cache is not None:
+        cache = BakeCache(opt.bake_cache, params=['debug-info=%s' % opt.debug_info,
+                                                  'debug-store=%s' % opt.debug_store])
+    mtime = files_mtime(installdir)
+    mgr = DistManager(tarball_name(mtime), wrapper_file, opt.codec, opt.level, cache, mtime)
+    frame_size = opt.frame_size * 1024 * 1024 if opt.seekable else None
 
     try:
         INSTALLDIR = Prefix(installdir)
@@ -183,8 +235,17 @@ if __name__ == '__main__':
             ISISROOT = opt.isisroot
 
         if opt.include == 'all':
-            mgr.add_directory(INSTALLDIR, hardlink=True)
-            mgr.make_tarball()
+            mgr.add_directory(INSTALLDIR)
+            # A tree packed whole gets deployed somewhere else, help relocating it
+            print('Indexing the install dir paths in %s' % INSTALLDIR)
+            sys.stdout.flush()
+            files = dict((P.relpath(dst, mgr.distdir), src) for dst, src in mgr.manifest.iteritems())
+            index = RelocationIndex.build(INSTALLDIR, files, get_platform())
+            with mgr.create_file(RelocationIndex.NAME) as f:
+                index.dump(f)
+            mgr.make_tarball(frame_size = frame_size, first = [mgr.distdir.base(RelocationIndex.NAME)])
+            if opt.chunk_store is not None:
+                ChunkStore(opt.chunk_store).publish(mgr.tarball_name(), level=opt.level)
             sys.exit(0)
         else:
             print('Adding requested files')
@@ -270,6 +331,16 @@ if __name__ == '__main__':
                 raise Exception('Failed to find some libs in any of our dirs:\n\t%s' % '\n\t'.join(mgr.deplist.keys()))
             else:
                 print("Warning: missing libs: " + '\n\t'.join(mgr.deplist.keys()) + "\n")
+
+        if opt.overlink_report is not None:
+            print('Looking for linked libraries that supply no symbols')
+            sys.stdout.flush()
+            unused = mgr.unused_libs()
+            with file(opt.overlink_report, 'w') as f:
+                for dst in sorted(unused):
+                    print('%s: %s' % (P.relpath(dst, mgr.distdir), ' '.join(unused[dst])), file=f)
+            print('\t%d of %d binaries link libraries they do not use, see %s'
+                  % (len(unused), len(mgr.needed), opt.overlink_report))
                 
         # We don't want to distribute with ASP any random files in
         # 'docs' installed by any of its deps. Distribute only what we need.
@@ -291,13 +362,22 @@ if __name__ == '__main__':
 
         print('Baking RPATH and stripping binaries')
         sys.stdout.flush()
-        mgr.bake(map(lambda path: P.relpath(path, INSTALLDIR), SEARCHPATH))
-
-        debuglist = mgr.find_filter('-name', '*.debug')
-
-        mgr.make_tarball(exclude = [debuglist.name])
-        if P.getsize(debuglist.name) > 0 and opt.debug_build:
-            mgr.make_tarball(include = debuglist.name, name = '%s-debug.tar.bz2' % mgr.tarname)
+        def baker(filename, distdir, searchpath):
+            default_baker(filename, distdir, searchpath, opt.debug_info, opt.debug_store)
+        mgr.bake(map(lambda path: P.relpath(path, INSTALLDIR), SEARCHPATH), baker)
+
+        is_debug = lambda path: path.endswith('.debug') or path.endswith('.dwp')
+
+        mgr.make_tarball(exclude = is_debug, frame_size = frame_size)
+        if opt.chunk_store is not None:
+            ChunkStore(opt.chunk_store).publish(mgr.tarball_name(), level=opt.level)
+        if opt.debug_build and any(map(is_debug, mgr.manifest)):
+            mgr.make_tarball(include = is_debug, name = mgr.tarball_name('-debug'), frame_size = frame_size)
+        if opt.export_ccache is not None:
+            export_cache(opt.export_ccache, mgr.tarball_name('-ccache'))
     finally:
+        if cache is not None:
+            cache.prune(opt.bake_cache_days)
+            cache.save()
         if not opt.keeptemp:
             mgr.remove_tempdir()
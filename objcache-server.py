@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import sys
+code = -1
+# Must have this check before importing other BB modules
+if sys.version_info < (2, 6, 1):
+    print('\nERROR: Must use Python 2.6.1 or greater.')
+    sys.exit(code)
+
+import os, time, socket, threading
+import os.path as P
+from optparse import OptionParser
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from BinaryBuilder import die
+from ObjCache import DirCache, KEY, parse_size
+
+''' Serves an object cache directory (see ObjCache.py) over HTTP, for
+    build.py --objcache http://<host>:<port> on the build machines:
+
+      GET /<key>   the compressed object, or 404
+      PUT /<key>   store one; an object already there is kept
+
+    By default it only listens on localhost, to try it out next to one
+    build; use --bind 0.0.0.0 to serve the other machines.
+
+    There is no authentication: whoever may PUT can put object code into
+    everyone's builds. So only the hosts given with --writer (and
+    localhost) may store objects, the others may only read. The check is
+    by address, so it only keeps out hosts that cannot spoof one; serve
+    the cache on a network of build machines you trust, not beyond.
+
+      ./objcache-server.py --max-size 50G ~/objcache &
+      ./build.py --objcache http://localhost:8765
+'''
+
+class Handler(BaseHTTPRequestHandler):
+    def _key(self):
+        key = self.path.strip('/')
+        if not KEY.match(key):
+            self.send_error(400, 'Not an object key')
+            return None
+        return key
+
+    def do_GET(self):
+        key = self._key()
+        if key is None:
+            return
+        data = self.server.cache.get_raw(key)
+        if data is None:
+            self.server.count('misses')
+            self.send_error(404)
+            return
+        self.server.count('hits')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_PUT(self):
+        if self.client_address[0] not in self.server.writers:
+            self.send_error(403, 'Not a writer')
+            return
+        key = self._key()
+        if key is None:
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        if length <= 0 or length > self.server.max_object:
+            self.send_error(413)
+            return
+        self.server.cache.put_raw(key, self.rfile.read(length))
+        self.server.count('stores')
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, cache, max_object, writers, verbose):
+        HTTPServer.__init__(self, address, Handler)
+        self.cache      = cache
+        self.max_object = max_object
+        self.writers    = writers
+        self.verbose    = verbose
+        self.stats      = dict(hits = 0, misses = 0, stores = 0)
+        self.lock       = threading.Lock()
+
+    def count(self, what):
+        with self.lock:
+            self.stats[what] += 1
+
+def addresses(hosts):
+    '''The IP addresses of the hosts'''
+    ret = set()
+    for host in hosts:
+        try:
+            ret.update(a[4][0] for a in socket.getaddrinfo(host, None))
+        except socket.gaierror, e:
+            die('Cannot resolve writer %s: %s' % (host, e))
+    return ret
+
+def trimmer(server, max_bytes, interval):
+    while True:
+        removed = server.cache.trim(max_bytes)
+        with server.lock:
+            print('%s: %d hits, %d misses, %d stored, %d trimmed'
+                  % (time.strftime('%H:%M:%S'), server.stats['hits'], server.stats['misses'], server.stats['stores'], removed))
+        time.sleep(interval)
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%s [options] <cache dir>' % sys.argv[0])
+    parser.add_option('--bind',       dest='bind',       default='127.0.0.1', help='Address to listen on (default: %default)')
+    parser.add_option('--port',       dest='port',       default=8765, type='int', help='Port to listen on (default: %default)')
+    parser.add_option('--max-size',   dest='max_size',   default=None, help='Trim the cache to this size (like 50G) every --interval seconds')
+    parser.add_option('--interval',   dest='interval',   default=600, type='int', help='Seconds between trims and statistics (default: %default)')
+    parser.add_option('--max-object', dest='max_object', default='256M', help='Refuse larger objects (default: %default)')
+    parser.add_option('--writer',     dest='writers',    default=[], action='append', help='A host that may store objects, besides localhost (may be repeated)')
+    parser.add_option('-v', '--verbose', dest='verbose', default=False, action='store_true', help='Log every request')
+
+    (opt, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        die('\nMissing required argument: cache dir')
+    if not P.isdir(args[0]):
+        os.makedirs(args[0])
+
+    writers = addresses(['localhost'] + opt.writers) | set(['127.0.0.1', '::1'])
+    server = Server((opt.bind, opt.port), DirCache(P.abspath(args[0])), parse_size(opt.max_object), writers, opt.verbose)
+    if opt.max_size is not None:
+        t = threading.Thread(target=trimmer, args=(server, parse_size(opt.max_size), opt.interval))
+        t.daemon = True
+        t.start()
+    print('Serving %s on http://%s:%d' % (args[0], opt.bind, opt.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass